@@ -4,13 +4,41 @@ try:
     import ConfigParser
 except ImportError:
     import configparser as ConfigParser
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import bisect
+import collections
+import errno
+import fcntl
 import glob
+import heapq
+import itertools
+import json
+import marshal
 import os
-import subprocess
+import re
+import select
+import signal
+import socket
 import sys
+import threading
 import time
 import traceback
-import urllib2
+import zlib
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
+# httplib, urllib, urllib2, smtplib, email, subprocess, gzip, shutil,
+# hashlib and random are imported where they are used: urllib2,
+# smtplib and email alone pull in ssl and double the time a run takes
+# to start, and most runs by eventcmd find nothing to do.
 
 
 CONFIG = None
@@ -73,73 +101,588 @@ events = {
     }
 
 
-def _update_state(prefix, key, value):
-    url = '%s/%s' % (prefix, key)
-    req = urllib2.Request(url, data=value)
-    req.get_method = lambda: 'PUT'
-    try:
-        u = urllib2.urlopen(req)
-    except urllib2.HTTPError:
-        req.get_method = lambda: 'POST'
-        u = urllib2.urlopen(req)
+def _keepalive_class():
+    import httplib
+    import urllib
+    import urllib2
+
+    class KeepAliveHTTPHandler(urllib2.HTTPHandler):
+        """An HTTP handler that keeps connections open between requests.
+
+        urllib2's stock handler sends "Connection: close" and opens a new
+        socket for every request. This one keeps a small pool of idle
+        HTTP/1.1 connections per host:port and reuses them, reconnecting
+        once if a pooled connection turns out to have gone stale.
+        """
+        def __init__(self, max_idle=4):
+            urllib2.HTTPHandler.__init__(self)
+            self.max_idle = max_idle
+            self._idle = {}
+            self._lock = threading.Lock()
+
+        def _checkout(self, host, timeout):
+            with self._lock:
+                pool = self._idle.get(host)
+                if pool:
+                    return pool.pop(), True
+            return httplib.HTTPConnection(host, timeout=timeout), False
+
+        def _checkin(self, host, conn):
+            with self._lock:
+                pool = self._idle.setdefault(host, [])
+                if len(pool) < self.max_idle:
+                    pool.append(conn)
+                    return
+            conn.close()
+
+        def close_all(self):
+            with self._lock:
+                pools, self._idle = self._idle, {}
+            for pool in pools.values():
+                for conn in pool:
+                    conn.close()
+
+        def http_open(self, req):
+            host = req.get_host()
+            if not host:
+                raise urllib2.URLError('no host given')
+            headers = dict(req.unredirected_hdrs)
+            headers.update(req.headers)
+            headers['Connection'] = 'keep-alive'
+
+            while True:
+                conn, reused = self._checkout(host, req.timeout)
+                try:
+                    conn.request(req.get_method(), req.get_selector(),
+                                 req.get_data(), headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+                    if not reused:
+                        raise urllib2.URLError(e)
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(host, conn)
+            result = urllib.addinfourl(StringIO(body), resp.msg,
+                                       req.get_full_url(), resp.status)
+            result.msg = resp.reason
+            return result
+
+
+    return KeepAliveHTTPHandler
+
+
+# Defined by keepalive_handler() once something needs urllib2
+KeepAliveHTTPHandler = None
+
+# The handler urllib2's default opener uses, once http_handler() has
+# installed it
+HTTP_HANDLER = None
+_HTTP_LOCK = threading.Lock()
+
+
+def keepalive_handler(max_idle=4):
+    """Return a new KeepAliveHTTPHandler."""
+    global KeepAliveHTTPHandler
+    if KeepAliveHTTPHandler is None:
+        KeepAliveHTTPHandler = _keepalive_class()
+    return KeepAliveHTTPHandler(max_idle)
 
-def update_state(event):
+
+def http_handler():
+    """Return urllib2, with the keep-alive handler installed in it."""
+    global HTTP_HANDLER
+    import urllib2
+    with _HTTP_LOCK:
+        if HTTP_HANDLER is None:
+            HTTP_HANDLER = keepalive_handler()
+            urllib2.install_opener(urllib2.build_opener(HTTP_HANDLER))
+    return urllib2
+
+
+# Which method (PUT or POST) each post_url prefix last accepted
+_STATE_METHODS = {}
+
+
+def _state_request(url, data, content_type, method):
+    import urllib2
+    req = urllib2.Request(url, data=data)
+    if content_type:
+        req.add_header('Content-Type', content_type)
+    req.get_method = lambda: method
+    return req
+
+
+def _send_state(prefix, url, data, content_type=None):
+    urllib2 = http_handler()
+    method = _STATE_METHODS.get(prefix, 'PUT')
+    timeout = general_option('http_timeout', 30, 'getfloat')
+    start = time.time()
+    result = 'failed'
     try:
-        prefix = CONFIG.get(event.system, 'post_url')
-    except ConfigParser.NoOptionError:
+        try:
+            u = urllib2.urlopen(_state_request(url, data, content_type,
+                                               method), timeout=timeout)
+        except urllib2.HTTPError:
+            method = method == 'PUT' and 'POST' or 'PUT'
+            u = urllib2.urlopen(_state_request(url, data, content_type,
+                                               method), timeout=timeout)
+            _STATE_METHODS[prefix] = method
+        u.close()
+        result = 'ok'
+    finally:
+        collected = metrics()
+        collected.observe('alarm_events_state_request_seconds',
+                          time.time() - start)
+        collected.count('alarm_events_state_requests_total', result=result)
+
+
+def _update_state(prefix, key, value):
+    _send_state(prefix, '%s/%s' % (prefix, key), value)
+
+
+def state_updates(event):
+    """Return the (key, value) pairs that describe event to post_url."""
+    if event.event_code == 570:
+        # Record bypasses separately
+        inbypass = event.qualifier != 3
+        return [('bypass', inbypass and 'yes' or 'no')]
+
+    updates = []
+    if event.event_code == 401:
+        if event.qualifier == 1:
+            state = 'disarmed'
+        elif event.qualifier == 3:
+            state = 'armed'
+        else:
+            state = 'unknown'
+        updates.append(('state', state))
+    updates.append(('event', event.event))
+    updates.append(('event_code', str(event.event_code)))
+    updates.append(('event_full', str(event)))
+    return updates
+
+
+def update_state(event, changes=None):
+    """Send the state updates for event, plus changes, to post_url.
+
+    changes defaults to what event changed in the panel's state.
+    """
+    if changes is None:
+        changes = track_panel_state([event])
+    system = system_index(event.system)
+    prefix = system.post_url
+    if prefix is None:
         return
 
+    updates = state_updates(event) + changes
+    queue = state_queue()
+    if queue.waiting(prefix):
+        # Sent now, these could be overwritten by older values from the
+        # queue, so they join it instead
+        queue.put(prefix, updates, system.post_batch)
+        return
     try:
-        if event.event_code == 570:
-            # Record bypasses separately
-            inbypass = event.qualifier != 3
-            _update_state(prefix, 'bypass', inbypass and 'yes' or 'no')
-            return
+        if system.post_batch:
+            _send_state(prefix, prefix, json.dumps(dict(updates)),
+                        'application/json')
+        else:
+            while updates:
+                key, value = updates[0]
+                _update_state(prefix, key, value)
+                updates.pop(0)
+    except Exception, e:
+        print 'FAILED to update state (will retry): %s' % e
+        queue.put(prefix, updates, system.post_batch)
+
+
+class StateQueue(object):
+    """State updates that post_url did not take, kept until it does.
 
-        if event.event_code == 401:
-            if event.qualifier == 1:
-                state = 'disarmed'
-            elif event.qualifier == 3:
-                state = 'armed'
+    Only the latest value of each key matters to the state endpoint,
+    so the queue keeps a file per post_url holding the newest unsent
+    value of each key, and sends just those once it answers again.
+    After a failed attempt a post_url waits backoff * 2 ** (failures -
+    1) seconds, at most max_backoff, less up to half of that at random
+    so that many systems do not all retry at the same moment. retry()
+    sends what is due; in daemon mode a thread calls it as things
+    become due. Several processes may share the queue directory: each
+    claims an entry under the lock before sending it, and the others
+    leave it alone for CLAIM seconds (enough for a run that died while
+    sending to be noticed).
+    """
+    CLAIM = 600
+
+    def __init__(self, path, backoff=5.0, max_backoff=600.0):
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = False
+
+    @classmethod
+    def from_config(cls):
+        return cls(general_option('state_queue_dir', None) or
+                   state_path('state-queue'),
+                   backoff=general_option('state_retry_backoff', 5.0,
+                                          'getfloat'),
+                   max_backoff=general_option('state_retry_max', 600.0,
+                                              'getfloat'))
+
+    def _file(self, prefix):
+        import hashlib
+        return os.path.join(self.path, 'state-%s.json' % (
+            hashlib.sha1(prefix).hexdigest()[:16]))
+
+    def _files(self):
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            return []
+        return [os.path.join(self.path, name) for name in names
+                if name.startswith('state-') and name.endswith('.json')]
+
+    def _delay(self, failures):
+        import random
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _locked(self, update):
+        """Call update() holding the queue's thread and file locks."""
+        with self._lock:
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(os.path.join(self.path, '.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                return update()
+
+    def waiting(self, prefix):
+        """Return whether anything is queued for prefix."""
+        return os.path.exists(self._file(prefix))
+
+    def put(self, prefix, updates, batch, now=None):
+        """Queue (key, value) updates, replacing older values of a key."""
+        path = self._file(prefix)
+
+        def update():
+            entry = self._load(path)
+            if entry is None:
+                entry = {'prefix': prefix, 'values': {}, 'failures': 1,
+                         'due': (now or time.time()) + self._delay(1)}
+            entry['batch'] = batch
+            entry['values'].update(updates)
+            _write_atomic(path, json.dumps(entry))
+        self._locked(update)
+        self._wake.set()
+
+    def next_due(self):
+        """Return when the next retry is due, or None if none are queued."""
+        due = [max(entry['due'], entry.get('claimed', 0))
+               for entry in map(self._load, self._files()) if entry]
+        return due and min(due) or None
+
+    @staticmethod
+    def _send(entry):
+        """Send what entry holds; return the values that got through."""
+        prefix = entry['prefix'].encode('utf-8')
+        values = entry['values']
+        sent = {}
+        try:
+            if entry['batch']:
+                _send_state(prefix, prefix, json.dumps(values),
+                            'application/json')
+                sent.update(values)
             else:
-                state = 'unknown'
-            _update_state(prefix, 'state', state)
-        _update_state(prefix, 'event', event.event)
-        _update_state(prefix, 'event_code', str(event.event_code))
-        _update_state(prefix, 'event_full', str(event))
-    except Exception, e:
-        print 'FAILED to update state: %s' % e
+                for key, value in sorted(values.items()):
+                    _update_state(prefix, key.encode('utf-8'),
+                                  value.encode('utf-8'))
+                    sent[key] = value
+        except Exception, e:
+            print 'FAILED to update state from the queue: %s' % e
+        return sent
 
+    def retry(self, now=None, force=False):
+        """Send the queued updates that are due (or all, with force).
 
-class TroubleReport(object):
-    def __init__(self, event):
-        self._event = event
+        Returns how many post_urls still have updates waiting.
+        """
+        if now is None:
+            now = time.time()
+        waiting = 0
+        for path in self._files():
 
-    def __str__(self):
-        if self._event.qualifier == 3:
-            qual = ' (restored)'
+            def claim():
+                entry = self._load(path)
+                if entry is None:
+                    return None
+                if (entry.get('claimed', 0) > now or
+                        entry['due'] > now and not force):
+                    return False
+                entry['claimed'] = now + self.CLAIM
+                _write_atomic(path, json.dumps(entry))
+                return entry
+            entry = self._locked(claim)
+            if not entry:
+                # Not due, or another process is sending it
+                waiting += entry is False
+                continue
+            sent = self._send(entry)
+
+            def update():
+                current = self._load(path)
+                if current is None:
+                    return False
+                current.pop('claimed', None)
+                # Values queued while we were sending still need to go
+                for key, value in sent.items():
+                    if current['values'].get(key) == value:
+                        del current['values'][key]
+                if not current['values']:
+                    os.remove(path)
+                    return False
+                if len(sent) < len(entry['values']):
+                    current['failures'] += 1
+                    current['due'] = now + self._delay(current['failures'])
+                else:
+                    current['due'] = now
+                _write_atomic(path, json.dumps(current))
+                return True
+            waiting += self._locked(update)
+        metrics().gauge('alarm_events_state_queued', waiting)
+        return waiting
+
+    def _run(self):
+        while not self._stopping:
+            due = self.next_due()
+            timeout = 60
+            if due is not None:
+                timeout = max(0, min(timeout, due - time.time()))
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if not self._stopping:
+                self.retry()
+
+    def start(self):
+        """Retry in the background from now on."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            # Unless it is in the middle of a retry, it stops at once
+            self._thread.join(1.0)
+
+
+def state_queue():
+    queue = getattr(CONFIG, '_alarm_state_queue', None)
+    if queue is None:
+        queue = CONFIG._alarm_state_queue = StateQueue.from_config()
+    return queue
+
+
+class PanelState(object):
+    """What one system's panel has reported about itself.
+
+    Each partition is armed or disarmed (401), and each zone may be
+    open and in alarm (1xx), bypassed (570) or in trouble (3xx); a
+    restore clears the flag. A zone stays in alarm after it closes
+    until its partition is next armed or disarmed, as on a keypad.
+    values() flattens this into partition_N and zone_N keys for
+    post_url.
+    """
+    def __init__(self, partitions=None, zones=None, alarms=None):
+        # partition -> 'armed' or 'disarmed'
+        self.partitions = partitions or {}
+        # zone -> set of 'open', 'bypassed', 'trouble'
+        self.zones = zones or {}
+        # zone in alarm -> its partition
+        self.alarms = alarms or {}
+
+    @classmethod
+    def from_json(cls, stored):
+        return cls(dict((int(p), state) for p, state in
+                        stored.get('partitions', {}).items()),
+                   dict((int(zone), set(flags)) for zone, flags in
+                        stored.get('zones', {}).items()),
+                   dict((int(zone), p) for zone, p in
+                        stored.get('alarms', {}).items()))
+
+    def to_json(self):
+        return {'partitions': self.partitions,
+                'zones': dict((zone, sorted(flags))
+                              for zone, flags in self.zones.items()),
+                'alarms': self.alarms}
+
+    def value(self, key):
+        kind, number = key.rsplit('_', 1)
+        number = int(number)
+        if kind == 'partition':
+            return self.partitions.get(number, 'unknown')
+        flags = sorted(self.zones.get(number, ()))
+        if number in self.alarms:
+            flags = sorted(flags + ['alarm'])
+        return ','.join(flags) or 'normal'
+
+    def values(self):
+        keys = (['partition_%i' % p for p in sorted(self.partitions)] +
+                ['zone_%i' % zone for zone in
+                 sorted(set(self.zones) | set(self.alarms))])
+        return [(key, self.value(key)) for key in keys]
+
+    def _flag(self, zone, flag, on):
+        flags = self.zones.setdefault(zone, set())
+        if on:
+            flags.add(flag)
         else:
-            qual = ''
-        return 'Trouble with expander device %i%s' % (
-            self._event.zone_number, qual)
+            flags.discard(flag)
+        if not flags:
+            del self.zones[zone]
 
+    def apply(self, event):
+        """Update from event; return the (key, value) pairs it changed."""
+        code = event.event_code
+        restore = event.qualifier == 3
+        zone = event.zone_number
+        if code == 401:
+            keys = ['partition_%i' % event.partition] + [
+                'zone_%i' % number for number, p in self.alarms.items()
+                if p == event.partition]
+        elif code == 570 or 100 <= code < 400:
+            keys = ['zone_%i' % zone]
+        else:
+            return []
+        before = [self.value(key) for key in keys]
 
-class NetworxTroubleReport(TroubleReport):
-    def __init__(self, event):
-        super(NetworxTroubleReport, self).__init__(event)
-        self._devices = {0: 'Control Panel'}
-        for keypad in range(0, 8):
-            for partition in range(0, 8):
-                index = 192 + (8 * keypad) + partition
-                self._devices[index] = 'Keypad %i (Partition %i)' % (
-                    keypad + 1, partition + 1)
-        expanders = [23] + range(16, 22) + range(96, 112)
-        for i, number in enumerate(expanders):
-            self._devices[number] = 'Expander %i (Zones %i-%i)' % (
-                number, 9 + i, 9 + 8 + i)
-        powers = range(84, 92)
-        for number in powers:
-            self._devices[number] = 'Power Supply %i' % number
+        if code == 401:
+            if event.qualifier in (1, 3):
+                self.partitions[event.partition] = (
+                    restore and 'armed' or 'disarmed')
+            for number, p in self.alarms.items():
+                if p == event.partition:
+                    del self.alarms[number]
+        elif code == 570:
+            self._flag(zone, 'bypassed', not restore)
+        elif code >= 300:
+            self._flag(zone, 'trouble', not restore)
+        else:
+            self._flag(zone, 'open', not restore)
+            if not restore:
+                self.alarms[zone] = event.partition
+        return [(key, self.value(key)) for key, old in zip(keys, before)
+                if self.value(key) != old]
+
+
+class PanelStates(object):
+    """The PanelState of every system, kept between runs in path.
+
+    Each system's state is a small JSON file of its own, read the
+    first time one of its events is seen and written by save() once
+    it has changed, so a run only touches the systems it handles.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._states = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(state_path('panels'))
+
+    def _file(self, system):
+        import urllib
+        return os.path.join(self.path, '%s.json' % urllib.quote(system, ''))
+
+    def get(self, system):
+        state = self._states.get(system)
+        if state is None:
+            try:
+                with open(self._file(system)) as f:
+                    state = PanelState.from_json(json.load(f))
+            except (IOError, ValueError):
+                state = PanelState()
+            self._states[system] = state
+        return state
+
+    def apply(self, events):
+        """Apply events in turn; return the (key, value) pairs changed."""
+        changes = collections.OrderedDict()
+        with self._lock:
+            for event in events:
+                for key, value in self.get(event.system).apply(event):
+                    changes[key] = value
+                    self._dirty.add(event.system)
+        return changes.items()
+
+    def save(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            stored = [(system, json.dumps(self._states[system].to_json()))
+                      for system in dirty]
+        if stored and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for system, data in stored:
+            _write_atomic(self._file(system), data)
+
+
+def panel_states():
+    """Return the PanelStates for CONFIG, or None if panel_state is off."""
+    if not general_option('panel_state', False, 'getboolean'):
+        return None
+    states = getattr(CONFIG, '_alarm_panel_state', None)
+    if states is None:
+        states = CONFIG._alarm_panel_state = PanelStates.from_config()
+    return states
+
+
+def track_panel_state(events):
+    """Apply events to their panels' state; return what changed."""
+    states = panel_states()
+    if states is None:
+        return []
+    return states.apply(events)
+
+
+def show_state(system):
+    """Print what system's panel last reported, as key=value lines."""
+    states = panel_states() or PanelStates.from_config()
+    for key, value in states.get(system).values():
+        print '%s=%s' % (key, value)
+
+
+class TroubleReport(object):
+    """The reason line for a trouble (3xx) event.
+
+    devices maps the device numbers a panel reports in the zone field
+    to names; it is shared, never copied, between reports.
+    """
+    devices = {}
+
+    def __init__(self, event, devices=None):
+        self._event = event
+        if devices is not None:
+            self.devices = devices
 
     def __str__(self):
         if self._event.qualifier == 3:
@@ -148,34 +691,310 @@ class NetworxTroubleReport(TroubleReport):
             qual = ''
         device = self._event.zone_number
         return 'Trouble with %s%s' % (
-            self._devices.get(device, 'expander device %i' % device),
+            self.devices.get(device, 'expander device %i' % device),
             qual)
 
 
-TROUBLE_REPORTERS = {
-    'networx': NetworxTroubleReport,
+def keypad_devices(devices, first, keypads, partitions):
+    """Name the devices of keypads addressed once per partition."""
+    for keypad in range(keypads):
+        for partition in range(partitions):
+            devices[first + partitions * keypad + partition] = (
+                'Keypad %i (Partition %i)' % (keypad + 1, partition + 1))
+
+
+def _networx_devices():
+    devices = {0: 'Control Panel'}
+    keypad_devices(devices, 192, 8, 8)
+    expanders = [23] + range(16, 22) + range(96, 112)
+    for i, number in enumerate(expanders):
+        devices[number] = 'Expander %i (Zones %i-%i)' % (
+            number, 9 + i, 9 + 8 + i)
+    for number in range(84, 92):
+        devices[number] = 'Power Supply %i' % number
+    return devices
+
+
+class NetworxTroubleReport(TroubleReport):
+    devices = _networx_devices()
+
+
+class PanelType(object):
+    """What is known about one kind of panel.
+
+    devices names the panel's device numbers for trouble reports, and
+    overrides replaces the names of some event codes.
+    """
+    def __init__(self, name, devices=None, overrides=None):
+        self.name = name
+        self.devices = devices or {}
+        self.overrides = overrides or {}
+        self.event_names = dict(events)
+        self.event_names.update(self.overrides)
+
+    def trouble_report(self, event):
+        return TroubleReport(event, self.devices)
+
+    @classmethod
+    def from_file(cls, path, known=None):
+        """Load a panel type definition; see samples/sample-panel.conf.
+
+        known maps the names of the types already loaded, which the
+        definition may inherit from.
+        """
+        cfg = ConfigParser.RawConfigParser()
+        if not cfg.read(path):
+            raise IOError('Cannot read panel type %s' % path)
+        name = cfg.get('panel', 'name')
+        devices = {}
+        overrides = {}
+        if cfg.has_option('panel', 'inherits'):
+            parent = (known or {}).get(cfg.get('panel', 'inherits'))
+            if parent is None:
+                raise ConfigParser.Error('%s: unknown panel type %r' % (
+                    path, cfg.get('panel', 'inherits')))
+            devices.update(parent.devices)
+            overrides.update(parent.overrides)
+        if cfg.has_section('keypads'):
+            keypad_devices(devices, cfg.getint('keypads', 'first'),
+                           cfg.getint('keypads', 'keypads'),
+                           cfg.getint('keypads', 'partitions'))
+        if cfg.has_section('expanders'):
+            for number, zones in cfg.items('expanders'):
+                devices[int(number)] = 'Expander %s (Zones %s)' % (
+                    number, zones)
+        if cfg.has_section('devices'):
+            for numbers, label in cfg.items('devices'):
+                first, _, last = numbers.partition('-')
+                first = int(first)
+                for i, number in enumerate(range(first,
+                                                 int(last or first) + 1)):
+                    devices[number] = label % {'n': number, 'i': i + 1}
+        if cfg.has_section('events'):
+            for code, text in cfg.items('events'):
+                overrides[int(code)] = text
+        return cls(name, devices, overrides)
+
+
+GENERIC_PANEL = PanelType(None)
+
+BUILTIN_PANEL_TYPES = {
+    'networx': PanelType('networx', NetworxTroubleReport.devices),
+}
+
+
+def panel_types():
+    """Return the panel types by name: built in, then from panel_dir.
+
+    Definitions are loaded in file name order, so one may inherit from
+    another that sorts before it.
+    """
+    types = getattr(CONFIG, '_alarm_panels', None)
+    if types is None:
+        types = CONFIG._alarm_panels = load_panel_types(
+            general_option('panel_dir', None))
+    return types
+
+
+def load_panel_types(panel_dir=None):
+    types = dict(BUILTIN_PANEL_TYPES)
+    if panel_dir:
+        for path in sorted(glob.glob(os.path.join(
+                os.path.expanduser(panel_dir), '*.conf'))):
+            panel = PanelType.from_file(path, types)
+            types[panel.name] = panel
+    return types
+
+
+def panel_type(system):
+    """Return the PanelType of system, or GENERIC_PANEL."""
+    try:
+        name = system_index(system).type
+    except ConfigParser.NoSectionError:
+        return GENERIC_PANEL
+    if name is None:
+        return GENERIC_PANEL
+    return panel_types().get(name, GENERIC_PANEL)
+
+
+EventRecord = collections.namedtuple(
+    'EventRecord',
+    'account qualifier event_code partition zone_number raw_event')
+
+
+# What message templates can refer to, and where each comes from
+_TEMPLATE_FIELDS = {
+    'account': lambda event: event.account,
+    'event': lambda event: event.event,
+    'event_num': lambda event: event.event_code,
+    'from_ext': lambda event: event.from_ext,
+    'partition': lambda event: event.partition,
+    'qualifier': lambda event: event.qualifier,
+    'raw_event': lambda event: event.raw_event,
+    'system': lambda event: event.system_name,
+    'system_id': lambda event: event.system,
+    'user': lambda event: event.user,
+    'zone': lambda event: event.zone,
+    'zone_num': lambda event: event.zone_number,
 }
 
+_TEMPLATE_FIELD = re.compile(r'%\((\w+)\)')
+
+# The built in template of each class of event codes (0xx-9xx)
+_DEFAULT_TEMPLATES = (
+    ['Unknown event %(event_num)i received for index %(zone_num)i '
+     'at %(system)s'] +
+    ['Alarm %(event_num)i: %(event)s in zone %(zone)s at %(system)s'] * 2 +
+    ['Event %(event_num)i: %(event)s in device %(zone)s at %(system)s',
+     'Event %(event_num)i: %(event)s by %(user)s at %(system)s',
+     'Event %(event_num)i: %(event)s in zone %(zone)s at %(system)s'] +
+    ['Event %(event_num)i: %(event)s at %(system)s'] * 4)
+
+_TEMPLATE_OPTION = re.compile(r'^template_(?:(\d)xx|(\d{3}))$')
+
+
+class MessageTemplate(object):
+    """A message format, knowing which fields of the event it uses.
+
+    Only those fields are looked up when it is rendered, so a template
+    without %(zone)s or %(user)s does not look for zone or user names.
+    """
+    __slots__ = ('text', 'fields')
+
+    def __init__(self, text):
+        names = sorted(set(_TEMPLATE_FIELD.findall(text)))
+        unknown = [name for name in names if name not in _TEMPLATE_FIELDS]
+        if unknown:
+            raise ValueError('Unknown field(s) %s in %r' % (
+                ', '.join(unknown), text))
+        try:
+            text % dict.fromkeys(names, 1)
+        except (TypeError, ValueError, KeyError), e:
+            raise ValueError('Bad template %r: %s' % (text, e))
+        self.text = text
+        self.fields = tuple((name, _TEMPLATE_FIELDS[name])
+                            for name in names)
+
+    def render(self, event):
+        return self.text % dict((name, get(event))
+                                for name, get in self.fields)
+
+
+class TemplateTable(object):
+    """The message template of each system and event code.
+
+    template_Nxx options set the template of a class of event codes and
+    template_NNN that of a single code. Those of a system section
+    override those in [general], which override the built in ones.
+    Each system's templates are compiled the first time one of its
+    events is rendered; systems with the same templates share them.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._compiled = {}
+        self._templates = {}
+        self._defaults = None
+
+    def _template(self, text):
+        template = self._templates.get(text)
+        if template is None:
+            template = self._templates[text] = MessageTemplate(text)
+        return template
+
+    def _options(self, section, classes, codes):
+        cfg = self.cfg
+        if not cfg.has_section(section):
+            return
+        for option in cfg.options(section):
+            match = _TEMPLATE_OPTION.match(option)
+            if not match:
+                continue
+            try:
+                template = self._template(cfg.get(section, option, True))
+            except ValueError, e:
+                raise ConfigError('[%s] %s: %s' % (section, option, e))
+            if match.group(1):
+                classes[int(match.group(1))] = template
+            else:
+                codes[int(match.group(2))] = template
+
+    def compile(self, system):
+        """Return (templates by code, templates by class) for system."""
+        if system in self._compiled:
+            return self._compiled[system]
+        if self._defaults is None:
+            classes = [self._template(text) for text in _DEFAULT_TEMPLATES]
+            codes = {}
+            self._options('general', classes, codes)
+            self._defaults = (codes, classes)
+        codes, classes = dict(self._defaults[0]), list(self._defaults[1])
+        if is_system_section(system):
+            self._options(system, classes, codes)
+        if (codes, classes) == (self._defaults[0], self._defaults[1]):
+            compiled = self._defaults
+        else:
+            compiled = (codes, classes)
+        self._compiled[system] = compiled
+        return compiled
+
+    def compile_all(self):
+        for section in self.cfg.sections():
+            self.compile(section)
+
+    def render(self, event):
+        codes, classes = self.compile(event.system)
+        template = codes.get(event.event_code)
+        if template is None:
+            template = classes[event.event_code / 100]
+        return template.render(event)
+
+
+def message_templates():
+    table = getattr(CONFIG, '_alarm_templates', None)
+    if table is None:
+        table = CONFIG._alarm_templates = TemplateTable(CONFIG)
+    return table
+
+
+class Event(object):
+    __slots__ = ('system_format', 'partition', 'from_ext', 'from_caller',
+                 'from_name', 'account', 'qualifier', 'event_code',
+                 'zone_number', 'raw_event', 'metadata', '_text',
+                 '_details')
+
+    # What dump() lists, after the reason for a trouble event
+    _DUMP_KEYS = ('event', 'zone', 'user', 'event_code', 'zone_number',
+                  'partition', 'qualifier', 'account', 'raw_event',
+                  'system_name', 'from_name', 'from_ext')
 
-class Event:
     def __init__(self, **kwargs):
         self.system_format = '%(account)s'
         self.partition = 0
         self.from_ext = '?'
         self.from_caller = '?'
         self.account = 0
+        self.metadata = {}
+        # What __str__() and dump() return, once they have been asked
+        self._text = self._details = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+    @classmethod
+    def from_record(cls, record):
+        event = cls()
+        (event.account, event.qualifier, event.event_code, event.partition,
+         event.zone_number, event.raw_event) = record
+        return event
+
     @property
     def system(self):
-        keys = ['partition', 'from_ext', 'from_caller', 'account']
-        attrs = {k: getattr(self, k) for k in keys}
-        return self.system_format % attrs
+        return self.system_format % {
+            'partition': self.partition, 'from_ext': self.from_ext,
+            'from_caller': self.from_caller, 'account': self.account}
 
     @property
     def system_name(self):
-        return CONFIG.get(self.system, 'name')
+        return system_index(self.system).require('name')
 
     @property
     def event(self):
@@ -183,7 +1002,8 @@ class Event:
             opens = {1: 'System disarmed normally',
                      3: 'System armed normally'}
             return opens.get(self.qualifier, 'Unknown Open/Close')
-        event = events.get(self.event_code, 'UNKNOWN')
+        event = panel_type(self.system).event_names.get(self.event_code,
+                                                        'UNKNOWN')
         if self.qualifier == 3 and ((self.event_code / 100) != 4):
             qual = ' (restored)'
         elif self.qualifier == 6:
@@ -194,100 +1014,122 @@ class Event:
 
     @property
     def zone(self):
-        try:
-            return CONFIG.get(self.system, 'zone_%i' % self.zone_number)
-        except ConfigParser.NoOptionError:
+        zone = system_index(self.system).zones.get(self.zone_number)
+        if zone is None:
             return 'Zone %i' % self.zone_number
+        return zone
 
     @property
     def user(self):
         if self.zone_number == 98:
             return 'keypad user'
 
-        try:
-            return CONFIG.get(self.system, 'user_%i' % self.zone_number)
-        except ConfigParser.NoOptionError:
+        user = system_index(self.system).users.get(self.zone_number)
+        if user is None:
             return 'User %i' % self.zone_number
+        return user
 
     def __str__(self):
-        data = {
-            'partition': self.partition,
-            'zone_num': self.zone_number,
-            'zone': self.zone,
-            'user': self.user,
-            'event_num': self.event_code,
-            'event': self.event,
-            'system': self.system_name,
-        }
-        if self.event_code >= 600:
-            res = 'Event %(event_num)i: %(event)s'
-        elif self.event_code >= 500:
-            res = ('Event %(event_num)i: %(event)s '
-                   'in zone %(zone)s')
-        elif self.event_code >= 400:
-            res = ('Event %(event_num)i: %(event)s '
-                   'by %(user)s')
-        elif self.event_code >= 300:
-            res = ('Event %(event_num)i: %(event)s '
-                   'in device %(zone)s')
-        elif self.event_code >= 100:
-            res = ('Alarm %(event_num)i: %(event)s in zone %(zone)s')
-        else:
-            res = 'Unknown event %(event_num)i received for index %(zone_num)i'
-
-        if False:
-            # Insert partition information
-            res = '[P%(partition)02i] ' + res
-
-        res += ' at %(system)s'
-        return res % data
+        # The mail subject, the log, event_full and so on all want it
+        if self._text is None:
+            self._text = message_templates().render(self)
+        return self._text
 
     def dump(self):
-        keys = ['event', 'zone', 'user', 'event_code', 'zone_number',
-                'partition', 'qualifier', 'account', 'raw_event',
-                'system_name', 'from_name', 'from_ext']
-        string = ''
+        if self._details is not None:
+            return self._details
+        lines = []
         if self.event_code / 100 == 3:
+            trouble_rpt = panel_type(self.system).trouble_report(self)
+            lines.append('reason=%s\n' % trouble_rpt)
+        for key in self._DUMP_KEYS:
             try:
-                trouble_cls = TROUBLE_REPORTERS[CONFIG.get(self.system,
-                                                           'type')]
-            except:
-                trouble_cls = TroubleReport
-            trouble_rpt = trouble_cls(self)
-            string += 'reason=%s\n' % trouble_rpt
-        for key in keys:
-            if hasattr(self, key):
-                string += '%s=%s\n' % (key, getattr(self, key))
-        return string
+                value = getattr(self, key)
+            except Exception:
+                # Unset, or no such system; as hasattr() would skip it
+                continue
+            lines.append('%s=%s\n' % (key, value))
+        self._details = ''.join(lines)
+        return self._details
 
 
-def process_event(lines):
-    event = None
-    ext = None
-    name = None
+def iter_spool_records(lines):
+    """Yield (metadata, event_code) for every event in a spool file.
+
+    alarmreceiver writes a [metadata] section of KEY=value lines and an
+    [events] section with one ContactID code per line; with
+    logindividualevents off, one file holds every event from a call.
+    lines may be an open file, which is then read lazily. Each event
+    is paired with the metadata read before it.
+    """
+    metadata = {}
+    shared = False
     for line in lines:
-        if not line:
+        line = line.strip()
+        if not line or line.startswith('['):
             continue
-        if line.startswith('CALLINGFROM'):
-            _, ext = line.split('=', 1)
-            ext = ext.strip()
-        if line.startswith('CALLERNAME'):
-            _, name = line.split('=', 1)
-            name = name.strip()
         if line[0].isdigit():
-            event = line.strip()
-            break
+            shared = True
+            yield metadata, line
+        elif '=' in line:
+            if shared:
+                # Don't change what earlier events were given
+                metadata = dict(metadata)
+                shared = False
+            key, value = line.split('=', 1)
+            metadata[key.strip()] = value.strip()
+
 
-    return ext, name, event
+def process_event(lines):
+    """Return (CALLINGFROM, CALLERNAME, event) for the first event."""
+    for metadata, event in iter_spool_records(lines):
+        return metadata.get('CALLINGFROM'), metadata.get('CALLERNAME'), event
+    return None, None, None
 
 
 def process_event_file(filename):
     with file(filename) as f:
-        lines = f.readlines()
-    return process_event(lines)
+        return process_event(f)
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+# ContactID: ACCT MT Q EEE GG CCC S, where the message type MT is 18 (or
+# 98) and S is the checksum digit.
+_CONTACTID_FORMAT = r'([0-9]{4})(18|98)([0-9])([0-9]{3})([0-9]{2})([0-9]{3})'
+_CONTACTID = re.compile(_CONTACTID_FORMAT + r'.$')
+_CONTACTID_LINES = re.compile(r'^(' + _CONTACTID_FORMAT + r'.)$', re.M)
+
+# Checksum weights for the digits alarmreceiver hands us
+_CHECKSUM_DIGITS = '0123456789*#ABC'
+_CHECKSUM_WEIGHTS = dict(zip(_CHECKSUM_DIGITS,
+                             [10, 1, 2, 3, 4, 5, 6, 7, 8, 9,
+                              11, 12, 13, 14, 15]))
+
+
+def checksum_ok(event_code):
+    """Check the ContactID rule: all digit weights sum to a multiple of 15."""
+    try:
+        return sum(_CHECKSUM_WEIGHTS[c] for c in event_code) % 15 == 0
+    except KeyError:
+        return False
+
+
+def checksum_digit(event_code):
+    """Return the digit that completes the first 15 digits of event_code."""
+    total = sum(_CHECKSUM_WEIGHTS[c] for c in event_code[:15])
+    weight = 15 - total % 15
+    for digit, value in _CHECKSUM_WEIGHTS.items():
+        if value == weight:
+            return digit
 
 
 def parse_event_code(event_code):
+    match = event_code and _CONTACTID.match(event_code)
+    if not match or len(event_code) != 16:
+        raise InvalidEvent('Malformed ContactID event %r' % event_code)
     event = Event()
     event.account = int(event_code[0:4])
     event.qualifier = int(event_code[6])
@@ -298,80 +1140,3736 @@ def parse_event_code(event_code):
     return event
 
 
-def mail_event(event):
-    nomail = CONFIG.get(event.system, 'nomail_events').split(',')
-    nomail = [int(x) for x in nomail]
-    if event.event_code in nomail:
+_FIELD_TABLES = {}
+
+
+def _field_tables():
+    """Map every 1-4 digit field to its value and its checksum weight.
+
+    Dict lookups are several times cheaper than int() and a per-digit
+    sum, which is what makes parse_event_codes() fast.
+    """
+    if not _FIELD_TABLES:
+        values = {}
+        weights = {}
+        for width in range(1, 5):
+            for number in range(10 ** width):
+                field = '%0*i' % (width, number)
+                values[field] = number
+                weights[field] = sum(_CHECKSUM_WEIGHTS[c] for c in field)
+        weights.update((c, w) for c, w in _CHECKSUM_WEIGHTS.items())
+        _FIELD_TABLES['values'] = values
+        _FIELD_TABLES['weights'] = weights
+    return _FIELD_TABLES['values'], _FIELD_TABLES['weights']
+
+
+def parse_event_codes(data, verify_checksum=True):
+    """Parse many ContactID events in one pass.
+
+    data is either a string holding whitespace-separated codes (such as
+    the contents of a replay file) or an iterable of codes. Returns a
+    list of EventRecord, or raises InvalidEvent for the first code that
+    is malformed or, with verify_checksum, fails its checksum.
+    """
+    if isinstance(data, basestring):
+        codes = data.split()
+    else:
+        codes = [code.strip() for code in data if code.strip()]
+    matches = _CONTACTID_LINES.findall('\n'.join(codes))
+    if len(matches) != len(codes):
+        for code in codes:
+            parse_event_code(code)
+
+    values, weights = _field_tables()
+    new = tuple.__new__
+    records = []
+    append = records.append
+    for raw, account, msgtype, qualifier, code, partition, zone in matches:
+        if verify_checksum:
+            total = (weights[account] + weights[msgtype] +
+                     weights[qualifier] + weights[code] +
+                     weights[partition] + weights[zone] +
+                     weights.get(raw[15], 1))
+            if raw[15] not in _CHECKSUM_WEIGHTS or total % 15:
+                raise InvalidEvent('Bad checksum on event %r' % raw)
+        append(new(EventRecord, (values[account], values[qualifier],
+                                 values[code], values[partition],
+                                 values[zone], raw)))
+    return records
+
+
+class SMTPMailer(object):
+    """Send mail over a single SMTP connection kept open between messages.
+
+    All of a message's recipients go in one transaction. A send that
+    fails is retried with exponential backoff; if it still fails, the
+    message is written to the outbox directory and flush_outbox() tries
+    it again later, so an SMTP outage does not lose notifications. While
+    the server cannot be reached, the outbox waits OUTBOX_RETRY seconds,
+    doubling up to OUTBOX_RETRY_MAX, between tries; the time of the
+    next one is kept in the outbox, so that forked runs wait too.
+    """
+    OUTBOX_RETRY = 60
+    OUTBOX_RETRY_MAX = 600
+
+    def __init__(self, host, port=25, starttls=False, user=None,
+                 password=None, retries=3, backoff=1.0, outbox=None,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.retries = retries
+        self.backoff = backoff
+        self.outbox = outbox
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(CONFIG.get('general', 'smtp_host'),
+                   port=general_option('smtp_port', 25, 'getint'),
+                   starttls=general_option('smtp_starttls', False,
+                                           'getboolean'),
+                   user=general_option('smtp_user', None),
+                   password=general_option('smtp_password', None),
+                   retries=general_option('smtp_retries', 3, 'getint'),
+                   backoff=general_option('smtp_backoff', 1.0, 'getfloat'),
+                   outbox=general_option('outbox_dir', None) or
+                   state_path('outbox'),
+                   timeout=general_option('smtp_timeout', 30, 'getfloat'))
+
+    def _connect(self):
+        import smtplib
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            conn.starttls()
+            conn.ehlo()
+        if self.user:
+            conn.login(self.user, self.password or '')
+        return conn
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            import smtplib
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, socket.error):
+                conn.close()
+
+    @staticmethod
+    def _connection_errors():
+        """The errors that mean the server itself could not be used."""
+        import smtplib
+        return (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected,
+                smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError,
+                socket.error)
+
+    def _drop(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _retry_path(self):
+        return os.path.join(self.outbox, 'retry')
+
+    def _retry_state(self):
+        try:
+            with open(self._retry_path()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _unreachable(self, now=None):
+        """Put off the next outbox flush, for longer each time."""
+        if now is None:
+            now = time.time()
+        state = self._retry_state()
+        delay = (state and min(state['delay'] * 2, self.OUTBOX_RETRY_MAX) or
+                 self.OUTBOX_RETRY)
+        if not os.path.isdir(self.outbox):
+            os.makedirs(self.outbox)
+        _write_atomic(self._retry_path(), json.dumps({'at': now + delay,
+                                                      'delay': delay}))
+        return delay
+
+    def _reachable(self):
+        try:
+            os.remove(self._retry_path())
+        except OSError:
+            pass
+
+    def _sendmail(self, sender, recipients, message):
+        """Send on the open connection, reconnecting once if it is stale."""
+        import smtplib
+        if self._conn is not None:
+            try:
+                self._conn.sendmail(sender, recipients, message)
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self._conn.close()
+                self._conn = None
+        self._conn = self._connect()
+        self._conn.sendmail(sender, recipients, message)
+
+    def deliver(self, sender, recipients, message):
+        """Try to send, with backoff; return False if it never worked."""
+        import smtplib
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Not holding the lock, so other accounts' mail can go
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            with self._lock:
+                try:
+                    self._sendmail(sender, recipients, message)
+                    self._reachable()
+                    return True
+                except (smtplib.SMTPException, socket.error), e:
+                    print 'SMTP delivery to %s failed: %s' % (
+                        ','.join(recipients), e)
+                    self._drop()
+                    error = e
+        if isinstance(error, self._connection_errors()):
+            self._unreachable()
+        return False
+
+    def send(self, subject, body, dest, fromaddr=None):
+        from email.mime.text import MIMEText
+        from email import utils as email_utils
+        fromaddr = fromaddr or general_option('email_from',
+                                              'alarm_events@localhost')
+        recipients = [addr for _, addr in email_utils.getaddresses([dest])
+                      if addr]
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = fromaddr
+        msg['To'] = ', '.join(recipients)
+        msg['Date'] = email_utils.formatdate(localtime=True)
+        sender = email_utils.parseaddr(fromaddr)[1]
+        message = msg.as_string()
+        if not self.deliver(sender, recipients, message):
+            self._to_outbox(sender, recipients, message)
+
+    def _to_outbox(self, sender, recipients, message):
+        if not os.path.isdir(self.outbox):
+            os.makedirs(self.outbox)
+        path = os.path.join(self.outbox, 'mail-%.6f-%i-%i' % (
+            time.time(), os.getpid(), threading.current_thread().ident))
+        _write_atomic(path, json.dumps({'sender': sender,
+                                        'recipients': recipients,
+                                        'message': message}))
+        print 'Queued undeliverable mail in %s' % path
+
+    def flush_outbox(self, now=None):
+        """Retry queued mail; returns how many are still waiting.
+
+        Nothing is tried before the time set when the server was last
+        found unreachable, and the first connection error ends the try.
+        """
+        try:
+            names = sorted(name for name in os.listdir(self.outbox)
+                           if name.startswith('mail-') and
+                           not name.endswith('.tmp'))
+        except OSError:
+            return 0
+        if not names:
+            return 0
+        if now is None:
+            now = time.time()
+        state = self._retry_state()
+        if state and state['at'] > now:
+            return len(names)
+        import smtplib
+        waiting = 0
+        for index, name in enumerate(names):
+            path = os.path.join(self.outbox, name)
+            with open(path) as f:
+                queued = json.load(f)
+            with self._lock:
+                try:
+                    self._sendmail(queued['sender'], queued['recipients'],
+                                   queued['message'].encode('utf-8'))
+                except self._connection_errors(), e:
+                    self._drop()
+                    print 'SMTP server unreachable, outbox retried in ' \
+                        '%is: %s' % (self._unreachable(now), e)
+                    return waiting + len(names) - index
+                except smtplib.SMTPException:
+                    # Refused, say, for this message only
+                    waiting += 1
+                    continue
+            os.remove(path)
+        self._reachable()
+        return waiting
+
+
+def smtp_mailer():
+    """Return the SMTPMailer for CONFIG, or None to use /usr/bin/mail."""
+    if not CONFIG.has_option('general', 'smtp_host'):
+        return None
+    mailer = getattr(CONFIG, '_alarm_mailer', None)
+    if mailer is None:
+        mailer = CONFIG._alarm_mailer = SMTPMailer.from_config()
+    return mailer
+
+
+def close_sinks():
+    """Flush and close whatever the sinks kept open during a run.
+
+    Mail still in the outbox gets another try first.
+    """
+    mailer = smtp_mailer()
+    if mailer is not None:
+        mailer.flush_outbox()
+        mailer.close()
+    log = getattr(CONFIG, '_alarm_log', None)
+    if log is not None:
+        log.close()
+    store = getattr(CONFIG, '_alarm_store', None)
+    if store is not None:
+        store.close()
+        CONFIG._alarm_store = None
+    for sink in getattr(CONFIG, '_alarm_sinks', None) or []:
+        sink.close()
+    queue = getattr(CONFIG, '_alarm_state_queue', None)
+    if queue is not None:
+        queue.close()
+    states = getattr(CONFIG, '_alarm_panel_state', None)
+    if states is not None:
+        states.save()
+    checkins = getattr(CONFIG, '_alarm_checkins', None)
+    if checkins is not None:
+        checkins.save()
+
+
+def send_mail(subject, body, dest, fromaddr=None):
+    mailer = smtp_mailer()
+    if mailer is not None:
+        mailer.send(subject, body, dest, fromaddr)
         return
-    fromaddr = CONFIG.get('general', 'email_from')
-    dest = CONFIG.get(event.system, 'email')
-    mail = subprocess.Popen(
-        ['/usr/bin/mail',
-         '-S', 'from=%s' % fromaddr,
-         '-s', str(event), dest],
-         stdin=subprocess.PIPE)
-    mail.stdin.write(event.dump())
+    import subprocess
+    args = ['/usr/bin/mail']
+    if fromaddr:
+        args += ['-S', 'from=%s' % fromaddr]
+    mail = subprocess.Popen(args + ['-s', subject, dest],
+                            stdin=subprocess.PIPE)
+    mail.stdin.write(body)
     mail.stdin.close()
     mail.wait()
 
 
-def log_event(event):
-    filename = os.path.join(os.getenv('HOME', '/tmp'),
-                            '%s-security.log' % event.account)
-    line = '%s: %s' % (time.strftime('%Y-%m-%dT%H:%M:%S'),
-                       str(event))
-    with file(filename, 'a') as f:
-        f.write(line + '\n')
+def mail_event(event):
+    system = system_index(event.system)
+    if event.event_code in system.require('nomail'):
+        return
+    fromaddr = CONFIG.get('general', 'email_from')
+    send_mail(str(event), event.dump(), system.require('email'), fromaddr)
 
 
-def load_config(filename):
-    global CONFIG
-    CONFIG = ConfigParser.ConfigParser()
-    CONFIG.read(filename)
+class _LogFile(object):
+    __slots__ = ('path', 'handle', 'size', 'period', 'pending')
 
+    def __init__(self, path, period):
+        self.path = path
+        self.handle = open(path, 'a')
+        self.size = self.handle.tell()
+        self.period = period
+        self.pending = 0
 
-def main():
-    spool = CONFIG.get('general', 'spool_dir')
-    if CONFIG.has_option('general', 'system_format'):
-        system_format = CONFIG.get('general', 'system_format', True)
-    else:
-        system_format = None
-    files = glob.glob(os.path.join(spool, 'event-*'))
-    for filename in files:
-        from_ext, from_name, event_code = process_event_file(filename)
-        event = parse_event_code(event_code)
-        event.from_ext = from_ext
-        event.from_name = from_name
-        if system_format:
-            event.system_format = system_format
 
-        mail_event(event)
-        log_event(event)
-        update_state(event)
-        os.remove(filename)
+def event_record(event, stamp):
+    """Return the fields of event, for .jsonl logs and JSON sinks."""
+    return collections.OrderedDict([
+        ('time', stamp),
+        ('account', event.account),
+        ('system', event.system),
+        ('event_code', event.event_code),
+        ('qualifier', event.qualifier),
+        ('partition', event.partition),
+        ('zone_number', event.zone_number),
+        ('zone', event.zone),
+        ('user', event.user),
+        ('event', event.event),
+        ('text', str(event)),
+        ('raw_event', event.raw_event),
+    ])
 
 
-def safe_main():
-    try:
-        main()
-    except Exception, e:
-        print 'Failed: %s' % e
-        sn_email = CONFIG.get('general', 'safety_net_email')
-        subject = 'Failed to process alarm event'
-        msg = ('Failed to process event:\n' +
-               traceback.format_exc())
-        mail = subprocess.Popen(
-            ['/usr/bin/mail',
-             '-s', subject, sn_email],
-            stdin=subprocess.PIPE)
-        mail.stdin.write(msg)
-        mail.stdin.close()
-        mail.wait()
+class EventLog(object):
+    """Append event lines to per-account logs with open handles kept.
 
+    At most max_open files are held open, least recently used first to
+    be closed. Lines are flushed every flush_lines lines (and fsync'd
+    if asked), and on flush()/close(). A log is rotated when it would
+    grow past rotate_size bytes, or when rotate_period ('daily' or
+    'monthly') rolls over; rotated segments are gzipped if compress is
+    set. With json_lines, a <account>-security.jsonl file holding the
+    parsed fields is written alongside each log.
+    """
+    PERIODS = {'daily': '%Y-%m-%d', 'monthly': '%Y-%m'}
 
-if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print 'Requires config path as argument'
+    def __init__(self, directory, max_open=32, flush_lines=1, fsync=False,
+                 rotate_size=0, rotate_period=None, compress=False,
+                 json_lines=False):
+        if rotate_period and rotate_period not in self.PERIODS:
+            raise ValueError('Unknown log rotation period %r' %
+                             rotate_period)
+        self.directory = directory
+        self.max_open = max(1, max_open)
+        self.flush_lines = max(1, flush_lines)
+        self.fsync = fsync
+        self.rotate_size = rotate_size
+        self.period_format = self.PERIODS.get(rotate_period)
+        self.compress = compress
+        self.json_lines = json_lines
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stamp_second = None
+        self._stamp = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(general_option('log_dir', None) or
+                   os.getenv('HOME', '/tmp'),
+                   max_open=general_option('log_max_open', 32, 'getint'),
+                   flush_lines=general_option('log_flush_lines', 1,
+                                              'getint'),
+                   fsync=general_option('log_fsync', False, 'getboolean'),
+                   rotate_size=general_option('log_rotate_size', 0,
+                                              'getint'),
+                   rotate_period=general_option('log_rotate', None),
+                   compress=general_option('log_compress', False,
+                                           'getboolean'),
+                   json_lines=general_option('log_json', False,
+                                             'getboolean'))
+
+    def _timestamp(self, now):
+        second = int(now)
+        if second != self._stamp_second:
+            self._stamp = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                        time.localtime(second))
+            self._stamp_second = second
+        return self._stamp
+
+    def _period(self, now):
+        if self.period_format:
+            return time.strftime(self.period_format, time.localtime(now))
+        return None
+
+    def _open(self, path, now):
+        log = self._files.pop(path, None)
+        if log is None:
+            period = None
+            if self.period_format and os.path.exists(path):
+                period = self._period(os.stat(path).st_mtime)
+            log = _LogFile(path, period or self._period(now))
+            while len(self._files) >= self.max_open:
+                _, oldest = self._files.popitem(last=False)
+                self._close(oldest)
+        self._files[path] = log
+        return log
+
+    def _sync(self, log):
+        log.handle.flush()
+        if self.fsync:
+            os.fsync(log.handle.fileno())
+        log.pending = 0
+
+    def _close(self, log):
+        self._sync(log)
+        log.handle.close()
+
+    def _rotate(self, log, now):
+        self._close(log)
+        suffix = log.period or time.strftime('%Y%m%d-%H%M%S',
+                                             time.localtime(now))
+        target = '%s.%s' % (log.path, suffix)
+        count = 0
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            count += 1
+            target = '%s.%s.%i' % (log.path, suffix, count)
+        os.rename(log.path, target)
+        if self.compress:
+            import gzip
+            import shutil
+            with open(target, 'rb') as src:
+                with gzip.open(target + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(target)
+        return _LogFile(log.path, self._period(now))
+
+    def _append(self, path, line, now):
+        log = self._open(path, now)
+        if ((self.rotate_size and log.size and
+             log.size + len(line) > self.rotate_size) or
+                log.period != self._period(now)):
+            log = self._files[path] = self._rotate(log, now)
+        log.handle.write(line)
+        log.size += len(line)
+        log.pending += 1
+        if log.pending >= self.flush_lines:
+            self._sync(log)
+
+    def write(self, event, now=None):
+        if now is None:
+            now = time.time()
+        stamp = self._timestamp(now)
+        base = os.path.join(self.directory, '%s-security' % event.account)
+        line = '%s: %s\n' % (stamp, event)
+        if self.json_lines:
+            record = json.dumps(event_record(event, stamp)) + '\n'
+        with self._lock:
+            self._append(base + '.log', line, now)
+            if self.json_lines:
+                self._append(base + '.jsonl', record, now)
+
+    def flush(self):
+        with self._lock:
+            for log in self._files.values():
+                if log.pending:
+                    self._sync(log)
+
+    def close(self):
+        with self._lock:
+            while self._files:
+                self._close(self._files.popitem()[1])
+
+
+def event_log():
+    log = getattr(CONFIG, '_alarm_log', None)
+    if log is None:
+        log = CONFIG._alarm_log = EventLog.from_config()
+    return log
+
+
+def log_event(event):
+    event_log().write(event)
 
-    load_config(sys.argv[1])
-    safe_main()
+
+def event_store():
+    """Return the history store, or None if history_db is not set."""
+    if not CONFIG.has_option('general', 'history_db'):
+        return None
+    store = getattr(CONFIG, '_alarm_store', None)
+    if store is None:
+        import alarm_history
+        store = CONFIG._alarm_store = alarm_history.EventStore(
+            os.path.expanduser(CONFIG.get('general', 'history_db')))
+    return store
+
+
+def store_event(event):
+    store = event_store()
+    if store is not None:
+        store.add(event)
+
+
+class Digest(object):
+    """A burst of same-class events from one system, delivered as one."""
+    def __init__(self, events):
+        self.events = events
+        self.account = events[0].account
+        self.system = events[0].system
+        self.raw_event = ','.join(event.raw_event for event in events)
+
+    def __str__(self):
+        names = []
+        for event in self.events:
+            if event.event not in names:
+                names.append(event.event)
+        return '%i events at %s: %s' % (len(self.events),
+                                         self.events[0].system_name,
+                                         ', '.join(names))
+
+    def dump(self):
+        lines = []
+        for event in self.events:
+            stamp = event.metadata.get('TIMESTAMP')
+            lines.append(stamp and '%s: %s' % (stamp, event) or str(event))
+        return '\n'.join(lines + [''] + [event.dump()
+                                         for event in self.events])
+
+
+def mail_digest(digest):
+    system = system_index(digest.system)
+    nomail = system.require('nomail')
+    events = [event for event in digest.events
+              if event.event_code not in nomail]
+    if len(events) == 1:
+        return mail_event(events[0])
+    elif events:
+        digest = Digest(events)
+        send_mail(str(digest), digest.dump(), system.require('email'),
+                  CONFIG.get('general', 'email_from'))
+
+
+def log_digest(digest):
+    for event in digest.events:
+        log_event(event)
+
+
+def update_digest_state(digest):
+    # Every event moves the panel state on, but otherwise only the
+    # latest value matters to the state endpoint
+    update_state(digest.events[-1], track_panel_state(digest.events))
+
+
+def store_digest(digest):
+    for event in digest.events:
+        store_event(event)
+
+
+def digest_sinks():
+    return ([mail_digest, log_digest, update_digest_state, store_digest] +
+            [_DigestSink(sink) for sink in sink_plugins()])
+
+
+# Sections named [sink:NAME] configure sinks and their routing rather
+# than systems
+SINK_PREFIX = 'sink:'
+
+# The names routing rules use for the built in sinks
+_BUILTIN_SINKS = {
+    'mail': 'mail_event',
+    'log': 'log_event',
+    'state': 'update_state',
+    'history': 'store_event',
+}
+
+
+def is_system_section(section):
+    return section != 'general' and not section.startswith(SINK_PREFIX)
+
+
+class Sink(object):
+    """A sink configured in a [sink:NAME] section.
+
+    Subclasses implement deliver(), which should raise if the event
+    could not be delivered. A burst of coalesced events is passed to
+    digest(), which by default delivers each of them in turn. Sinks
+    are called from several dispatch lanes at once. The sink is known
+    as sink:NAME in journals and metrics.
+    """
+    def __init__(self, name, options):
+        self.__name__ = SINK_PREFIX + name
+        self.options = options
+
+    def __call__(self, event):
+        self.deliver(event)
+
+    def deliver(self, event):
+        raise NotImplementedError()
+
+    def digest(self, digest):
+        for event in digest.events:
+            self.deliver(event)
+
+    def close(self):
+        pass
+
+    def require(self, option):
+        try:
+            return self.options[option]
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, self.__name__)
+
+    @staticmethod
+    def record(event):
+        return event_record(event, time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+class _ImportedSink(Sink):
+    """A sink of type module.Class, imported when it is first needed."""
+    def __init__(self, name, options):
+        Sink.__init__(self, name, options)
+        self._name = name
+        self._sink = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._sink is None:
+                self._sink = sink_class(self.options['type'])(self._name,
+                                                              self.options)
+        return self._sink
+
+    def __call__(self, event):
+        self._load()(event)
+
+    def deliver(self, event):
+        self._load().deliver(event)
+
+    def digest(self, digest):
+        self._load().digest(digest)
+
+    def close(self):
+        if self._sink is not None:
+            self._sink.close()
+
+
+class _DigestSink(object):
+    """The digest side of a Sink, under the same name for the journal."""
+    def __init__(self, sink):
+        self.sink = sink
+        self.__name__ = sink.__name__
+
+    def __call__(self, digest):
+        self.sink.digest(digest)
+
+
+class EmailSink(Sink):
+    """Mail every event routed here to a fixed address (email)."""
+    def deliver(self, event):
+        send_mail(str(event), event.dump(), self.require('email'),
+                  CONFIG.get('general', 'email_from'))
+
+    def digest(self, digest):
+        send_mail(str(digest), digest.dump(), self.require('email'),
+                  CONFIG.get('general', 'email_from'))
+
+
+class WebhookSink(Sink):
+    """POST each event to url as a JSON object.
+
+    A digest is sent as one JSON list of events.
+    """
+    def _post(self, document):
+        urllib2 = http_handler()
+        request = urllib2.Request(self.require('url'), json.dumps(document),
+                                  {'Content-Type': 'application/json'})
+        urllib2.urlopen(request,
+                        timeout=general_option('http_timeout', 30,
+                                               'getfloat')).read()
+
+    def deliver(self, event):
+        self._post(self.record(event))
+
+    def digest(self, digest):
+        self._post([self.record(event) for event in digest.events])
+
+
+class SocketSink(Sink):
+    """Write each event as a line of JSON to a stream socket.
+
+    The socket is a unix socket at path, or address as host:port. The
+    connection is kept open and re-established once if it has gone.
+    """
+    def __init__(self, name, options):
+        super(SocketSink, self).__init__(name, options)
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        timeout = general_option('http_timeout', 30, 'getfloat')
+        if 'path' in self.options:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(self.options['path'])
+            return sock
+        host, port = self.require('address').rsplit(':', 1)
+        return socket.create_connection((host, int(port)), timeout)
+
+    def _send(self, data):
+        with self._lock:
+            for attempt in (1, 2):
+                reused = self._sock is not None
+                if not reused:
+                    self._sock = self._connect()
+                try:
+                    self._sock.sendall(data)
+                    return
+                except socket.error:
+                    self.close()
+                    if not reused:
+                        raise
+
+    def deliver(self, event):
+        self._send(json.dumps(self.record(event)) + '\n')
+
+    def digest(self, digest):
+        self._send(''.join(json.dumps(self.record(event)) + '\n'
+                           for event in digest.events))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class ExecSink(Sink):
+    """Run command for each event, with the event as JSON on stdin.
+
+    The command also gets the main fields in ALARM_* environment
+    variables, and a non-zero exit status counts as a failure.
+    """
+    def deliver(self, event):
+        env = dict(os.environ,
+                   ALARM_ACCOUNT=str(event.account),
+                   ALARM_SYSTEM=str(event.system),
+                   ALARM_EVENT_CODE=str(event.event_code),
+                   ALARM_QUALIFIER=str(event.qualifier),
+                   ALARM_PARTITION=str(event.partition),
+                   ALARM_ZONE=str(event.zone_number),
+                   ALARM_TEXT=str(event))
+        import subprocess
+        proc = subprocess.Popen(self.require('command'), shell=True,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env)
+        output = proc.communicate(json.dumps(self.record(event)))[0]
+        if proc.returncode:
+            raise Exception('%s exited with status %i: %s' % (
+                self.require('command'), proc.returncode, output.strip()))
+
+
+SINK_TYPES = {
+    'email': EmailSink,
+    'webhook': WebhookSink,
+    'socket': SocketSink,
+    'exec': ExecSink,
+}
+
+
+def sink_class(type_name):
+    """Return the Sink subclass for a type, which may be module.Class."""
+    if type_name in SINK_TYPES:
+        return SINK_TYPES[type_name]
+    module, _, name = type_name.rpartition('.')
+    if not module:
+        raise ConfigError('Unknown sink type %r' % type_name)
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def load_sink_plugins(cfg, lazy=False):
+    """Build the sinks configured in cfg's [sink:NAME] sections.
+
+    Sections for the built in sinks (mail, log, state, history) only
+    carry routing. With lazy, a sink whose type is module.Class is not
+    imported until an event reaches it.
+    """
+    sinks = []
+    for section in cfg.sections():
+        if not section.startswith(SINK_PREFIX):
+            continue
+        name = section[len(SINK_PREFIX):]
+        if not name or name.split() != [name]:
+            raise ConfigError('Bad sink name [%s]' % section)
+        if name in _BUILTIN_SINKS:
+            continue
+        options = dict(cfg.items(section, True))
+        if 'type' not in options:
+            raise ConfigError('[%s] has no type' % section)
+        if lazy and options['type'] not in SINK_TYPES:
+            sinks.append(_ImportedSink(name, options))
+        else:
+            sinks.append(sink_class(options['type'])(name, options))
+    return sinks
+
+
+def sink_plugins():
+    sinks = getattr(CONFIG, '_alarm_sinks', None)
+    if sinks is None:
+        sinks = CONFIG._alarm_sinks = load_sink_plugins(CONFIG, lazy=True)
+    return sinks
+
+
+def _route_name(name):
+    return _BUILTIN_SINKS.get(name, SINK_PREFIX + name)
+
+
+def _parse_numbers(value, limit):
+    """Parse a list of numbers and ranges such as "100-199, 401"."""
+    numbers = set()
+    for part in value.replace(',', ' ').split():
+        low, _, high = part.partition('-')
+        low = int(low)
+        if high:
+            high = int(high)
+        else:
+            high = low
+        if not 0 <= low <= high < limit:
+            raise ValueError('Bad range %r' % part)
+        numbers.update(range(low, high + 1))
+    return frozenset(numbers)
+
+
+def _minute_of_day(value):
+    hour, _, minute = value.partition(':')
+    hour, minute = int(hour), int(minute or 0)
+    if not (0 <= hour <= 24 and 0 <= minute < 60 and
+            hour * 60 + minute <= 1440):
+        raise ValueError('Bad time of day %r' % value)
+    return hour * 60 + minute
+
+
+def _parse_hours(value):
+    """Parse times of day such as "22:00-06:30, 12-13" into a bitmask.
+
+    Bit n is set for the n'th minute of the day. Ranges may wrap past
+    midnight; the end of each range is not included.
+    """
+    mask = 0
+    for part in value.replace(',', ' ').split():
+        start, _, end = part.partition('-')
+        start, end = _minute_of_day(start), _minute_of_day(end)
+        if start < end:
+            mask |= (1 << end) - (1 << start)
+        else:
+            mask |= (1 << 1440) - (1 << start) | (1 << end) - 1
+    return mask
+
+
+class RouteRule(collections.namedtuple(
+        'RouteRule', 'events qualifiers zones partitions hours')):
+    """One routing condition; fields that are None match anything."""
+    __slots__ = ()
+
+    def matches(self, event, minute):
+        return ((self.qualifiers is None or
+                 event.qualifier in self.qualifiers) and
+                (self.zones is None or event.zone_number in self.zones) and
+                (self.partitions is None or
+                 event.partition in self.partitions) and
+                (self.hours is None or self.hours >> minute & 1))
+
+    @classmethod
+    def parse(cls, options):
+        """Build a rule from a dict of events, qualifiers, zones, ..."""
+        unknown = set(options) - set(cls._fields)
+        if unknown:
+            raise ValueError('Unknown routing condition(s) %s' %
+                             ', '.join(sorted(unknown)))
+        limits = {'events': 1000, 'qualifiers': 10, 'zones': 1000,
+                  'partitions': 100}
+        values = dict((field, None) for field in cls._fields)
+        for field, value in options.items():
+            if field == 'hours':
+                values[field] = _parse_hours(value)
+            else:
+                values[field] = _parse_numbers(value, limits[field])
+        return cls(**values)
+
+
+def parse_route(value):
+    """Parse a route_NAME option into a list of RouteRules.
+
+    Alternatives are separated by ";", each a list of conditions like
+    "events=100-199,401 zones=1-8 hours=22-6". "none" routes nothing.
+    """
+    if value.strip() == 'none':
+        return []
+    rules = []
+    for alternative in value.split(';'):
+        options = {}
+        for term in alternative.split():
+            field, sep, values = term.partition('=')
+            if not sep:
+                raise ValueError('Bad routing condition %r' % term)
+            options[field] = values
+        rules.append(RouteRule.parse(options))
+    return rules
+
+
+class SystemRoutes(object):
+    """The routing of one system: its rules indexed by event code.
+
+    conditional names the sinks that have rules for this system; the
+    rest get every event.
+    """
+    def __init__(self, rules):
+        self.conditional = frozenset(rules)
+        self.by_code = {}
+        self.timed = False
+        everything = RouteRule(None, None, None, None, None)
+        for name, alternatives in rules.items():
+            for rule in alternatives:
+                residual = rule._replace(events=None)
+                if residual == everything:
+                    residual = None
+                self.timed = self.timed or rule.hours is not None
+                codes = rule.events
+                if codes is None:
+                    codes = [None]
+                entry = (name, residual)
+                by_code = self.by_code
+                for code in codes:
+                    if code in by_code:
+                        by_code[code].append(entry)
+                    else:
+                        by_code[code] = [entry]
+
+    def match(self, event, minute, allowed):
+        """Add the conditional sinks that want event to allowed."""
+        for code in (event.event_code, None):
+            for name, rule in self.by_code.get(code, ()):
+                if name not in allowed and (rule is None or
+                                            rule.matches(event, minute)):
+                    allowed.add(name)
+
+
+class RouteTable(object):
+    """Which sinks each event goes to, compiled from the routing rules.
+
+    A [sink:NAME] section may hold conditions (events, qualifiers,
+    zones, partitions, hours) and a list of systems, which apply to
+    every system (or the listed ones); a route_NAME option in a system
+    section replaces them for that system. A sink with no rules for a
+    system gets all of its events. Each system's rules are compiled
+    the first time one of its events is routed, indexed by event code,
+    so matching costs a couple of lookups and the few rules for that
+    code, however many rules there are.
+    """
+    def __init__(self, defaults, cfg):
+        # sink name -> (systems it is limited to or None, RouteRule)
+        self.defaults = defaults
+        # Where the route_NAME options of each system are read from
+        self.cfg = cfg
+        self._compiled = {}
+        self._names = {}
+
+    @classmethod
+    def from_config(cls, cfg):
+        defaults = {}
+        for section in cfg.sections():
+            if section.startswith(SINK_PREFIX):
+                options = dict(cfg.items(section, True))
+                only = options.pop('systems', None)
+                conditions = dict((field, options[field])
+                                  for field in RouteRule._fields
+                                  if field in options)
+                if conditions or only is not None:
+                    try:
+                        rule = RouteRule.parse(conditions)
+                    except ValueError, e:
+                        raise ConfigError('[%s] %s' % (section, e))
+                    defaults[_route_name(section[len(SINK_PREFIX):])] = (
+                        only and set(only.replace(',', ' ').split()), rule)
+        return cls(defaults, cfg)
+
+    def compile(self, system):
+        """Return the SystemRoutes of system, or None if it has none."""
+        if system in self._compiled:
+            return self._compiled[system]
+        cfg = self.cfg
+        if not (is_system_section(system) and cfg.has_section(system)):
+            return None
+        rules = {}
+        for name, (only, rule) in self.defaults.items():
+            rules[name] = (not only or system in only) and [rule] or []
+        for option in cfg.options(system):
+            if not option.startswith('route_'):
+                continue
+            name = _route_name(option[6:])
+            value = cfg.get(system, option, True)
+            try:
+                rules[name] = parse_route(value)
+            except ValueError, e:
+                raise ConfigError('[%s] route for %s: %s' % (system, name,
+                                                             e))
+        routes = self._compiled[system] = rules and SystemRoutes(rules) or None
+        return routes
+
+    def compile_all(self):
+        for system in self.cfg.sections():
+            self.compile(system)
+
+    def _name(self, sink):
+        try:
+            return self._names[sink]
+        except KeyError:
+            name = self._names[sink] = _journal_name(sink)
+            return name
+
+    def select(self, event, sinks, now=None):
+        """Return those of sinks that event (or digest) should go to."""
+        routes = self.compile(event.system)
+        if routes is None:
+            return sinks
+        minute = 0
+        if routes.timed:
+            moment = time.localtime(now)
+            minute = moment.tm_hour * 60 + moment.tm_min
+        allowed = set()
+        for each in getattr(event, 'events', None) or [event]:
+            routes.match(each, minute, allowed)
+        conditional = routes.conditional
+        return [sink for sink in sinks
+                if self._name(sink) not in conditional or
+                self._name(sink) in allowed]
+
+
+def route_table():
+    table = getattr(CONFIG, '_alarm_routes', None)
+    if table is None:
+        table = CONFIG._alarm_routes = RouteTable.from_config(CONFIG)
+    return table
+
+
+# The event sink each digest sink delivers for, as far as the journal
+# is concerned
+_DIGEST_SINKS = {
+    'mail_digest': 'mail_event',
+    'log_digest': 'log_event',
+    'update_digest_state': 'update_state',
+    'store_digest': 'store_event',
+}
+
+
+def _journal_name(sink):
+    name = _sink_name(sink)
+    return _DIGEST_SINKS.get(name, name)
+
+
+_SYSTEM_FIELDS = collections.OrderedDict([
+    ('section', None),
+    ('name', 'name'),
+    ('email', 'email'),
+    ('nomail', 'nomail_events'),
+    ('type', 'type'),
+    ('post_url', 'post_url'),
+    ('post_batch', 'post_batch'),
+    ('zones', None),
+    ('users', None),
+    ('coalesce_window', 'coalesce_window'),
+    ('coalesce_bypass', 'coalesce_bypass'),
+    ('checkin_interval', 'checkin_interval'),
+    ('checkin_grace', 'checkin_grace'),
+])
+
+
+class SystemIndex(collections.namedtuple('SystemIndex', _SYSTEM_FIELDS)):
+    """The compiled, read-only view of one system's config section.
+
+    Fields for options that are not set are None; require() raises
+    the same NoOptionError that ConfigParser would have.
+    """
+    __slots__ = ()
+
+    def require(self, field):
+        value = getattr(self, field)
+        if value is None:
+            raise ConfigParser.NoOptionError(_SYSTEM_FIELDS[field],
+                                             self.section)
+        return value
+
+
+_NUMBERED_OPTION = re.compile(r'^(zone|user)_(\d+)$')
+
+
+def _compile_system(cfg, section):
+    values = {'section': section, 'zones': {}, 'users': {}}
+    for option in cfg.options(section):
+        try:
+            value = cfg.get(section, option)
+        except ConfigParser.InterpolationError:
+            value = cfg.get(section, option, True)
+        match = _NUMBERED_OPTION.match(option)
+        if match and '%s_%i' % (match.group(1),
+                                int(match.group(2))) == option:
+            values[match.group(1) + 's'][int(match.group(2))] = value
+        elif option == 'nomail_events':
+            values['nomail'] = frozenset(int(x) for x in value.split(','))
+        elif option == 'post_batch':
+            values['post_batch'] = cfg.getboolean(section, option)
+        elif option in ('coalesce_window', 'checkin_interval',
+                        'checkin_grace'):
+            values[option] = cfg.getfloat(section, option)
+        elif option == 'coalesce_bypass':
+            values['coalesce_bypass'] = frozenset(
+                int(x) for x in value.split(',') if x.strip())
+        elif option in _SYSTEM_FIELDS:
+            values[option] = value
+    values.setdefault('coalesce_bypass', frozenset([1]))
+    return SystemIndex(**dict((field, values.get(field))
+                              for field in _SYSTEM_FIELDS))
+
+
+def compile_config(cfg):
+    """Build the SystemIndex for every system section in cfg."""
+    return dict((section, _compile_system(cfg, section))
+                for section in cfg.sections() if is_system_section(section))
+
+
+def config_index():
+    """Return the compiled index for CONFIG, building it on first use.
+
+    The index is stored on the ConfigParser itself, so changes made to
+    CONFIG after the first lookup are not seen.
+    """
+    cfg = CONFIG
+    index = getattr(cfg, '_alarm_index', None)
+    if index is None:
+        index = cfg._alarm_index = compile_config(cfg)
+    return index
+
+
+def system_index(system):
+    try:
+        return config_index()[system]
+    except KeyError:
+        raise ConfigParser.NoSectionError(system)
+
+
+# Bump when the layout of the cached config changes
+CONFIG_CACHE_VERSION = 5
+
+# Each config read gets the next version number
+_CONFIG_VERSIONS = itertools.count(1)
+
+# What validate_config() checks that [general] options parse as
+_GENERAL_GETTERS = {
+    'dedup_entries': 'getint', 'dedup_window': 'getfloat',
+    'dispatch_queue': 'getint', 'dispatch_workers': 'getint',
+    'http_timeout': 'getfloat', 'log_compress': 'getboolean',
+    'log_flush_lines': 'getint', 'log_fsync': 'getboolean',
+    'log_json': 'getboolean', 'log_max_open': 'getint',
+    'log_rotate_size': 'getint', 'metrics': 'getboolean',
+    'metrics_port': 'getint', 'sink_timeout': 'getfloat',
+    'smtp_backoff': 'getfloat', 'smtp_port': 'getint',
+    'smtp_retries': 'getint', 'smtp_starttls': 'getboolean',
+    'smtp_timeout': 'getfloat', 'verify_checksum': 'getboolean',
+    'config_check': 'getfloat', 'state_retry_backoff': 'getfloat',
+    'state_retry_max': 'getfloat', 'panel_state': 'getboolean',
+    'dc09_port': 'getint', 'dc09_idle_timeout': 'getfloat',
+}
+
+_SECTION_HEADER = re.compile(r'^\[([^\]]+)\]', re.M)
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _include_dir(cfg):
+    if cfg.has_option('general', 'include_dir'):
+        return os.path.expanduser(cfg.get('general', 'include_dir'))
+    return None
+
+
+def _include_files(include_dir):
+    if not include_dir:
+        return []
+    return sorted(glob.glob(os.path.join(include_dir, '*.conf')))
+
+
+def _config_cache_path(filename):
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    return os.path.join(dirname, '.%s.cache' % basename)
+
+
+def _config_cache_key(filename, include_dir=None):
+    """Identify the current contents of filename and its includes."""
+    stamps = []
+    for path in [filename] + _include_files(include_dir):
+        st = os.stat(path)
+        stamps.append((path, st.st_mtime, st.st_size))
+    return (CONFIG_CACHE_VERSION, tuple(stamps))
+
+
+class _SnapshotSections(collections.OrderedDict):
+    """A ConfigParser's sections, each unpacked on first use.
+
+    A run only looks at the few systems its events come from, so
+    loading a config of thousands of them from the cache does not
+    unpack the rest.
+    """
+    def __getitem__(self, section):
+        options = collections.OrderedDict.__getitem__(self, section)
+        if isinstance(options, str):
+            options = collections.OrderedDict(marshal.loads(options))
+            collections.OrderedDict.__setitem__(self, section, options)
+        return options
+
+    def get(self, section, default=None):
+        if section in self:
+            return self[section]
+        return default
+
+
+class _SnapshotIndex(dict):
+    """The compiled index from the cache, unpacked system by system."""
+    def __getitem__(self, system):
+        value = dict.__getitem__(self, system)
+        if isinstance(value, str):
+            value = SystemIndex(*marshal.loads(value))
+            dict.__setitem__(self, system, value)
+        return value
+
+    def get(self, system, default=None):
+        if system in self:
+            return self[system]
+        return default
+
+    def items(self):
+        return [(system, self[system]) for system in self]
+
+    def values(self):
+        return [self[system] for system in self]
+
+
+def _pending_work(cfg):
+    """Where a run that finds nothing in the spool may still have work.
+
+    For alarm_eventcmd.py, which starts a run only if one of the 'dirs'
+    (directory, prefix) holds a file whose name starts with prefix, or
+    one of the 'due' files holds a time that has passed. None means it
+    should always start one.
+    """
+    if not cfg.has_option('general', 'spool_dir'):
+        return None
+
+    def option(name, default):
+        if cfg.has_option('general', name):
+            return cfg.get('general', name)
+        return default
+    spool = cfg.get('general', 'spool_dir')
+    state_dir = option('state_dir', spool)
+    return {'dirs': [(spool, 'event-'),
+                     (os.path.join(spool, PROCESSING_DIR), ''),
+                     (option('state_queue_dir', None) or
+                      os.path.join(state_dir, 'state-queue'), 'state-'),
+                     (option('outbox_dir', None) or
+                      os.path.join(state_dir, 'outbox'), 'mail-')],
+            'due': [os.path.join(state_dir, checkin_file()) + '.due']}
+
+
+def _load_cached_config(filename):
+    """Rebuild a config from the cache, or return None if it is unusable.
+
+    The cache holds a small header, which alarm_eventcmd.py reads on
+    its own, then the sections and the index, each packed separately
+    so that they are only unpacked when they are looked at.
+    """
+    try:
+        with open(_config_cache_path(filename), 'rb') as f:
+            header = pickle.load(f)
+            key = _config_cache_key(filename, header.get('include_dir'))
+            if header.get('key') != key:
+                return None
+            cached = pickle.load(f)
+        cfg = ConfigParser.ConfigParser(cached['defaults'])
+        cfg._sections = _SnapshotSections(cached['sections'])
+        cfg._alarm_index = _SnapshotIndex(cached['index'])
+        cfg._alarm_stamp = key
+    except Exception:
+        return None
+    return cfg
+
+
+def _save_cached_config(filename, cfg):
+    """Best effort: the config directory may well not be writable.
+
+    Returns whether the cache was written.
+    """
+    header = {'key': cfg._alarm_stamp,
+              'include_dir': _include_dir(cfg),
+              'pending': _pending_work(cfg)}
+    cached = {'defaults': cfg.defaults(),
+              'sections': [(section, marshal.dumps(options.items()))
+                           for section, options in cfg._sections.items()],
+              'index': [(section, marshal.dumps(tuple(system)))
+                        for section, system in cfg._alarm_index.items()]}
+    path = _config_cache_path(filename)
+    tmp = '%s.%i' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def read_config(filename, cached=True):
+    """Read filename, and the *.conf files in its include_dir, afresh.
+
+    Returns a new ConfigParser with its index built: a snapshot that
+    later edits to the files do not affect. Included files may only
+    add systems; one that redefines a section raises ConfigError.
+    Unless cached is False, the cache is used if it is up to date.
+    """
+    cfg = cached and _load_cached_config(filename) or None
+    if cfg is None:
+        cfg = ConfigParser.ConfigParser()
+        cfg.read(filename)
+        include_dir = _include_dir(cfg)
+        for path in _include_files(include_dir):
+            with open(path) as f:
+                clash = set(_SECTION_HEADER.findall(f.read())).intersection(
+                    cfg.sections())
+            if clash:
+                raise ConfigError('%s redefines %s' % (
+                    path, ', '.join('[%s]' % s for s in sorted(clash))))
+            cfg.read(path)
+        try:
+            cfg._alarm_index = compile_config(cfg)
+        except ValueError:
+            # Left for validate_config() to report, or config_index()
+            # to raise
+            pass
+        if os.path.exists(filename) and hasattr(cfg, '_alarm_index'):
+            cfg._alarm_stamp = _config_cache_key(filename, include_dir)
+            _save_cached_config(filename, cfg)
+    cfg._alarm_source = filename
+    cfg._alarm_version = next(_CONFIG_VERSIONS)
+    return cfg
+
+
+def load_config(filename):
+    global CONFIG
+    CONFIG = read_config(filename)
+
+
+def validate_config(cfg):
+    """Return a list of what is wrong with cfg that would stop delivery."""
+    if not cfg.has_section('general'):
+        return ['There is no [general] section']
+    problems = []
+    for option in ('spool_dir', 'email_from'):
+        if not cfg.has_option('general', option):
+            problems.append('[general] %s is not set' % option)
+    for option, getter in sorted(_GENERAL_GETTERS.items()):
+        if cfg.has_option('general', option):
+            try:
+                getattr(cfg, getter)('general', option)
+            except ValueError, e:
+                problems.append('[general] %s: %s' % (option, e))
+    try:
+        types = load_panel_types(
+            cfg.has_option('general', 'panel_dir') and
+            cfg.get('general', 'panel_dir') or None)
+    except Exception, e:
+        problems.append('Bad panel type: %s' % e)
+        types = BUILTIN_PANEL_TYPES
+    cfg._alarm_panels = types
+    try:
+        cfg._alarm_routes = RouteTable.from_config(cfg)
+        cfg._alarm_routes.compile_all()
+        cfg._alarm_sinks = load_sink_plugins(cfg)
+    except Exception, e:
+        problems.append('Bad sink or routing: %s' % e)
+    try:
+        cfg._alarm_templates = TemplateTable(cfg)
+        cfg._alarm_templates.compile_all()
+    except ConfigError, e:
+        problems.append('Bad template: %s' % e)
+    for section in cfg.sections():
+        if not is_system_section(section):
+            continue
+        try:
+            system = _compile_system(cfg, section)
+        except ValueError, e:
+            problems.append('[%s] %s' % (section, e))
+            continue
+        for field in ('name', 'email', 'nomail'):
+            if getattr(system, field) is None:
+                problems.append('[%s] %s is not set' % (
+                    section, _SYSTEM_FIELDS[field]))
+        if system.type is not None and system.type not in types:
+            problems.append('[%s] unknown panel type %r' % (section,
+                                                           system.type))
+    return problems
+
+
+class ConfigReloader(object):
+    """Notice that the config files have changed, and read them again.
+
+    The files are checked at most every interval seconds (never, if it
+    is 0). A new version is only returned once it has been validated,
+    and one that failed is not tried again until the files change
+    again.
+    """
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._next = time.time() + interval
+        self._rejected = None
+
+    def _stamp(self):
+        cfg = CONFIG
+        return _config_cache_key(cfg._alarm_source, _include_dir(cfg))
+
+    def changed(self, now=None):
+        if not self.interval or getattr(CONFIG, '_alarm_source',
+                                        None) is None:
+            return False
+        now = now or time.time()
+        if now < self._next:
+            return False
+        self._next = now + self.interval
+        try:
+            stamp = self._stamp()
+        except OSError:
+            # Probably in the middle of being replaced; look again later
+            return False
+        return stamp not in (getattr(CONFIG, '_alarm_stamp', None),
+                             self._rejected)
+
+    def load(self):
+        """Return the new config, or raise ConfigError."""
+        filename = CONFIG._alarm_source
+        try:
+            self._rejected = self._stamp()
+        except OSError:
+            self._rejected = None
+        cfg = read_config(filename)
+        problems = validate_config(cfg)
+        if problems:
+            raise ConfigError('%s:\n%s' % (filename, '\n'.join(problems)))
+        self._rejected = None
+        return cfg
+
+
+def swap_config(cfg):
+    """Make cfg the config. Nothing may be in flight on the old one.
+
+    Whatever the sinks kept open for the old config is closed; the
+    metrics carry on.
+    """
+    global CONFIG
+    close_sinks()
+    for attr in ('_alarm_metrics', '_alarm_shard'):
+        if hasattr(CONFIG, attr):
+            setattr(cfg, attr, getattr(CONFIG, attr))
+    CONFIG = cfg
+
+
+def reload_config(reloader):
+    """Try to load a new config; returns it, or None if it was bad."""
+    try:
+        cfg = reloader.load()
+    except Exception, e:
+        metrics().count('alarm_events_config_reloads_total',
+                        result='invalid')
+        print 'Not reloading config: %s' % e
+        safety_net('The changed config was not loaded, so version %s '
+                   'stays in use:\n%s' % (
+                       getattr(CONFIG, '_alarm_version', '?'), e))
+        return None
+    metrics().count('alarm_events_config_reloads_total', result='ok')
+    return cfg
+
+
+def general_option(option, default, getter='get'):
+    if not CONFIG.has_option('general', option):
+        return default
+    return getattr(CONFIG, getter)('general', option)
+
+
+def spool_settings():
+    spool = CONFIG.get('general', 'spool_dir')
+    if current_shard() is not None:
+        spool = shard_spool(spool, current_shard())
+    if CONFIG.has_option('general', 'system_format'):
+        system_format = CONFIG.get('general', 'system_format', True)
+    else:
+        system_format = None
+    return spool, system_format
+
+
+def state_path(name):
+    """Return the path of a file kept between runs in state_dir."""
+    state_dir = general_option('state_dir', None)
+    if state_dir is None:
+        state_dir = CONFIG.get('general', 'spool_dir')
+    return os.path.join(state_dir, name)
+
+
+def _write_atomic(path, data):
+    tmp = '%s.%i.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def spool_files(spool):
+    """Return the pending spool files, oldest first."""
+    def _mtime(filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return 0
+    return sorted(glob.glob(os.path.join(spool, 'event-*')), key=_mtime)
+
+
+def set_aside(filename, reason, dirname=None):
+    """Move a spool file out of the way without losing it."""
+    basename = os.path.basename(filename)
+    if dirname is None:
+        dirname = os.path.dirname(filename)
+    target = os.path.join(dirname, '%s-%s' % (reason, basename))
+    os.rename(filename, target)
+    return target
+
+
+# Spool files are claimed by moving them into a per-process directory
+# under this one
+PROCESSING_DIR = 'processing'
+
+
+class SpoolClaims(object):
+    """This process's claims on the files of one spool directory.
+
+    A file is claimed by renaming it into processing/<pid>. Only one
+    of any number of concurrent runs can succeed in renaming a given
+    file, so they partition the spool between them. The process holds
+    an flock on processing/<pid>/.lock while it runs; the kernel drops
+    it if the process dies, which is how recover() tells claims that
+    were abandoned from claims that are still being worked on.
+    """
+    LOCK = '.lock'
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.processing = os.path.join(spool, PROCESSING_DIR)
+        self.owner = None
+        self._pid = None
+        self._lock_file = None
+        self._mutex = threading.Lock()
+
+    def _open(self):
+        # Build the owner directory under a hidden name and lock it
+        # before it becomes visible, so recover() never sees it unlocked
+        for path in (self.spool, self.processing):
+            try:
+                os.mkdir(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        owner = os.path.join(self.processing, str(os.getpid()))
+        building = os.path.join(self.processing, '.new-%i' % os.getpid())
+        if not os.path.isdir(building):
+            os.mkdir(building)
+        self._lock_file = open(os.path.join(building, self.LOCK), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        if os.path.isdir(owner):
+            # Left by an earlier process with our pid
+            self._recover_owner(owner, self._recover_lock(owner))
+        os.rename(building, owner)
+        self.owner = owner
+        self._pid = os.getpid()
+
+    def claim(self, filename):
+        """Rename filename into our directory; None if it has gone."""
+        with self._mutex:
+            # A forked child needs claims (and a lock) of its own
+            if self.owner is None or self._pid != os.getpid():
+                self._open()
+        claimed = os.path.join(self.owner, os.path.basename(filename))
+        try:
+            os.rename(filename, claimed)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return claimed
+
+    def close(self):
+        """Put back anything still claimed and drop the lock."""
+        with self._mutex:
+            if self.owner is None or self._pid != os.getpid():
+                return
+            for name in os.listdir(self.owner):
+                if name != self.LOCK:
+                    release_spool_file(os.path.join(self.owner, name))
+            os.remove(os.path.join(self.owner, self.LOCK))
+            os.rmdir(self.owner)
+            self._lock_file.close()
+            self.owner = self._lock_file = None
+
+    @classmethod
+    def _recover_lock(cls, owner):
+        """Return the lock of a dead owner directory, or None."""
+        try:
+            lock_file = open(os.path.join(owner, cls.LOCK), 'r+')
+        except IOError:
+            return None
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @classmethod
+    def _recover_owner(cls, owner, lock_file):
+        released = 0
+        if lock_file is None:
+            return released
+        try:
+            for name in os.listdir(owner):
+                if name != cls.LOCK:
+                    release_spool_file(os.path.join(owner, name))
+                    released += 1
+            os.remove(os.path.join(owner, cls.LOCK))
+            os.rmdir(owner)
+        except OSError:
+            # Another run recovered it first
+            pass
+        finally:
+            lock_file.close()
+        return released
+
+    @classmethod
+    def recover(cls, spool):
+        """Release files left claimed by runs that died part way through.
+
+        Their journals stay, so they are only replayed to the sinks
+        that had not finished with them. Returns the number released.
+        """
+        processing = os.path.join(spool, PROCESSING_DIR)
+        try:
+            names = os.listdir(processing)
+        except OSError:
+            return 0
+        released = 0
+        for name in names:
+            if name.isdigit():
+                owner = os.path.join(processing, name)
+                released += cls._recover_owner(owner,
+                                               cls._recover_lock(owner))
+        return released
+
+
+def spool_claims(spool):
+    claims = _SPOOL_CLAIMS.get(spool)
+    if claims is None:
+        claims = _SPOOL_CLAIMS.setdefault(spool, SpoolClaims(spool))
+    return claims
+
+
+_SPOOL_CLAIMS = {}
+
+
+def close_claims():
+    """Give up this process's claims in every spool directory."""
+    for claims in _SPOOL_CLAIMS.values():
+        claims.close()
+
+
+def _spool_dir(claimed):
+    return os.path.dirname(os.path.dirname(os.path.dirname(claimed)))
+
+
+def unclaimed_path(claimed):
+    """Return where a claimed spool file came from."""
+    return os.path.join(_spool_dir(claimed), os.path.basename(claimed))
+
+
+def claim_spool_file(filename):
+    """Take filename for this process; None if another run got it first."""
+    return spool_claims(os.path.dirname(filename)).claim(filename)
+
+
+def release_spool_file(claimed):
+    """Put a claimed file back in the spool for a later run."""
+    target = unclaimed_path(claimed)
+    os.rename(claimed, target)
+    return target
+
+
+def quarantine_spool_file(claimed):
+    """Move a claimed file that cannot be processed out of the spool."""
+    SpoolJournal.discard(claimed)
+    return set_aside(claimed, 'quarantined', _spool_dir(claimed))
+
+
+def recover_spool(spool):
+    """Release abandoned claims and drop journals nothing refers to.
+
+    A journal is only dropped once it has been left untouched for an
+    hour, so that one whose file is in the middle of being claimed
+    (and so briefly in neither place) is not lost.
+    """
+    released = SpoolClaims.recover(spool)
+    processing = os.path.join(spool, PROCESSING_DIR)
+    try:
+        names = os.listdir(processing)
+    except OSError:
+        return released
+    owners = [os.path.join(processing, name) for name in names
+              if name.isdigit()]
+    for name in names:
+        if not name.endswith(SpoolJournal.SUFFIX):
+            continue
+        path = os.path.join(processing, name)
+        basename = name[:-len(SpoolJournal.SUFFIX)]
+        try:
+            if time.time() - os.stat(path).st_mtime < 3600:
+                continue
+        except OSError:
+            continue
+        if not any(os.path.exists(os.path.join(where, basename))
+                   for where in [spool] + owners):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return released
+
+
+class SpoolJournal(object):
+    """Record which sinks have finished with each event of a claimed file.
+
+    A file that comes back, because a sink failed or the run died, is
+    replayed only to the sinks that had not finished with each of its
+    events. The journal is created when the file is first claimed, so
+    a replay is recognisable even if nothing had finished.
+    """
+    SUFFIX = '.journal'
+
+    def __init__(self, path):
+        self.path = path
+        self.replay = os.path.exists(path)
+        self.done = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        if self.replay:
+            with open(path) as f:
+                for line in f:
+                    index, _, name = line.rstrip('\n').partition(' ')
+                    if index.isdigit() and name:
+                        self.done[int(index)].add(name)
+        else:
+            open(path, 'a').close()
+
+    @classmethod
+    def path_for(cls, claimed):
+        # Kept beside the owner directories, so that whichever run
+        # claims the file next finds it
+        return os.path.join(os.path.dirname(os.path.dirname(claimed)),
+                            os.path.basename(claimed) + cls.SUFFIX)
+
+    @classmethod
+    def for_file(cls, claimed):
+        return cls(cls.path_for(claimed))
+
+    @classmethod
+    def discard(cls, claimed):
+        try:
+            os.remove(cls.path_for(claimed))
+        except OSError:
+            pass
+
+    def started(self, index):
+        """Return True if some sink has already finished with event index."""
+        return index in self.done
+
+    def pending(self, index, sinks):
+        done = self.done.get(index, ())
+        return [sink for sink in sinks if _journal_name(sink) not in done]
+
+    def record(self, index, sink):
+        name = _journal_name(sink)
+        with self._lock:
+            self.done[index].add(name)
+            # One small O_APPEND write, so a crash cannot tear the line
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, '%i %s\n' % (index, name))
+            finally:
+                os.close(fd)
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _metric_key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (k, labels[k])
+                                      for k in sorted(labels)))
+
+
+class NullMetrics(object):
+    """Stands in for Metrics when they are off; every call is a no-op."""
+    enabled = False
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def count(self, name, n=1, **labels):
+        pass
+
+    def gauge(self, name, value, **labels):
+        pass
+
+    def save(self):
+        pass
+
+    def report(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics(object):
+    """Latency histograms, counters and gauges for the event pipeline.
+
+    Numbers are collected in memory. save() merges them into the
+    cumulative totals kept in state_dir (under a lock, as concurrent
+    runs share them) and writes those out in the Prometheus text
+    format if path is set. report() summarizes this process's own
+    numbers to stderr.
+    """
+    enabled = True
+
+    def __init__(self, path=None, state=None):
+        self.path = path
+        self.state = state
+        self.run = self._empty()
+        self.totals = self._empty()
+        self._saved = self._empty()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(path=general_option('metrics_file', None),
+                   state=state_path('metrics.json'))
+
+    @staticmethod
+    def _empty():
+        return {'histograms': {}, 'counters': {}, 'gauges': {}}
+
+    def observe(self, name, seconds, **labels):
+        key = _metric_key(name, labels)
+        bucket = bisect.bisect_left(METRIC_BUCKETS, seconds)
+        with self._lock:
+            hist = self.run['histograms'].get(key)
+            if hist is None:
+                hist = self.run['histograms'][key] = [
+                    [0] * (len(METRIC_BUCKETS) + 1), 0.0]
+            hist[0][bucket] += 1
+            hist[1] += seconds
+
+    def count(self, name, n=1, **labels):
+        key = _metric_key(name, labels)
+        counters = self.run['counters']
+        with self._lock:
+            counters[key] = counters.get(key, 0) + n
+
+    def gauge(self, name, value, **labels):
+        key = _metric_key(name, labels)
+        with self._lock:
+            self.run['gauges'][key] = value
+
+    @staticmethod
+    def _merge(into, data, sign=1):
+        for key, (buckets, total) in data['histograms'].items():
+            hist = into['histograms'].setdefault(
+                key, [[0] * len(buckets), 0.0])
+            hist[0] = [a + sign * b for a, b in zip(hist[0], buckets)]
+            hist[1] += sign * total
+        for key, value in data['counters'].items():
+            into['counters'][key] = into['counters'].get(key, 0) + (
+                sign * value)
+        if sign > 0:
+            into['gauges'].update(data['gauges'])
+
+    def _unsaved(self):
+        """Return what was collected since the last save."""
+        delta = self._empty()
+        with self._lock:
+            self._merge(delta, self.run)
+        self._merge(delta, self._saved, -1)
+        return delta
+
+    def save(self):
+        """Fold what was collected since the last save into the totals."""
+        delta = self._unsaved()
+        self._merge(self._saved, delta)
+        if not self.state:
+            self._merge(self.totals, delta)
+        else:
+            with open(self.state + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.state) as f:
+                        self.totals = json.load(f)
+                except (IOError, ValueError):
+                    self.totals = self._empty()
+                self._merge(self.totals, delta)
+                _write_atomic(self.state, json.dumps(self.totals))
+        if self.path:
+            _write_atomic(self.path, self.render())
+
+    def render(self):
+        """Return the totals, and anything not yet saved, as Prometheus text."""
+        data = self._empty()
+        self._merge(data, self.totals)
+        self._merge(data, self._unsaved())
+        lines = []
+        typed = set()
+
+        def series(key, kind):
+            name, _, labels = key.rstrip('}').partition('{')
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            return name, labels
+
+        for key in sorted(data['histograms']):
+            name, labels = series(key, 'histogram')
+            buckets, total = data['histograms'][key]
+            sep = labels and ',' or ''
+            running = 0
+            for bound, n in zip(METRIC_BUCKETS + ('+Inf',), buckets):
+                running += n
+                lines.append('%s_bucket{%s%sle="%s"} %i' % (
+                    name, labels, sep, bound, running))
+            labels = labels and '{%s}' % labels
+            lines.append('%s_sum%s %f' % (name, labels, total))
+            lines.append('%s_count%s %i' % (name, labels, running))
+        for kind, values in (('counter', data['counters']),
+                             ('gauge', data['gauges'])):
+            for key in sorted(values):
+                series(key, kind)
+                lines.append('%s %s' % (key, values[key]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _quantile(buckets, q):
+        target = q * sum(buckets)
+        running = 0
+        for bound, n in zip(METRIC_BUCKETS, buckets):
+            running += n
+            if running >= target:
+                return '<=%gms' % (bound * 1000)
+        return '>%gs' % METRIC_BUCKETS[-1]
+
+    def summary(self):
+        lines = []
+        with self._lock:
+            for key, (buckets, total) in sorted(
+                    self.run['histograms'].items()):
+                n = sum(buckets)
+                lines.append('%s n=%i mean=%.1fms p50%s p99%s' % (
+                    key, n, total * 1000 / n, self._quantile(buckets, 0.5),
+                    self._quantile(buckets, 0.99)))
+            for kind in ('counters', 'gauges'):
+                for key, value in sorted(self.run[kind].items()):
+                    lines.append('%s %s' % (key, value))
+        return lines
+
+    def report(self):
+        for line in self.summary():
+            sys.stderr.write('alarm_events: %s\n' % line)
+
+
+def metrics():
+    """Return the Metrics of this run, or NULL_METRICS if they are off."""
+    collected = getattr(CONFIG, '_alarm_metrics', None)
+    if collected is None:
+        enabled = (general_option('metrics', False, 'getboolean') or
+                   CONFIG.has_option('general', 'metrics_file') or
+                   CONFIG.has_option('general', 'metrics_port'))
+        collected = enabled and Metrics.from_config() or NULL_METRICS
+        CONFIG._alarm_metrics = collected
+    return collected
+
+
+class MetricsServer(object):
+    """Serve the metrics over HTTP (for --daemon), on a thread."""
+    def __init__(self, collected, port, address='127.0.0.1'):
+        import BaseHTTPServer
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = collected.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='metrics-server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class EventScreen(object):
+    """Drop corrupt and retransmitted events before any sink sees them.
+
+    Events whose checksum does not verify are rejected. An event whose
+    account, raw code and calling extension match one accepted within
+    the last window seconds is a retransmission (the panel missed our
+    kissoff) and is suppressed. The most recent max_entries keys, and
+    running totals of what was dropped, are kept in a small JSON file
+    so that separately forked runs share them; save() merges with what
+    other runs have saved in the meantime, under a lock.
+    """
+    ACCEPTED = 'accepted'
+    REJECTED = 'rejected'
+    SUPPRESSED = 'suppressed'
+
+    def __init__(self, verify_checksum=True, window=0, max_entries=1024,
+                 path=None):
+        self.verify_checksum = verify_checksum
+        self.window = window
+        self.max_entries = max_entries
+        self.path = path
+        self.seen = collections.OrderedDict()
+        self.counts = dict.fromkeys([self.ACCEPTED, self.REJECTED,
+                                     self.SUPPRESSED], 0)
+        self.totals = dict(self.counts)
+        # What of counts is already in the stored totals
+        self._saved = dict(self.counts)
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    @classmethod
+    def from_config(cls):
+        window = general_option('dedup_window', 0, 'getfloat')
+        # Under --workers each shard sees only its own accounts, so each
+        # keeps its own state
+        name = 'dedup.json'
+        if current_shard() is not None:
+            name = 'dedup-%i.json' % current_shard()
+        return cls(
+            verify_checksum=general_option('verify_checksum', True,
+                                           'getboolean'),
+            window=window,
+            max_entries=general_option('dedup_entries', 1024, 'getint'),
+            path=window and state_path(name) or None)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _load(self):
+        stored = self._read()
+        for key, stamp in stored.get('seen', []):
+            self.seen[key] = stamp
+        self.totals.update(stored.get('totals', {}))
+
+    def save(self):
+        """Merge what this run has seen and counted into the stored state.
+
+        Of a key seen by several runs, the newest time is kept; the
+        counts since the last save are added to the stored totals.
+        """
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stored = self._read()
+                seen = dict(stored.get('seen', []))
+                for key, stamp in self.seen.iteritems():
+                    if stamp > seen.get(key, stamp - 1):
+                        seen[key] = stamp
+                newest = sorted(seen.items(), key=lambda item: item[1])
+                self.seen = collections.OrderedDict(
+                    newest[-self.max_entries:])
+                totals = dict.fromkeys(self.counts, 0)
+                totals.update(stored.get('totals', {}))
+                for verdict, count in self.counts.items():
+                    totals[verdict] += count - self._saved[verdict]
+                self.totals = totals
+                self._saved = dict(self.counts)
+                _write_atomic(self.path, json.dumps(
+                    {'seen': self.seen.items(), 'totals': self.totals}))
+                self._dirty = False
+
+    def _count(self, verdict):
+        self.counts[verdict] += 1
+        self.totals[verdict] += 1
+        self._dirty = True
+        return verdict
+
+    def check(self, event, now=None, replay=False):
+        """Return ACCEPTED, REJECTED or SUPPRESSED for event.
+
+        An event replayed from a file that an earlier run claimed is
+        never taken for a retransmission of itself.
+        """
+        with self._lock:
+            if self.verify_checksum and not checksum_ok(event.raw_event):
+                return self._count(self.REJECTED)
+            if not self.window:
+                return self._count(self.ACCEPTED)
+
+            if now is None:
+                now = time.time()
+            key = '%s|%s|%s' % (event.account, event.raw_event,
+                                getattr(event, 'from_ext', '?'))
+            stamp = self.seen.get(key)
+            if (stamp is not None and now - stamp < self.window and
+                    not replay):
+                return self._count(self.SUPPRESSED)
+            self.seen.pop(key, None)
+            self.seen[key] = now
+            while len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+            return self._count(self.ACCEPTED)
+
+    def summary(self, sinks=3):
+        dropped = self.counts[self.REJECTED] + self.counts[self.SUPPRESSED]
+        if not dropped:
+            return None
+        return ('%i event(s): %i rejected (bad checksum), %i duplicate(s) '
+                'suppressed, %i sink call(s) saved; since the store was '
+                'created: %i rejected, %i suppressed of %i' % (
+                    sum(self.counts.values()), self.counts[self.REJECTED],
+                    self.counts[self.SUPPRESSED], dropped * sinks,
+                    self.totals[self.REJECTED],
+                    self.totals[self.SUPPRESSED],
+                    sum(self.totals.values())))
+
+    def report(self, sinks=3):
+        summary = self.summary(sinks)
+        if summary:
+            sys.stderr.write('alarm_events: %s\n' % summary)
+
+
+class CheckInMonitor(object):
+    """Notice systems that stop reporting, from missed periodic tests.
+
+    A system with checkin_interval set is expected to send something
+    (its periodic test, if nothing else) at least that often. Once it
+    has been silent for checkin_interval plus checkin_grace seconds,
+    check() makes up a 354 (Fail to communicate) event for it, to be
+    delivered like any other; the next event the system does send
+    comes with a restore of the 354. Systems are watched from their
+    first event on. Deadlines are kept in a heap, so that however many
+    systems there are, checking costs nothing until one is due.
+
+    Separately forked runs share what they know through files changed
+    under a lock: a JSON snapshot of every system, a log of sightings
+    since, and a ".due" file with the next deadline and the systems
+    that have missed theirs. A run that has not needed the snapshot
+    only appends to the log and reads the ".due" file, so its cost
+    does not grow with the number of systems; alarm_eventcmd.py reads
+    the deadline too.
+    """
+    MISSED = 1
+    RESTORED = 3
+
+    def __init__(self, path=None):
+        self.path = path
+        # system -> [last seen, missed?, what Event.system is made of,
+        #            deadline]
+        self._systems = {}
+        self._heap = []
+        self._dirty = False
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(state_path(checkin_file(current_shard())))
+
+    @staticmethod
+    def _origin(event):
+        return [event.account, event.partition, event.from_ext,
+                event.from_caller, event.system_format]
+
+    @staticmethod
+    def _watched(system):
+        index = config_index().get(system)
+        return index is not None and index.checkin_interval is not None
+
+    def _deadline(self, system, seen):
+        """When system is overdue, if it was last seen at seen."""
+        if not self._watched(system):
+            return None
+        index = config_index()[system]
+        grace = index.checkin_grace
+        if grace is None:
+            grace = index.checkin_interval / 10
+        return seen + index.checkin_interval + grace
+
+    def _push(self, system, deadline):
+        heapq.heappush(self._heap, (deadline, system))
+        if len(self._heap) > 2 * len(self._systems) + 64:
+            # Drop the entries left behind by later sightings
+            self._heap = [entry for entry in self._heap
+                          if not self._stale(entry)]
+            heapq.heapify(self._heap)
+
+    def _stale(self, entry):
+        deadline, system = entry
+        record = self._systems.get(system)
+        return record is None or record[1] or deadline != record[3]
+
+    def _locked(self, update, merge=True):
+        """Call update() holding the thread lock and, if stored, the file's.
+
+        Unless merge is False, what other processes have stored is
+        merged in first, and what update() changed is stored afterwards.
+        """
+        with self._lock:
+            if not self.path:
+                return update()
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not merge:
+                    return update()
+                self._merge()
+                result = update()
+                if self._dirty:
+                    self._store()
+                return result
+
+    def _update(self, system, record, missed):
+        current = self._systems.get(system)
+        if current is None or record[0] > current[0]:
+            record[1] = missed
+            self._systems[system] = record
+            self._push(system, record[3])
+        elif record[0] == current[0] and missed and not current[1]:
+            current[1] = True
+
+    def _merge(self):
+        self._loaded = True
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            stored = {}
+        for system, record in stored.get('systems', {}).iteritems():
+            self._update(system.encode('utf-8'), record, record[1])
+        try:
+            with open(self.path + '.log') as f:
+                for line in f:
+                    try:
+                        system, seen, origin, deadline = json.loads(line)
+                    except ValueError:
+                        # Cut short by a crash
+                        continue
+                    self._update(system.encode('utf-8'),
+                                 [seen, False, origin, deadline], False)
+        except IOError:
+            pass
+
+    def _read_due(self):
+        """Return the stored next deadline and the systems that missed."""
+        try:
+            with open(self.path + '.due') as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return None, set()
+        due = lines[0] and float(lines[0]) or None
+        return due, set(line for line in lines[1:] if line)
+
+    def _write_due(self, due, missed):
+        _write_atomic(self.path + '.due', '\n'.join(
+            [due is not None and repr(due) or ''] + sorted(missed)))
+
+    def _store(self):
+        _write_atomic(self.path, json.dumps({'systems': self._systems}))
+        self._write_due(self.next_due(), [
+            system for system, record in self._systems.iteritems()
+            if record[1]])
+        # Everything logged is in the snapshot now
+        try:
+            os.unlink(self.path + '.log')
+        except OSError:
+            pass
+        self._dirty = False
+
+    def _load(self):
+        if self._loaded or not self.path:
+            return
+        if (os.path.exists(self.path) or
+                os.path.exists(self.path + '.log')):
+            self._locked(lambda: None)
+        self._loaded = True
+
+    def _log(self, system, record):
+        """Note a sighting without loading the snapshot; True if missed."""
+        def update():
+            due, missed = self._read_due()
+            with open(self.path + '.log', 'a') as f:
+                f.write(json.dumps([system, record[0], record[2],
+                                    record[3]]) + '\n')
+            was_missed = system in missed
+            if was_missed or due is None or record[3] < due:
+                missed.discard(system)
+                self._write_due(due is None and record[3] or
+                                min(due, record[3]), missed)
+            return was_missed
+        return self._locked(update, merge=False)
+
+    def _event(self, system, qualifier, seen, origin):
+        """Make up a 354 event for system, as if it had sent it."""
+        account, partition, from_ext, from_caller, system_format = [
+            isinstance(value, unicode) and value.encode('utf-8') or value
+            for value in origin]
+        code = '%04i18%i354%02i000' % (account, qualifier, partition)
+        event = parse_event_code(code + checksum_digit(code))
+        event.from_ext = from_ext
+        event.from_caller = from_caller
+        event.from_name = 'check-in monitor'
+        event.system_format = system_format
+        event.metadata = {'LASTSEEN': time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(seen))}
+        return event
+
+    def seen(self, event, now=None):
+        """Note that event arrived; return the restores it brings."""
+        system = event.system
+        if not self._watched(system):
+            return []
+        if now is None:
+            now = time.time()
+        deadline = self._deadline(system, now)
+        record = [now, False, self._origin(event), deadline]
+        if self.path and not self._loaded:
+            missed = self._log(system, record)
+        else:
+            with self._lock:
+                current = self._systems.get(system)
+                missed = current is not None and current[1]
+                self._systems[system] = record
+                self._dirty = True
+                self._push(system, deadline)
+        if not missed:
+            return []
+        metrics().count('alarm_events_checkins_total', result='restored')
+        return [self._event(system, self.RESTORED, now, record[2])]
+
+    def stored_due(self):
+        """Return when the next system is overdue, by what is stored.
+
+        This may be earlier than next_due(), never later, and does not
+        need the snapshot.
+        """
+        if self._loaded or not self.path:
+            return self.next_due()
+        return self._read_due()[0]
+
+    def next_due(self):
+        """Return when the next system is overdue, or None."""
+        self._load()
+        while self._heap and self._stale(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def check(self, now=None):
+        """Return a 354 event for each system that has become overdue."""
+        if now is None:
+            now = time.time()
+        due = self.stored_due()
+        if due is None or due > now:
+            return []
+
+        def update():
+            overdue = []
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if self._stale(entry):
+                    continue
+                system = entry[1]
+                record = self._systems[system]
+                self._dirty = True
+                # The config may have changed since it was last seen
+                deadline = self._deadline(system, record[0])
+                if deadline is None:
+                    del self._systems[system]
+                elif deadline > now:
+                    record[3] = deadline
+                    self._push(system, deadline)
+                else:
+                    record[1] = True
+                    overdue.append(system)
+            if self.path and self._read_due()[0] != self.next_due():
+                # Only later sightings were due; store the real deadline
+                self._dirty = True
+            return overdue
+        events = []
+        for system in self._locked(update):
+            seen, _, origin, _ = self._systems[system]
+            events.append(self._event(system, self.MISSED, seen, origin))
+        if events:
+            metrics().count('alarm_events_checkins_total', len(events),
+                            result='missed')
+        return events
+
+    def save(self):
+        if self._dirty:
+            self._locked(lambda: None)
+
+    def replace(self, systems):
+        """Store systems (as records) in place of whatever is stored."""
+        def update():
+            self._systems = systems
+            self._heap = []
+            for system, record in systems.iteritems():
+                if not record[1]:
+                    self._push(system, record[3])
+            self._loaded = True
+            self._store()
+        self._locked(update, merge=False)
+
+
+def checkin_file(shard=None):
+    # Under --workers each shard watches its own accounts
+    if shard is None:
+        return 'checkins.json'
+    return 'checkins-%i.json' % shard
+
+
+_CHECKIN_FILE = re.compile(r'^checkins(-\d+)?\.json$')
+
+
+def _checkin_files():
+    """Return the check-in files there are, for any shard or none."""
+    state_dir = os.path.dirname(state_path(checkin_file()))
+    try:
+        names = os.listdir(state_dir or '.')
+    except OSError:
+        return []
+    return [os.path.join(state_dir, name) for name in sorted(names)
+            if _CHECKIN_FILE.match(name)]
+
+
+def _checkin_layout():
+    """Return the layout the check-in files were last split for."""
+    try:
+        with open(state_path('checkins.layout')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        pass
+    # Shard files from before the layout was recorded
+    if [path for path in _checkin_files()
+            if path != state_path(checkin_file())]:
+        return 'unknown'
+    return None
+
+
+def rebalance_checkins(router=None):
+    """Split what the check-in monitor knows between the shards' files.
+
+    Each shard watches its own systems in checkin_file(shard), and an
+    unsharded run (router None) all of them in checkin_file(). When
+    the number of workers or shard_by changes, every system is moved
+    to the file of the shard its events now go to, so that its new
+    shard neither raises a false missed check-in nor misses the
+    restore of one. Nothing is read but the recorded layout unless it
+    has changed.
+    """
+    layout = router and [router.workers, router.by_system] or None
+    if _checkin_layout() == layout:
+        return
+    marker = state_path('checkins.layout')
+    dirname = os.path.dirname(marker)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(marker + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _checkin_layout() == layout:
+            return
+        merged = CheckInMonitor()
+        paths = _checkin_files()
+        for path in paths:
+            monitor = CheckInMonitor(path)
+            monitor._load()
+            for system, record in monitor._systems.iteritems():
+                merged._update(system, record, record[1])
+        shards = {}
+        for system, record in merged._systems.iteritems():
+            index = None
+            if router:
+                index = router.shard(router.by_system and system or
+                                     str(record[2][0]))
+            shards.setdefault(index, {})[system] = record
+        wanted = set()
+        for index in router and range(router.workers) or [None]:
+            path = state_path(checkin_file(index))
+            CheckInMonitor(path).replace(shards.get(index, {}))
+            wanted.add(path)
+        for path in paths:
+            if path not in wanted:
+                for suffix in ('', '.log', '.due', '.lock'):
+                    try:
+                        os.unlink(path + suffix)
+                    except OSError:
+                        pass
+        _write_atomic(marker, json.dumps(layout))
+
+
+def checkin_monitor():
+    monitor = getattr(CONFIG, '_alarm_checkins', None)
+    if monitor is None:
+        monitor = CONFIG._alarm_checkins = CheckInMonitor.from_config()
+    return monitor
+
+
+def _report_failures(event):
+    """Return a done callback that tells the safety net if event failed."""
+    def done(errors):
+        if errors:
+            safety_net('Failed to deliver event %s:\n%s' % (
+                event.raw_event, '\n'.join(errors)))
+    return done
+
+
+def raise_missed_checkins(dispatcher, now=None, done=None):
+    """Deliver a 354 for each system that has missed its check-in.
+
+    done, if given, is called as done(event) and should return the
+    callback for that event's delivery. Returns how many were raised.
+    """
+    events = checkin_monitor().check(now)
+    for event in events:
+        print 'Missed check-in: %s (last seen %s)' % (
+            event.system, event.metadata['LASTSEEN'])
+        dispatcher.submit(event, done and done(event))
+    return len(events)
+
+
+def default_sinks():
+    return ([mail_event, log_event, update_state, store_event] +
+            sink_plugins())
+
+
+def _sink_name(sink):
+    return getattr(sink, '__name__', repr(sink))
+
+
+class DispatchError(Exception):
+    pass
+
+
+class Dispatcher(object):
+    """Deliver events to their sinks on a bounded pool of lanes.
+
+    Every account hashes to a single lane, so one account's events are
+    delivered in the order they were submitted while other accounts
+    proceed in parallel. Lane queues are bounded and submit() blocks
+    when one is full. Within a lane, an event's sinks run concurrently
+    and each gets sink_timeout seconds. A sink that overruns is counted
+    as failed and abandoned, but keeps holding its slot until it really
+    finishes, so hung sinks cannot pile up threads without bound. Until
+    then, later events in its lane wait for it before going to that
+    sink (their own sink_timeout still runs), so a slow sink cannot
+    finish an account's events out of order.
+    """
+    def __init__(self, sinks, workers=4, queue_size=16, sink_timeout=60,
+                 metrics=NULL_METRICS):
+        self.sinks = sinks
+        self.sink_timeout = sink_timeout
+        self.metrics = metrics
+        self.failures = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(2 * workers * max(1, len(sinks)))
+        self._lanes = []
+        for i in range(workers):
+            queue = Queue.Queue(queue_size)
+            thread = threading.Thread(target=self._run_lane, args=(queue,),
+                                      name='dispatch-lane-%i' % i)
+            thread.daemon = True
+            thread.start()
+            self._lanes.append((queue, thread))
+
+    @classmethod
+    def from_config(cls, sinks=None):
+        if sinks is None:
+            sinks = default_sinks()
+        return cls(sinks,
+                   workers=general_option('dispatch_workers', 4, 'getint'),
+                   queue_size=general_option('dispatch_queue', 16, 'getint'),
+                   sink_timeout=general_option('sink_timeout', 60,
+                                               'getfloat'),
+                   metrics=metrics())
+
+    def submit(self, event, done=None, sinks=None, on_sink=None):
+        """Queue event for delivery to sinks (by default, self.sinks).
+
+        done, if given, is called from the lane with a list of errors
+        (empty when every sink succeeded) once all sinks have finished.
+        on_sink, if given, is called with each sink that succeeds.
+        """
+        if sinks is None:
+            sinks = self.sinks
+        sinks = route_table().select(event, sinks)
+        lane = hash(str(event.account)) % len(self._lanes)
+        self._lanes[lane][0].put((event, done, sinks, on_sink, time.time()))
+
+    def close(self):
+        """Wait for everything queued so far to be delivered."""
+        for queue, _ in self._lanes:
+            queue.put(None)
+        for _, thread in self._lanes:
+            thread.join()
+
+    def _run_lane(self, queue):
+        # The thread of each sink that overran and is still running
+        overdue = {}
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            event, done, sinks, on_sink, queued = item
+            self.metrics.observe('alarm_events_queued_seconds',
+                                 time.time() - queued)
+            errors = self._deliver(event, sinks, on_sink, overdue)
+            if errors:
+                with self._lock:
+                    self.failures.extend(errors)
+            if done:
+                try:
+                    done(errors)
+                except Exception:
+                    with self._lock:
+                        self.failures.append(traceback.format_exc())
+
+    def _run_sink(self, sink, event, result, on_sink, after=None):
+        if after is not None:
+            after.join()
+        start = time.time()
+        try:
+            sink(event)
+            if on_sink:
+                on_sink(sink)
+        except Exception:
+            result['error'] = '%s failed for %s:\n%s' % (
+                _sink_name(sink), event.raw_event, traceback.format_exc())
+        finally:
+            self._slots.release()
+            if self.metrics.enabled:
+                name = _journal_name(sink)
+                self.metrics.observe('alarm_events_sink_seconds',
+                                     time.time() - start, sink=name)
+                self.metrics.count('alarm_events_sink_calls_total',
+                                   sink=name, result='error' in result and
+                                   'failed' or 'ok')
+
+    def _deliver(self, event, sinks, on_sink=None, overdue=None):
+        if overdue is None:
+            overdue = {}
+        running = []
+        for sink in sinks:
+            result = {}
+            self._slots.acquire()
+            thread = threading.Thread(target=self._run_sink,
+                                      args=(sink, event, result, on_sink,
+                                            overdue.get(sink)))
+            thread.daemon = True
+            thread.start()
+            running.append((sink, thread, result))
+
+        deadline = time.time() + self.sink_timeout
+        errors = []
+        for sink, thread, result in running:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                overdue[sink] = thread
+                errors.append('%s timed out after %ss for %s' % (
+                    _sink_name(sink), self.sink_timeout, event.raw_event))
+                self.metrics.count('alarm_events_sink_timeouts_total',
+                                   sink=_journal_name(sink))
+            else:
+                overdue.pop(sink, None)
+                if 'error' in result:
+                    errors.append(result['error'])
+        return errors
+
+
+# How many events read_spool_file() parses at once
+SPOOL_PARSE_BATCH = 256
+
+
+def _parse_batch(codes, malformed):
+    """Parse codes in bulk, or one by one if any of them is malformed.
+
+    Returns an Event, or None for each code that malformed was told of.
+    """
+    try:
+        return [Event.from_record(record)
+                for record in parse_event_codes(codes, verify_checksum=False)]
+    except InvalidEvent:
+        pass
+    events = []
+    for code in codes:
+        try:
+            events.append(parse_event_code(code))
+        except InvalidEvent, e:
+            if malformed is None:
+                raise
+            malformed(code, e)
+            events.append(None)
+    return events
+
+
+def read_spool_file(filename, system_format=None, malformed=None):
+    """Yield an Event for each event in filename, reading it lazily.
+
+    Events are parsed SPOOL_PARSE_BATCH at a time with
+    parse_event_codes(); checksums are left to the EventScreen. A line
+    that is not a ContactID event raises InvalidEvent, unless
+    malformed is given; then malformed(line, error) is called instead
+    and the rest of the file is still read.
+    """
+    collected = metrics()
+    with open(filename) as f:
+        records = iter_spool_records(f)
+        while True:
+            batch = list(itertools.islice(records, SPOOL_PARSE_BATCH))
+            if not batch:
+                break
+            start = time.time()
+            events = _parse_batch([code for _, code in batch], malformed)
+            elapsed = (time.time() - start) / len(batch)
+            for (metadata, _), event in zip(batch, events):
+                if event is None:
+                    continue
+                collected.observe('alarm_events_parse_seconds', elapsed)
+                event.metadata = metadata
+                event.from_ext = metadata.get('CALLINGFROM')
+                event.from_name = metadata.get('CALLERNAME')
+                if system_format:
+                    event.system_format = system_format
+                yield event
+
+
+class SpoolTicket(object):
+    """Track delivery of the events read from one spool file.
+
+    The reader holds the ticket open until it has reached the end of
+    the file; on_done(ticket) is called once that has happened and
+    every event submitted from the file has been delivered. With a
+    journal, events are only delivered to the sinks that have not
+    already finished with them, and each sink that does is recorded.
+    """
+    def __init__(self, filename, on_done, journal=None):
+        self.filename = filename
+        self.on_done = on_done
+        self.journal = journal
+        self.errors = []
+        self.events = 0
+        self.rejected = 0
+        # When the file was spooled, if metrics want it
+        self.spooled = None
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def submitted(self):
+        with self._lock:
+            self._pending += 1
+
+    def delivered(self, errors):
+        with self._lock:
+            self.errors.extend(errors)
+        self._release()
+
+    def started(self, index):
+        return self.journal is not None and self.journal.started(index)
+
+    def pending_sinks(self, index, sinks):
+        if self.journal is None:
+            return sinks
+        return self.journal.pending(index, sinks)
+
+    def record(self, index, sink):
+        if self.journal is not None:
+            self.journal.record(index, sink)
+
+    def close(self):
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished:
+            self.on_done(self)
+
+
+class Coalescer(object):
+    """Hold back bursts of related events and deliver them as digests.
+
+    Systems with a coalesce_window collect events of the same class
+    (event_code / 100) for that many seconds after the first one, then
+    deliver them together: one mail, one state update, and a log line
+    per event. Classes listed in coalesce_bypass (alarms, by default)
+    are always delivered immediately, as are events that some sink
+    has already handled in an earlier run. A group that only collected
+    one event is delivered as a plain event.
+    """
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.held = 0
+        self.digests = 0
+        self._groups = collections.OrderedDict()
+
+    def submit(self, event, ticket, now=None, index=None):
+        """Queue event, the index'th in ticket's file, for delivery."""
+        ticket.submitted()
+        try:
+            system = system_index(event.system)
+        except ConfigParser.NoSectionError:
+            system = None
+        event_class = event.event_code / 100
+        if (system is None or not system.coalesce_window or
+                event_class in system.coalesce_bypass or
+                ticket.started(index)):
+            self._dispatch(event, ticket, index)
+            return
+
+        key = (event.system, event_class)
+        if key not in self._groups:
+            if now is None:
+                now = time.time()
+            self._groups[key] = (now + system.coalesce_window, [])
+        self._groups[key][1].append((event, ticket, index))
+        self.held += 1
+
+    def next_due(self):
+        """Return when the next group is due, or None if none are held."""
+        if not self._groups:
+            return None
+        return min(due for due, _ in self._groups.values())
+
+    def flush(self, now=None):
+        """Deliver the groups due by now (or all of them, if now is None)."""
+        for key, (due, items) in self._groups.items():
+            if now is None or due <= now:
+                del self._groups[key]
+                self._deliver(items)
+
+    def _dispatch(self, event, ticket, index):
+        self.dispatcher.submit(
+            event, ticket.delivered,
+            ticket.pending_sinks(index, self.dispatcher.sinks),
+            lambda sink: ticket.record(index, sink))
+
+    def _deliver(self, items):
+        if len(items) == 1:
+            self._dispatch(*items[0])
+            return
+
+        def done(errors):
+            for _, ticket, _ in items:
+                ticket.delivered(errors)
+
+        def record(sink):
+            for _, ticket, index in items:
+                ticket.record(index, sink)
+
+        self.digests += 1
+        self.dispatcher.submit(Digest([event for event, _, _ in items]),
+                               done, digest_sinks(), record)
+
+    def report(self):
+        if self.digests:
+            sys.stderr.write('alarm_events: coalesced %i events into %i '
+                             'digest(s)\n' % (self.held, self.digests))
+
+
+def submit_spool_file(filename, system_format, screen, coalescer, on_done,
+                      journal=None):
+    """Read filename and queue its events for delivery.
+
+    Lines that are not ContactID events are reported and skipped, like
+    events with a bad checksum, and the file is then kept as
+    rejected-event-*. If no line of the file is an event, or reading
+    it fails, the exception propagates and the ticket is never
+    completed, so on_done is never called.
+    """
+    ticket = SpoolTicket(filename, on_done, journal)
+    collected = metrics()
+    if collected.enabled:
+        ticket.spooled = os.stat(filename).st_mtime
+        collected.observe('alarm_events_spool_wait_seconds',
+                          time.time() - ticket.spooled)
+    replay = journal is not None and journal.replay
+    malformed = []
+
+    def reject(line, error):
+        print 'Rejected line %r in %s: %s' % (line, filename, error)
+        collected.count('alarm_events_events_total', verdict='malformed')
+        malformed.append(error)
+        ticket.rejected += 1
+    for index, event in enumerate(read_spool_file(filename, system_format,
+                                                  reject)):
+        ticket.events += 1
+        verdict = screen.check(event, replay=replay)
+        collected.count('alarm_events_events_total', verdict=verdict)
+        if verdict == EventScreen.REJECTED:
+            print 'Rejected event %s in %s: bad checksum' % (
+                event.raw_event, filename)
+            ticket.rejected += 1
+        elif verdict == EventScreen.ACCEPTED:
+            for restore in checkin_monitor().seen(event):
+                ticket.submitted()
+                coalescer.dispatcher.submit(restore, ticket.delivered)
+            coalescer.submit(event, ticket, index=index)
+    if not ticket.events:
+        if malformed:
+            raise malformed[0]
+        raise InvalidEvent('No events in %s' % filename)
+    ticket.close()
+    return ticket
+
+
+def finish_spool_file(ticket):
+    """Dispose of a spool file once everything in it has been handled.
+
+    Files with failed deliveries are left (or, if claimed, put back)
+    for the next run; files that contained rejected events are kept as
+    rejected-event-*.
+    """
+    claimed = ticket.journal is not None
+    collected = metrics()
+    if ticket.errors:
+        collected.count('alarm_events_files_total', result='failed')
+        if claimed:
+            release_spool_file(ticket.filename)
+        return
+    if ticket.rejected:
+        set_aside(ticket.filename, 'rejected',
+                  claimed and _spool_dir(ticket.filename) or None)
+    else:
+        os.remove(ticket.filename)
+    if claimed:
+        SpoolJournal.discard(ticket.filename)
+    collected.count('alarm_events_files_total', result='done')
+    if ticket.spooled:
+        collected.observe('alarm_events_delivered_seconds',
+                          time.time() - ticket.spooled)
+
+
+def process_spool_file(filename, system_format, screen, coalescer, on_done):
+    """Claim filename and queue its events, quarantining it if it is bad.
+
+    Returns an error message if the file was quarantined, else None.
+    """
+    claimed = claim_spool_file(filename)
+    if claimed is None:
+        return None
+    try:
+        submit_spool_file(claimed, system_format, screen, coalescer, on_done,
+                          SpoolJournal.for_file(claimed))
+    except Exception:
+        target = quarantine_spool_file(claimed)
+        metrics().count('alarm_events_files_total', result='quarantined')
+        return 'Quarantined %s as %s:\n%s' % (filename, target,
+                                               traceback.format_exc())
+
+
+def deliver_spool_files(files, system_format):
+    """Deliver the events in files; return the failures and quarantines."""
+    screen = EventScreen.from_config()
+    dispatcher = Dispatcher.from_config()
+    coalescer = Coalescer(dispatcher)
+    quarantined = []
+    try:
+        for filename in files:
+            error = process_spool_file(filename, system_format, screen,
+                                       coalescer, finish_spool_file)
+            if error:
+                print error.split('\n')[0]
+                quarantined.append(error)
+        raise_missed_checkins(dispatcher)
+    finally:
+        # A single run can only coalesce the events it has seen
+        coalescer.flush()
+        dispatcher.close()
+        screen.save()
+        screen.report(len(dispatcher.sinks))
+        coalescer.report()
+    return dispatcher.failures, quarantined
+
+
+def main():
+    spool, system_format = spool_settings()
+    recover_spool(spool)
+    if current_shard() is None:
+        rebalance_checkins()
+    collected = metrics()
+    failures = quarantined = []
+    try:
+        files = spool_files(spool)
+        collected.gauge('alarm_events_spool_backlog', len(files))
+        due = checkin_monitor().stored_due()
+        if files or (due is not None and due <= time.time()):
+            # The sinks are only set up once there is something for them
+            failures, quarantined = deliver_spool_files(files,
+                                                        system_format)
+    finally:
+        state_queue().retry()
+        close_sinks()
+        close_claims()
+        collected.save()
+        collected.report()
+    if failures or quarantined:
+        raise DispatchError('%i sink(s) failed, %i file(s) quarantined:\n%s'
+                            % (len(failures), len(quarantined),
+                               '\n'.join(failures + quarantined)))
+
+
+def safety_net(msg):
+    send_mail('Failed to process alarm event', msg,
+              CONFIG.get('general', 'safety_net_email'))
+
+
+def safe_main(workers=0):
+    try:
+        if workers:
+            sharded_main(workers)
+        else:
+            main()
+    except Exception, e:
+        print 'Failed: %s' % e
+        safety_net('Failed to process event:\n' +
+                   traceback.format_exc())
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+class SpoolWatcher(object):
+    """Block until something may have landed in the spool directory.
+
+    Uses inotify (through ctypes) when the platform has it, otherwise
+    falls back to sleeping for poll_interval. Either way, a signal
+    (such as the SIGUSR1 sent by --wakeup) cuts the wait short.
+    """
+    def __init__(self, spool, poll_interval=1.0, use_inotify=True):
+        self.spool = spool
+        self.poll_interval = poll_interval
+        self._fd = None
+        if not use_inotify:
+            return
+        try:
+            self._fd = self._inotify_open(spool)
+        except (OSError, AttributeError, ImportError):
+            self._fd = None
+
+    @property
+    def polling(self):
+        return self._fd is None
+
+    @staticmethod
+    def _inotify_open(spool):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        wd = libc.inotify_add_watch(fd, spool,
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, 'inotify_add_watch failed on %s' % spool)
+        return fd
+
+    def wait(self, timeout=None):
+        if self._fd is None:
+            if timeout is None or timeout > self.poll_interval:
+                timeout = self.poll_interval
+            time.sleep(timeout)
+            return
+        try:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            # Drain the queued notifications; we rescan the spool anyway
+            os.read(self._fd, 65536)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+# Seconds the daemon waits before retrying a spool file whose delivery
+# failed, doubling after each failure up to SPOOL_RETRY_MAX
+SPOOL_RETRY = 5
+SPOOL_RETRY_MAX = 600
+
+
+def daemon_main(poll_interval=1.0, use_inotify=True, settle=0.25):
+    """Stay resident and process spool files as they arrive.
+
+    Files whose delivery fails are reported to the safety net once and
+    then retried after SPOOL_RETRY seconds, backing off up to
+    SPOOL_RETRY_MAX, rather than on every pass. Files that cannot be
+    read are quarantined.
+    """
+    spool, system_format = spool_settings()
+    recover_spool(spool)
+    watcher = SpoolWatcher(spool, poll_interval, use_inotify)
+    state = {'running': True}
+
+    def _stop(signum, frame):
+        state['running'] = False
+
+    def _wake(signum, frame):
+        pass
+
+    def _reload(signum, frame):
+        state['reload'] = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGUSR1, _wake)
+    signal.signal(signal.SIGHUP, _reload)
+
+    # Under a supervisor (--workers), it owns the pid file and serves
+    # the metrics
+    supervised = current_shard() is not None
+    pid_file = None
+    if CONFIG.has_option('general', 'pid_file') and not supervised:
+        pid_file = CONFIG.get('general', 'pid_file')
+        with file(pid_file, 'w') as f:
+            f.write('%i\n' % os.getpid())
+    if not supervised:
+        rebalance_checkins()
+
+    screen = EventScreen.from_config()
+    dispatcher = Dispatcher.from_config()
+    coalescer = Coalescer(dispatcher)
+    collected = metrics()
+    server = None
+    if CONFIG.has_option('general', 'metrics_port') and not supervised:
+        server = MetricsServer(collected,
+                               CONFIG.getint('general', 'metrics_port'),
+                               general_option('metrics_address',
+                                              '127.0.0.1'))
+    reloader = ConfigReloader(general_option('config_check', 5, 'getfloat'))
+    state_queue().start()
+    pending = None
+    inflight = set()
+    failed = {}
+    next_outbox = 0
+    next_metrics = 0
+
+    def _finished(filename):
+        def done(ticket):
+            failures = 0
+            if ticket.errors:
+                # (failures so far, when to try again)
+                failures = failed.get(filename, (0, 0))[0] + 1
+                failed[filename] = (failures, time.time() + min(
+                    SPOOL_RETRY_MAX, SPOOL_RETRY * 2 ** (failures - 1)))
+            else:
+                failed.pop(filename, None)
+            finish_spool_file(ticket)
+            if failures == 1:
+                safety_net('Failed to deliver event %s:\n%s' % (
+                    filename, '\n'.join(ticket.errors)))
+            inflight.discard(filename)
+        return done
+
+    try:
+        while state['running']:
+            if pending is None and (state.pop('reload', False) or
+                                    reloader.changed()):
+                pending = reload_config(reloader)
+            if pending is not None:
+                # New files wait until everything in flight has been
+                # delivered under the old config
+                coalescer.flush()
+                if not inflight:
+                    swap_config(pending)
+                    pending = None
+                    state_queue().start()
+                    system_format = spool_settings()[1]
+                    print 'Loaded config version %i' % CONFIG._alarm_version
+            files = []
+            if pending is None:
+                files = spool_files(spool)
+                collected.gauge('alarm_events_spool_backlog', len(files))
+            for filename in files:
+                if filename in inflight:
+                    continue
+                try:
+                    mtime = os.stat(filename).st_mtime
+                except OSError:
+                    continue
+                if failed.get(filename, (0, 0))[1] > time.time():
+                    continue
+                if watcher.polling and time.time() - mtime < settle:
+                    # Possibly still being written by alarmreceiver
+                    continue
+                inflight.add(filename)
+                error = process_spool_file(filename, system_format, screen,
+                                           coalescer, _finished(filename))
+                if error:
+                    inflight.discard(filename)
+                    print error.split('\n')[0]
+                    safety_net('Failed to process event %s:\n%s' % (
+                        filename, error))
+            coalescer.flush(time.time())
+            if pending is None:
+                raise_missed_checkins(dispatcher, done=_report_failures)
+            screen.save()
+            if getattr(CONFIG, '_alarm_panel_state', None):
+                panel_states().save()
+            if getattr(CONFIG, '_alarm_log', None):
+                event_log().flush()
+            if time.time() >= next_outbox and smtp_mailer():
+                smtp_mailer().flush_outbox()
+                next_outbox = time.time() + 60
+            if time.time() >= next_metrics:
+                collected.save()
+                checkin_monitor().save()
+                next_metrics = time.time() + 15
+            for filename in failed.keys():
+                if not os.path.exists(filename):
+                    del failed[filename]
+            if state['running']:
+                timeout = poll_interval
+                retries = [retry for _, retry in failed.values()]
+                for due in (coalescer.next_due(),
+                            checkin_monitor().next_due(),
+                            retries and min(retries) or None):
+                    if due is not None:
+                        timeout = max(0, min(timeout, due - time.time()))
+                if pending is not None:
+                    timeout = min(timeout, 0.05)
+                watcher.wait(timeout)
+        coalescer.flush()
+        dispatcher.close()
+        screen.report(len(dispatcher.sinks))
+        coalescer.report()
+        close_sinks()
+        collected.save()
+        collected.report()
+    finally:
+        watcher.close()
+        close_claims()
+        if server:
+            server.close()
+        if pid_file:
+            try:
+                os.remove(pid_file)
+            except OSError:
+                pass
+
+
+def wakeup():
+    """Poke a running daemon so it rescans the spool immediately."""
+    with file(CONFIG.get('general', 'pid_file')) as f:
+        pid = int(f.read().strip())
+    os.kill(pid, signal.SIGUSR1)
+
+
+# With --workers, spool files are handed out to a spool per worker
+# process under this directory
+SHARD_DIR = 'shards'
+
+
+def current_shard():
+    """Return the shard this process works on, or None if unsharded."""
+    return getattr(CONFIG, '_alarm_shard', None)
+
+
+def shard_spool(spool, index):
+    return os.path.join(spool, SHARD_DIR, str(index))
+
+
+def enter_shard(index):
+    """Make this freshly forked process work on shard index only.
+
+    Anything the supervisor had opened for the sinks or the metrics
+    is its own, so the worker starts afresh.
+    """
+    for attr in ('_alarm_mailer', '_alarm_log', '_alarm_store',
+                 '_alarm_metrics', '_alarm_state_queue',
+                 '_alarm_panel_state', '_alarm_checkins'):
+        if hasattr(CONFIG, attr):
+            delattr(CONFIG, attr)
+    CONFIG._alarm_shard = index
+
+
+def _move_spool_file(filename, dirname):
+    """Move an unclaimed spool file, and its journal, into dirname."""
+    basename = os.path.basename(filename)
+    journal = os.path.join(os.path.dirname(filename), PROCESSING_DIR,
+                           basename + SpoolJournal.SUFFIX)
+    if os.path.exists(journal):
+        # The journal goes first: if we die in between, the file is
+        # routed here again and finds it
+        target = os.path.join(dirname, PROCESSING_DIR)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        os.rename(journal, os.path.join(target,
+                                        basename + SpoolJournal.SUFFIX))
+    os.rename(filename, os.path.join(dirname, basename))
+
+
+class ShardRouter(object):
+    """Hand spool files out to the workers' spools by account.
+
+    Every file from one account (or, with shard_by = system, from one
+    system) goes to the same worker in the order the files arrived, so
+    each account's events are still delivered in order while a slow
+    endpoint or a large backlog only holds up its own shard.
+    """
+    def __init__(self, spool, system_format, workers):
+        self.spool = spool
+        self.system_format = system_format
+        self.workers = workers
+        self.by_system = general_option('shard_by', 'account') == 'system'
+        for index in range(workers):
+            dirname = shard_spool(spool, index)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+    def key(self, filename):
+        """Return what filename is sharded on, from its first event."""
+        with open(filename) as f:
+            for metadata, event_code in iter_spool_records(f):
+                event = parse_event_code(event_code)
+                if not self.by_system:
+                    return str(event.account)
+                event.from_ext = metadata.get('CALLINGFROM')
+                if self.system_format:
+                    event.system_format = self.system_format
+                return event.system
+        raise InvalidEvent('No events in %s' % filename)
+
+    def shard(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % self.workers
+
+    def route(self, filename):
+        """Move filename into its shard's spool and return the shard."""
+        index = self.shard(self.key(filename))
+        dirname = shard_spool(self.spool, index)
+        if os.path.dirname(filename) != dirname:
+            _move_spool_file(filename, dirname)
+        return index
+
+    def route_all(self, spool=None, settle=0):
+        """Route the files waiting in spool (by default, the main one).
+
+        Returns the set of shards that were given files, and an error
+        for each file that could not be read and was quarantined.
+        Files younger than settle seconds are left for next time.
+        """
+        routed = set()
+        errors = []
+        for filename in spool_files(spool or self.spool):
+            try:
+                if settle and time.time() - os.stat(filename).st_mtime < \
+                        settle:
+                    # Possibly still being written by alarmreceiver
+                    continue
+                routed.add(self.route(filename))
+            except Exception, e:
+                if getattr(e, 'errno', None) == errno.ENOENT:
+                    # Taken by another run
+                    continue
+                target = set_aside(filename, 'quarantined')
+                errors.append('Quarantined %s as %s:\n%s' % (
+                    filename, target, traceback.format_exc()))
+        return routed, errors
+
+    def rebalance(self):
+        """Route the files left in every shard spool to where they belong.
+
+        Claims abandoned by dead workers are released first. Files only
+        move if the number of workers has changed since they were
+        routed. Returns the errors from route_all().
+        """
+        errors = []
+        top = os.path.join(self.spool, SHARD_DIR)
+        for name in sorted(os.listdir(top)):
+            dirname = os.path.join(top, name)
+            if not os.path.isdir(dirname):
+                continue
+            recover_spool(dirname)
+            errors += self.route_all(dirname)[1]
+        return errors
+
+
+def _fork_worker(index, target, args=(), close_fds=()):
+    """Run target(*args) for shard index in a child; return its pid.
+
+    close_fds are descriptors of the supervisor's that the child should
+    not hold open.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        for fd in close_fds:
+            os.close(fd)
+        enter_shard(index)
+        target(*args)
+        status = 0
+    except DispatchError, e:
+        print 'Shard %i: %s' % (index, e)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def _wait_child(pid, flags=0):
+    while True:
+        try:
+            return os.waitpid(pid, flags)
+        except OSError, e:
+            if e.errno == errno.ECHILD:
+                return 0, 0
+            if e.errno != errno.EINTR:
+                raise
+
+
+def sharded_main(workers):
+    """Like main(), with the spool split between worker processes."""
+    spool, system_format = spool_settings()
+    recover_spool(spool)
+    router = ShardRouter(spool, system_format, workers)
+    quarantined = router.rebalance() + router.route_all()[1]
+    for error in quarantined:
+        print error.split('\n')[0]
+    rebalance_checkins(router)
+    children = {}
+    for index in range(workers):
+        checkins = CheckInMonitor(state_path(checkin_file(index)))
+        due = checkins.stored_due()
+        if (spool_files(shard_spool(spool, index)) or
+                (due is not None and due <= time.time())):
+            children[_fork_worker(index, main)] = index
+    failed = []
+    for pid, index in sorted(children.items()):
+        if _wait_child(pid)[1]:
+            failed.append(index)
+    if failed or quarantined:
+        raise DispatchError('%i shard(s) failed, %i file(s) quarantined:\n%s'
+                            % (len(failed), len(quarantined),
+                               '\n'.join(['Shard %i failed' % index
+                                          for index in failed] +
+                                         quarantined)))
+
+
+def supervise(workers, poll_interval=1.0, use_inotify=True, settle=0.25):
+    """Route the spool between worker processes, each a daemon_main().
+
+    Signals are passed on to the workers. A worker that dies is
+    reported to the safety net and restarted, waiting longer each time
+    it keeps dying; its replacement recovers what it had claimed.
+    """
+    spool, system_format = spool_settings()
+    recover_spool(spool)
+    router = ShardRouter(spool, system_format, workers)
+    for error in router.rebalance():
+        safety_net('Failed to route event:\n%s' % error)
+    rebalance_checkins(router)
+    watcher = SpoolWatcher(spool, poll_interval, use_inotify)
+    state = {'running': True}
+
+    def _stop(signum, frame):
+        state['running'] = False
+
+    def _wake(signum, frame):
+        pass
+
+    def _reload(signum, frame):
+        # Each worker reloads its own config
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+
+    children = {}
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGUSR1, _wake)
+    signal.signal(signal.SIGHUP, _reload)
+
+    pid_file = None
+    if CONFIG.has_option('general', 'pid_file'):
+        pid_file = CONFIG.get('general', 'pid_file')
+        with file(pid_file, 'w') as f:
+            f.write('%i\n' % os.getpid())
+
+    collected = metrics()
+    server = None
+    if CONFIG.has_option('general', 'metrics_port'):
+        server = MetricsServer(collected,
+                               CONFIG.getint('general', 'metrics_port'),
+                               general_option('metrics_address',
+                                              '127.0.0.1'))
+    close_fds = [fd for fd in (watcher.fileno(),
+                               server and server.server.fileno())
+                 if fd is not None]
+    crashes = collections.Counter()
+    restart_at = {}
+
+    def start(index):
+        children[_fork_worker(index, daemon_main,
+                              (poll_interval, use_inotify, settle),
+                              close_fds)] = index
+
+    try:
+        for index in range(workers):
+            start(index)
+        next_metrics = 0
+        while state['running']:
+            routed, errors = router.route_all(
+                settle=watcher.polling and settle or 0)
+            for error in errors:
+                print error.split('\n')[0]
+                safety_net('Failed to process event:\n%s' % error)
+            for pid, index in children.items():
+                if index in routed:
+                    os.kill(pid, signal.SIGUSR1)
+            while children:
+                pid, status = _wait_child(-1, os.WNOHANG)
+                if not pid:
+                    break
+                index = children.pop(pid)
+                crashes[index] += 1
+                restart_at[index] = time.time() + min(
+                    60, 2 ** (crashes[index] - 1))
+                safety_net('Worker for shard %i exited with status %i; '
+                           'restarting it' % (index, status))
+            for index, when in restart_at.items():
+                if time.time() >= when:
+                    del restart_at[index]
+                    start(index)
+            if time.time() >= next_metrics:
+                # Picks up the totals the workers have saved
+                collected.save()
+                next_metrics = time.time() + 15
+            if state['running']:
+                timeout = poll_interval
+                if restart_at:
+                    timeout = max(0, min(timeout, min(restart_at.values()) -
+                                         time.time()))
+                watcher.wait(timeout)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in children:
+            _wait_child(pid)
+        watcher.close()
+        if server:
+            server.close()
+        if pid_file:
+            try:
+                os.remove(pid_file)
+            except OSError:
+                pass
+
+
+def compile_snapshot(filename):
+    """Write the cache for filename afresh, and byte-compile this module.
+
+    For installations where the user Asterisk runs as cannot write
+    next to the config or the script: run once after each change by
+    someone who can. Returns the problems that stopped it.
+    """
+    import py_compile
+    cfg = read_config(filename, cached=False)
+    problems = validate_config(cfg)
+    if problems:
+        return problems
+    if not _save_cached_config(filename, cfg):
+        return ['Could not write %s' % _config_cache_path(filename)]
+    source = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    try:
+        py_compile.compile(source, doraise=True)
+    except (py_compile.PyCompileError, IOError), e:
+        return ['Could not compile %s: %s' % (source, e)]
+    return []
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Process ContactID events spooled by alarmreceiver')
+    parser.add_argument('config', help='Path to the config file')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Stay resident and watch the spool directory')
+    parser.add_argument('--wakeup', action='store_true',
+                        help='Signal a running daemon to rescan the spool')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='Seconds between spool scans when inotify '
+                             'is not available (default: %(default)s)')
+    parser.add_argument('--no-inotify', action='store_true',
+                        help='Poll the spool even if inotify is available '
+                             '(for example on network filesystems)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Split the spool by account between this '
+                             'many worker processes')
+    parser.add_argument('--status', metavar='SYSTEM',
+                        help='Show what the panel of SYSTEM last reported '
+                             '(with panel_state on)')
+    parser.add_argument('--compile', action='store_true',
+                        help='Write the config cache and the compiled '
+                             'script for alarm_eventcmd.py, then exit')
+    return parser.parse_args(argv)
+
+
+def run(argv):
+    args = parse_args(argv)
+    if args.compile:
+        problems = compile_snapshot(args.config)
+        for problem in problems:
+            print problem
+        sys.exit(problems and 1 or 0)
+    load_config(args.config)
+    if args.wakeup:
+        wakeup()
+    elif args.status:
+        show_state(args.status)
+    elif args.daemon and args.workers:
+        supervise(args.workers, args.poll_interval, not args.no_inotify)
+    elif args.daemon:
+        daemon_main(args.poll_interval, not args.no_inotify)
+    else:
+        safe_main(args.workers)
+
+
+if __name__ == '__main__':
+    run(sys.argv[1:])
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+"""Indexed, queryable history of alarm events.
+
+alarm_events.py records every delivered event here when the config
+sets history_db in [general]. From the command line::
+
+   alarm_history.py my.config query --account 9876 --zone 5 --last
+   alarm_history.py my.config query --code 381 --since 7d --count
+   alarm_history.py my.config import ~/9876-security.log*
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import alarm_events
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    account INTEGER NOT NULL,
+    system TEXT,
+    event_code INTEGER NOT NULL,
+    qualifier INTEGER,
+    partition INTEGER,
+    zone_number INTEGER,
+    text TEXT,
+    raw_event TEXT
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_account ON events (account, time);
+CREATE INDEX IF NOT EXISTS events_code ON events (event_code, time);
+CREATE INDEX IF NOT EXISTS events_zone
+    ON events (account, zone_number, event_code, time);
+CREATE INDEX IF NOT EXISTS events_zone_time ON events (zone_number, time);
+"""
+
+COLUMNS = ('time', 'account', 'system', 'event_code', 'qualifier',
+           'partition', 'zone_number', 'text', 'raw_event')
+
+
+class EventStore(object):
+    """Events in an SQLite database, indexed for the usual questions.
+
+    The indexes cover time ranges, per-account ranges, event codes or
+    classes over time, and per-zone lookups such as "when was zone 5
+    last opened", with or without an account. One connection is shared
+    between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    @staticmethod
+    def _row(event, when):
+        return (when, event.account, event.system, event.event_code,
+                event.qualifier, event.partition, event.zone_number,
+                str(event), event.raw_event)
+
+    def add(self, event, when=None):
+        if when is None:
+            when = time.time()
+        self.add_rows([self._row(event, when)])
+
+    def add_rows(self, rows):
+        """Insert rows of COLUMNS values in one transaction."""
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT INTO events (%s) VALUES (%s)' % (
+                        ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                    rows)
+
+    @staticmethod
+    def _where(start, end, account, zone, event_code, event_class):
+        clauses = []
+        args = []
+        if account is not None:
+            clauses.append('account = ?')
+            args.append(account)
+        if zone is not None:
+            clauses.append('zone_number = ?')
+            args.append(zone)
+        if event_code is not None:
+            clauses.append('event_code = ?')
+            args.append(event_code)
+        elif event_class is not None:
+            # An IN list lets SQLite seek (event_code, time) per code
+            # rather than scanning the whole class
+            clauses.append('event_code IN (%s)' % ', '.join('?' * 100))
+            args.extend(range(event_class * 100, event_class * 100 + 100))
+        if start is not None:
+            clauses.append('time >= ?')
+            args.append(start)
+        if end is not None:
+            clauses.append('time < ?')
+            args.append(end)
+        return clauses and ' WHERE ' + ' AND '.join(clauses) or '', args
+
+    def query(self, start=None, end=None, account=None, zone=None,
+              event_code=None, event_class=None, limit=None, newest=False):
+        """Return matching events as sqlite3.Row objects, oldest first.
+
+        With newest, the most recent come first instead.
+        """
+        where, args = self._where(start, end, account, zone, event_code,
+                                  event_class)
+        sql = 'SELECT %s FROM events%s ORDER BY time %s' % (
+            ', '.join(COLUMNS), where, newest and 'DESC' or 'ASC')
+        if limit is not None:
+            sql += ' LIMIT %i' % limit
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def count(self, start=None, end=None, account=None, zone=None,
+              event_code=None, event_class=None):
+        where, args = self._where(start, end, account, zone, event_code,
+                                  event_class)
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM events' + where,
+                                    args).fetchone()[0]
+
+    def last(self, **kwargs):
+        """Return the most recent matching event, or None."""
+        rows = self.query(limit=1, newest=True, **kwargs)
+        return rows and rows[0] or None
+
+    def import_log(self, path, account=None, batch=10000):
+        """Back-fill from a *-security.log or .jsonl file; returns count.
+
+        Text logs only carry the rendered message, so zone and user
+        labels are mapped back to numbers through the loaded config
+        where possible and the partition is unknown.
+        """
+        if account is None:
+            match = re.match(r'(\d+)-security\.', os.path.basename(path))
+            if not match:
+                raise ValueError('Cannot tell the account of %s' % path)
+            account = int(match.group(1))
+        opener = path.endswith('.gz') and gzip.open or open
+        json_lines = '.jsonl' in os.path.basename(path)
+        parse = json_lines and parse_json_line or LogLineParser(account)
+        count = 0
+        rows = []
+        with opener(path) as f:
+            for line in f:
+                row = parse(line)
+                if row is None:
+                    continue
+                rows.append(row)
+                if len(rows) >= batch:
+                    self.add_rows(rows)
+                    count += len(rows)
+                    rows = []
+        self.add_rows(rows)
+        return count + len(rows)
+
+
+def _parse_stamp(stamp):
+    return time.mktime(time.strptime(stamp, '%Y-%m-%dT%H:%M:%S'))
+
+
+def parse_json_line(line):
+    try:
+        record = json.loads(line)
+        when = _parse_stamp(record['time'])
+    except (ValueError, KeyError):
+        return None
+    return (when, record['account'], record.get('system'),
+            record['event_code'], record.get('qualifier'),
+            record.get('partition'), record.get('zone_number'),
+            record.get('text'), record.get('raw_event'))
+
+
+class LogLineParser(object):
+    """Recover what we can from a line written by log_event()."""
+    _LINE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d): '
+                       r'(?:(?:Event|Alarm) (\d+): (.*?)(?: (?:in zone|'
+                       r'in device|by) (.*))?|Unknown event (\d+) received '
+                       r'for index (\d+)) at (.*)$')
+    _NUMBERED = re.compile(r'^(?:Zone|User) (\d+)$')
+
+    def __init__(self, account):
+        self.account = account
+        self.labels = {}
+        try:
+            system = alarm_events.system_index(str(account))
+        except Exception:
+            return
+        for number, label in system.zones.items() + system.users.items():
+            self.labels.setdefault(label, number)
+
+    def _number(self, label):
+        if label is None:
+            return None
+        if label == 'keypad user':
+            return 98
+        match = self._NUMBERED.match(label)
+        if match:
+            return int(match.group(1))
+        return self.labels.get(label)
+
+    def __call__(self, line):
+        match = self._LINE.match(line.rstrip('\n'))
+        if not match:
+            return None
+        stamp, code, name, label, unknown, index, _system = match.groups()
+        if unknown:
+            code, zone = int(unknown), int(index)
+        else:
+            code, zone = int(code), self._number(label)
+        if code == 401:
+            qualifier = 'disarmed' in name and 1 or 3
+        else:
+            qualifier = name and name.endswith('(restored)') and 3 or 1
+        text = line.rstrip('\n').split(': ', 1)[1]
+        return (_parse_stamp(stamp), self.account, str(self.account), code,
+                qualifier, None, zone, text, None)
+
+
+def parse_time(value):
+    """Parse 2026-10-17, 2026-10-17T08:00:00, or an age like 7d/12h/30m."""
+    match = re.match(r'^(\d+)([dhm])$', value)
+    if match:
+        scale = {'d': 86400, 'h': 3600, 'm': 60}[match.group(2)]
+        return time.time() - int(match.group(1)) * scale
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Bad time %r' % value)
+
+
+def format_row(row):
+    return '%s %s %s' % (
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(row['time'])),
+        row['account'], row['text'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Query the event history')
+    parser.add_argument('config', help='Path to the config file')
+    commands = parser.add_subparsers(dest='command')
+
+    query = commands.add_parser('query', help='Show or count events')
+    query.add_argument('--account', type=int)
+    query.add_argument('--zone', type=int)
+    query.add_argument('--code', type=int, help='Event code, such as 381')
+    query.add_argument('--class', type=int, dest='event_class',
+                       help='Event class, such as 1 for alarms')
+    query.add_argument('--since', type=parse_time)
+    query.add_argument('--until', type=parse_time)
+    query.add_argument('--limit', type=int)
+    query.add_argument('--last', action='store_true',
+                       help='Show only the most recent match')
+    query.add_argument('--count', action='store_true',
+                       help='Print the number of matches')
+
+    backfill = commands.add_parser('import',
+                                   help='Back-fill from security logs')
+    backfill.add_argument('logs', nargs='+')
+    backfill.add_argument('--account', type=int,
+                          help='Account, if not in the file name')
+
+    args = parser.parse_args(argv)
+    alarm_events.load_config(args.config)
+    store = EventStore(os.path.expanduser(
+        alarm_events.CONFIG.get('general', 'history_db')))
+    try:
+        if args.command == 'import':
+            for path in args.logs:
+                print '%s: %i events' % (path, store.import_log(
+                    path, args.account))
+            return
+        criteria = dict(start=args.since, end=args.until,
+                        account=args.account, zone=args.zone,
+                        event_code=args.code, event_class=args.event_class)
+        if args.count:
+            print store.count(**criteria)
+        elif args.last:
+            row = store.last(**criteria)
+            if row:
+                print format_row(row)
+        else:
+            for row in store.query(limit=args.limit, **criteria):
+                print format_row(row)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,438 @@
+#!/usr/bin/python
+"""Receive SIA DC-09 alarm reports over IP.
+
+Communicators that speak SIA DC-09 send ContactID events as ADM-CID
+frames over TCP or UDP. Each frame is checked and answered (ACK, NAK
+or DUH), and its event goes straight to the usual sinks, without
+Asterisk or the spool::
+
+   alarm_receiver.py my.config --port 7001
+"""
+
+import argparse
+import asyncore
+import errno
+import re
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+
+import alarm_events
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """Return the CRC-16/ARC of data, as carried by DC-09 frames."""
+    crc = 0
+    table = _CRC16_TABLE
+    for c in data:
+        crc = (crc >> 8) ^ table[(crc ^ ord(c)) & 0xFF]
+    return crc
+
+
+def frame(body):
+    """Wrap a message body in LF, CRC, length and CR."""
+    return '\n%04X0%03X%s\r' % (crc16(body), len(body), body)
+
+
+class FrameError(ValueError):
+    pass
+
+
+_BODY = re.compile(r'^"(?P<id>\*?[A-Z0-9-]+)"(?P<seq>\d{4})'
+                   r'(?:R(?P<rcvr>[0-9A-F]{1,6}))?L(?P<pref>[0-9A-F]{1,6})'
+                   r'[#A](?P<acct>[0-9A-F]{1,16})\[(?P<data>[^\]]*)\]'
+                   r'(?P<stamp>_\d\d:\d\d:\d\d,\d\d-\d\d-\d{4})?$')
+
+_ADM_CID = re.compile(r'^(?:#[0-9A-F]+\|)?([136])(\d{3}) ?(\d{2}) ?'
+                      r'(\d{3})$')
+
+
+def parse_frame(data):
+    """Return the fields of one frame (LF to CR) as a dict.
+
+    Raises FrameError if it is not a well formed frame whose length
+    and CRC match.
+    """
+    if len(data) < 11 or data[0] != '\n' or data[-1] != '\r':
+        raise FrameError('Not a DC-09 frame: %r' % data)
+    body = data[9:-1]
+    try:
+        crc = int(data[1:5], 16)
+        length = int(data[5:9], 16)
+    except ValueError:
+        raise FrameError('Bad CRC or length in %r' % data)
+    if length != len(body):
+        raise FrameError('Length %i of %r should be %i' % (length, body,
+                                                          len(body)))
+    if crc != crc16(body):
+        raise FrameError('Bad CRC on %r' % body)
+    match = _BODY.match(body)
+    if not match:
+        raise FrameError('Malformed message %r' % body)
+    return match.groupdict()
+
+
+def contactid_code(account, data):
+    """Return the 16 digit ContactID code of an ADM-CID message.
+
+    Raises FrameError if data is not ContactID or the account does not
+    fit the four digits that ContactID has for it.
+    """
+    match = _ADM_CID.match(data)
+    if not match or not account.isdigit() or int(account) > 9999:
+        raise FrameError('Cannot make a ContactID event of #%s[%s]' % (
+            account, data))
+    code = '%04i18%s' % (int(account), ''.join(match.groups()))
+    return code + alarm_events.checksum_digit(code)
+
+
+def reply(kind, message=None):
+    """Return the ACK, DUH or NAK frame that answers message."""
+    if kind == 'NAK' or message is None:
+        return frame('"NAK"0000R0L0A0[]%s' % time.strftime(
+            '_%H:%M:%S,%m-%d-%Y', time.gmtime()))
+    receiver = message['rcvr'] and 'R' + message['rcvr'] or ''
+    return frame('"%s"%s%sL%s#%s[]' % (kind, message['seq'], receiver,
+                                        message['pref'], message['acct']))
+
+
+class Receiver(object):
+    """Turn DC-09 frames into events for the sinks.
+
+    The ACK goes back as soon as the event has been queued for
+    delivery, not once the sinks have finished. Corrupt frames get a
+    NAK, so the panel sends them again; frames that are sound but not
+    unencrypted ContactID get a DUH. A panel that did not hear an ACK
+    repeats the frame with the same sequence number and data, which is
+    acknowledged again but not delivered twice. A new event that reuses
+    the sequence number (after a reboot, or once the counter wraps) is
+    delivered. If the sinks fall
+    behind, the dispatcher's bounded queues hold back the replies too,
+    rather than letting events pile up in memory.
+    """
+    def __init__(self, dispatcher, screen, system_format=None,
+                 metrics=alarm_events.NULL_METRICS):
+        self.dispatcher = dispatcher
+        self.screen = screen
+        self.system_format = system_format
+        self.metrics = metrics
+        # (account, receiver, line) -> (sequence number, data) of the
+        # last frame acknowledged
+        self._sequences = {}
+
+    def _answer(self, kind, message=None):
+        self.metrics.count('alarm_events_dc09_frames_total',
+                           reply=kind.lower())
+        return reply(kind, message)
+
+    def handle(self, data, peer):
+        """Return the reply to one frame from peer."""
+        try:
+            message = parse_frame(data)
+        except FrameError, e:
+            print 'NAK to %s: %s' % (peer[0], e)
+            return self._answer('NAK')
+        if message['id'] == 'NULL':
+            # A link test
+            return self._answer('ACK', message)
+        if message['id'] != 'ADM-CID':
+            return self._answer('DUH', message)
+        try:
+            code = contactid_code(message['acct'], message['data'])
+        except FrameError, e:
+            print 'DUH to %s: %s' % (peer[0], e)
+            return self._answer('DUH', message)
+
+        key = (message['acct'], message['rcvr'], message['pref'])
+        last = (message['seq'], message['data'])
+        if self._sequences.get(key) == last:
+            self.metrics.count('alarm_events_dc09_repeats_total')
+            return self._answer('ACK', message)
+        self._sequences[key] = last
+        event = alarm_events.parse_event_code(code)
+        event.from_ext = 'dc09'
+        event.from_caller = peer[0]
+        event.from_name = 'DC-09'
+        if self.system_format:
+            event.system_format = self.system_format
+        if self.screen.check(event) == self.screen.ACCEPTED:
+            for restore in alarm_events.checkin_monitor().seen(event):
+                self.dispatcher.submit(restore, self._done(restore))
+            self.dispatcher.submit(event, self._done(event))
+        return self._answer('ACK', message)
+
+    @staticmethod
+    def _done(event):
+        def done(errors):
+            if errors:
+                alarm_events.safety_net('Failed to deliver event %s:\n%s' % (
+                    event.raw_event, '\n'.join(errors)))
+        return done
+
+
+class Poller(object):
+    """Run asyncore channels from epoll, where there is one.
+
+    asyncore.loop() asks every channel whether it wants to read or
+    write on every pass, which gets slow with thousands of mostly idle
+    connections. epoll is told once, and update() tells it again only
+    when a channel starts or stops having output to send.
+    """
+    def __init__(self):
+        self.map = {}
+        self._epoll = hasattr(select, 'epoll') and select.epoll() or None
+        self._events = {}
+
+    def update(self, channel):
+        """Watch channel for what it wants to do now."""
+        if self._epoll is None:
+            return
+        fd = channel._fileno
+        if fd not in self.map:
+            self._events.pop(fd, None)
+            return
+        events = select.EPOLLIN
+        if channel.writable():
+            events |= select.EPOLLOUT
+        old = self._events.get(fd)
+        if old == events:
+            return
+        try:
+            if old is None:
+                self._epoll.register(fd, events)
+            else:
+                self._epoll.modify(fd, events)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The fd was closed and reused since we last saw it
+            self._epoll.register(fd, events)
+        self._events[fd] = events
+
+    def close(self, channel):
+        fd = channel._fileno
+        channel.close()
+        self._events.pop(fd, None)
+
+    def poll(self, timeout):
+        if self._epoll is None:
+            asyncore.loop(timeout, use_poll=True, map=self.map, count=1)
+            return
+        try:
+            ready = self._epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        for fd, flags in ready:
+            channel = self.map.get(fd)
+            if channel is None:
+                continue
+            asyncore.readwrite(channel, flags)
+            self.update(channel)
+
+    def close_all(self):
+        asyncore.close_all(self.map)
+        self._events.clear()
+        if self._epoll is not None:
+            self._epoll.close()
+
+
+class _Connection(asyncore.dispatcher_with_send):
+    def __init__(self, sock, peer, server):
+        asyncore.dispatcher_with_send.__init__(self, sock, map=server.map)
+        self.peer = peer
+        self.server = server
+        self.buffer = ''
+        self.seen = time.time()
+
+    def handle_read(self):
+        data = self.recv(4096)
+        self.seen = time.time()
+        self.buffer += data
+        while '\r' in self.buffer:
+            data, _, self.buffer = self.buffer.partition('\r')
+            # Whatever came before the frame's LF is line noise
+            start = data.rfind('\n')
+            if start >= 0:
+                self.send(self.server.receiver.handle(data[start:] + '\r',
+                                                      self.peer))
+        if len(self.buffer) > 4096:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+
+class _TCPListener(asyncore.dispatcher):
+    def __init__(self, server, address, port):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((address, port))
+        self.listen(1024)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.server.poller.update(
+                _Connection(pair[0], pair[1], self.server))
+
+
+class _UDPListener(asyncore.dispatcher):
+    def __init__(self, server, address, port):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.bind((address, port))
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data, peer = self.socket.recvfrom(2048)
+        try:
+            self.socket.sendto(self.server.receiver.handle(data, peer), peer)
+        except socket.error:
+            # The panel will send it again
+            pass
+
+
+class DC09Server(object):
+    """Listen for DC-09 frames on a TCP port and the same UDP port.
+
+    Every connection is served from one Poller, so thousands of panels
+    can stay connected. TCP connections idle for longer than
+    idle_timeout are closed by sweep().
+    """
+    def __init__(self, receiver, port, address='', udp=True,
+                 idle_timeout=300):
+        self.receiver = receiver
+        self.idle_timeout = idle_timeout
+        self.poller = Poller()
+        self.map = self.poller.map
+        self.tcp = _TCPListener(self, address, port)
+        self.port = self.tcp.socket.getsockname()[1]
+        self.udp = udp and _UDPListener(self, address, self.port) or None
+        for channel in (self.tcp, self.udp):
+            if channel:
+                self.poller.update(channel)
+
+    def poll(self, timeout):
+        self.poller.poll(timeout)
+
+    def connections(self):
+        return [channel for channel in self.map.values()
+                if isinstance(channel, _Connection)]
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        for connection in self.connections():
+            if now - connection.seen > self.idle_timeout:
+                self.poller.close(connection)
+
+    def close(self):
+        self.poller.close_all()
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit does."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(port, address, udp=True):
+    raise_file_limit()
+    collected = alarm_events.metrics()
+    screen = alarm_events.EventScreen.from_config()
+    dispatcher = alarm_events.Dispatcher.from_config()
+    receiver = Receiver(dispatcher, screen,
+                        alarm_events.spool_settings()[1], collected)
+    server = DC09Server(receiver, port, address, udp,
+                        alarm_events.general_option('dc09_idle_timeout',
+                                                    300, 'getfloat'))
+    state = {'running': True}
+
+    def _stop(signum, frame):
+        state['running'] = False
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    alarm_events.state_queue().start()
+    print 'Listening for DC-09 on port %i' % server.port
+    sys.stdout.flush()
+    next_chores = next_metrics = 0
+    try:
+        while state['running']:
+            server.poll(1.0)
+            if time.time() < next_chores:
+                continue
+            next_chores = time.time() + 1
+            server.sweep()
+            alarm_events.raise_missed_checkins(dispatcher,
+                                               done=receiver._done)
+            screen.save()
+            if getattr(alarm_events.CONFIG, '_alarm_panel_state', None):
+                alarm_events.panel_states().save()
+            if getattr(alarm_events.CONFIG, '_alarm_log', None):
+                alarm_events.event_log().flush()
+            if time.time() >= next_metrics:
+                collected.gauge('alarm_events_dc09_connections',
+                                len(server.connections()))
+                collected.save()
+                alarm_events.checkin_monitor().save()
+                next_metrics = time.time() + 15
+    finally:
+        server.close()
+        dispatcher.close()
+        screen.save()
+        alarm_events.close_sinks()
+        collected.save()
+        collected.report()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Receive SIA DC-09 (ADM-CID) alarm reports over IP')
+    parser.add_argument('config', help='Path to the config file')
+    parser.add_argument('--port', type=int,
+                        help='TCP and UDP port (default: dc09_port, or 7001)')
+    parser.add_argument('--address',
+                        help='Address to listen on (default: dc09_address, '
+                             'or all)')
+    parser.add_argument('--no-udp', action='store_true',
+                        help='Only listen on TCP')
+    args = parser.parse_args(argv)
+    alarm_events.load_config(args.config)
+    port = args.port
+    if port is None:
+        port = alarm_events.general_option('dc09_port', 7001, 'getint')
+    address = args.address
+    if address is None:
+        address = alarm_events.general_option('dc09_address', '')
+    serve(port, address, not args.no_udp)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+"""Watch check-ins from tens of thousands of systems.
+
+Writes a config whose systems all have checkin_interval set, feeds the
+CheckInMonitor an event from each of them and then a steady stream of
+periodic tests, and times seen(), check() while nothing is overdue
+(as the daemon calls it on every pass) and check() when a batch of
+systems has gone quiet. "scan" finds the overdue systems by looking
+at every one in turn, as a straightforward implementation would; the
+monitor's time per check should stay flat as the number of systems
+grows. Then times, against the shared files, a load of everything
+(as a run does when a check-in is due), noting one event from a
+forked run (which only appends to a log) and alarm_eventcmd.py's look
+at the next due time.
+
+  python bench/bench_checkins.py [systems] [checks]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_eventcmd
+import alarm_events
+
+
+INTERVAL = 3600
+
+
+def write_config(path, spool, systems):
+    with open(path, 'w') as f:
+        # Accounts have four digits; tell the systems apart by extension
+        f.write('[general]\nspool_dir = %s\nemail_from = bench@localhost\n'
+                'system_format = %%(from_ext)s\n' % spool)
+        for system in range(systems):
+            f.write('\n[%i]\nname = System %i\nemail = bench@localhost\n'
+                    'checkin_interval = %i\n' % (10000 + system, system,
+                                                 INTERVAL))
+
+
+def test_report(system):
+    code = '123418160201000'
+    event = alarm_events.parse_event_code(
+        code + alarm_events.checksum_digit(code))
+    event.system_format = '%(from_ext)s'
+    event.from_ext = str(system)
+    return event
+
+
+def scan(monitor, now):
+    """Look at every system to find the ones that are overdue."""
+    overdue = []
+    for system, record in monitor._systems.iteritems():
+        if not record[1] and monitor._deadline(system, record[0]) <= now:
+            overdue.append(system)
+    return overdue
+
+
+def main():
+    systems = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    checks = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    workdir = tempfile.mkdtemp()
+    try:
+        spool = os.path.join(workdir, 'spool')
+        os.makedirs(spool)
+        config = os.path.join(workdir, 'checkins.config')
+        write_config(config, spool, systems)
+        alarm_events.load_config(config)
+        rng = random.Random(0)
+        events = [test_report(10000 + i) for i in range(systems)]
+        start = 1000000.0
+
+        monitor = alarm_events.CheckInMonitor()
+        began = time.time()
+        for i, event in enumerate(events):
+            monitor.seen(event, now=start + i * INTERVAL / float(systems))
+        first_time = time.time() - began
+        now = start + INTERVAL
+        stream = [rng.choice(events) for _ in range(checks * 10)]
+        began = time.time()
+        for event in stream:
+            monitor.seen(event, now=now)
+        seen_time = time.time() - began
+
+        began = time.time()
+        for _ in range(checks):
+            assert not monitor.check(now)
+        check_time = time.time() - began
+        began = time.time()
+        for _ in range(checks):
+            assert not scan(monitor, now)
+        scan_time = time.time() - began
+        print '%i systems: seen %.2fus/event (first %.2fus), heap %i' % (
+            systems, 1e6 * seen_time / len(stream),
+            1e6 * first_time / systems, len(monitor._heap))
+        print 'nothing due: check %8.2fus  scan %10.2fus' % (
+            1e6 * check_time / checks, 1e6 * scan_time / checks)
+
+        # Later, the first tenth of those not heard from since go quiet
+        later = now + INTERVAL * 0.2
+        expected = len(scan(monitor, later))
+        began = time.time()
+        missed = monitor.check(later)
+        batch_time = time.time() - began
+        assert len(missed) == expected
+        print '%i overdue: check %.2fms' % (len(missed), 1000 * batch_time)
+
+        path = alarm_events.state_path(alarm_events.checkin_file())
+        stored = alarm_events.CheckInMonitor(path)
+        stored._systems = monitor._systems
+        stored._heap = monitor._heap
+        stored._dirty = True
+        began = time.time()
+        stored.save()
+        save_time = time.time() - began
+        print 'file: %i bytes, save %.2fms' % (os.path.getsize(path),
+                                               1000 * save_time)
+        samples = []
+        for _ in range(20):
+            began = time.time()
+            alarm_events.CheckInMonitor(path).next_due()
+            samples.append(time.time() - began)
+        common.summarize('load', samples)
+        samples = []
+        for event in stream[:200]:
+            began = time.time()
+            alarm_events.CheckInMonitor(path).seen(event)
+            samples.append(time.time() - began)
+        common.summarize('forked seen', samples)
+        samples = []
+        for _ in range(200):
+            began = time.time()
+            alarm_eventcmd.idle(config)
+            samples.append(time.time() - began)
+        common.summarize('eventcmd', samples)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
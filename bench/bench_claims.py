@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""Many concurrent runs draining one spool, as when panels call at once.
+
+Spools a backlog of distinct events and starts several alarm_events
+runs against it at the same moment. Each run records what it mailed;
+the script checks that every event was delivered exactly once and
+shows how the runs shared the work.
+
+  python bench/bench_claims.py [files] [workers]
+"""
+
+import collections
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+WORKER = """
+import os, sys
+import alarm_events
+alarm_events.load_config(sys.argv[1])
+fd = os.open(sys.argv[2], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+def mail_event(event):
+    os.write(fd, '%i %s\\n' % (os.getpid(), event.from_name))
+alarm_events.mail_event = mail_event
+alarm_events.main()
+"""
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    workdir = tempfile.mkdtemp()
+    try:
+        config, spool = common.make_config(workdir)
+        code = '987618113001001'
+        code += alarm_events.checksum_digit(code)
+        for i in range(count):
+            common.spool_event(spool, code, name='Caller %i' % i)
+        delivered = os.path.join(workdir, 'delivered')
+        env = dict(os.environ, HOME=workdir, PYTHONPATH=common.ROOT)
+        start = time.time()
+        procs = [subprocess.Popen([sys.executable, '-c', WORKER, config,
+                                   delivered], env=env,
+                                  stdout=open(os.devnull, 'w'))
+                 for i in range(workers)]
+        for proc in procs:
+            proc.wait()
+        elapsed = time.time() - start
+
+        per_worker = collections.Counter()
+        per_event = collections.Counter()
+        with open(delivered) as f:
+            for line in f:
+                pid, name = line.rstrip('\n').split(' ', 1)
+                per_worker[pid] += 1
+                per_event[name] += 1
+        repeats = sum(n - 1 for n in per_event.values() if n > 1)
+        print '%i files, %i runs: %.2fs' % (count, workers, elapsed)
+        print 'delivered %i distinct, %i missing, %i delivered twice' % (
+            len(per_event), count - len(per_event), repeats)
+        print 'files per run: %s' % ' '.join(
+            str(n) for n in sorted(per_worker.values(), reverse=True))
+        print 'left in spool: %s' % (os.listdir(spool) or 'nothing')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+"""Format events against a large config, with and without the index.
+
+Builds a config with many systems, hundreds of zones and users each,
+then renders str() and dump() for a stream of events. "before" replays
+the old per-access ConfigParser lookups via a legacy Event subclass.
+Also times load_config() with a cold and a warm on-disk cache.
+
+  python bench/bench_config_index.py [events] [zones]
+"""
+
+import ConfigParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+class LegacyEvent(alarm_events.Event):
+    """Event with the pre-index property implementations."""
+    @property
+    def system_name(self):
+        return alarm_events.CONFIG.get(self.system, 'name')
+
+    @property
+    def zone(self):
+        try:
+            return alarm_events.CONFIG.get(self.system,
+                                           'zone_%i' % self.zone_number)
+        except ConfigParser.NoOptionError:
+            return 'Zone %i' % self.zone_number
+
+    @property
+    def user(self):
+        if self.zone_number == 98:
+            return 'keypad user'
+        try:
+            return alarm_events.CONFIG.get(self.system,
+                                           'user_%i' % self.zone_number)
+        except ConfigParser.NoOptionError:
+            return 'User %i' % self.zone_number
+
+
+def write_config(path, systems, zones):
+    with open(path, 'w') as f:
+        f.write('[general]\nspool_dir = /tmp\n'
+                'email_from = bench@localhost\n')
+        for system in range(systems):
+            f.write('\n[%i]\nname = System %i\nemail = bench@localhost\n'
+                    'nomail_events = 570\ntype = networx\n' % (
+                        1000 + system, system))
+            for n in range(1, zones + 1):
+                f.write('zone_%i = Zone label %i\n' % (n, n))
+            for n in range(1, zones / 2 + 1):
+                f.write('user_%i = User name %i\n' % (n, n))
+
+
+def make_codes(count, systems, zones):
+    rand = random.Random(42)
+    codes = []
+    for i in range(count):
+        account = 1000 + rand.randrange(systems)
+        event = rand.choice([130, 301, 333, 401, 570, 602])
+        # Include a share of numbers that miss the config entirely
+        zone = rand.randrange(1, zones + zones / 4)
+        codes.append('%04i18%i%03i01%03i_' % (
+            account, rand.choice([1, 3]), event, zone))
+    return codes
+
+
+def render(cls, codes):
+    records = alarm_events.parse_event_codes(codes, verify_checksum=False)
+    start = time.time()
+    for record in records:
+        event = cls.from_record(record)
+        str(event)
+        event.dump()
+    return time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    zones = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    systems = 20
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, 'big.config')
+        write_config(path, systems, zones)
+        cache = os.path.join(workdir, '.big.config.cache')
+
+        start = time.time()
+        alarm_events.load_config(path)
+        cold = time.time() - start
+        start = time.time()
+        alarm_events.load_config(path)
+        warm = time.time() - start
+        print 'load_config: parse+compile %.1fms, cached %.1fms (%ik cache)' % (
+            cold * 1000, warm * 1000, os.path.getsize(cache) / 1024)
+
+        codes = make_codes(count, systems, zones)
+        for label, cls in [('before', LegacyEvent),
+                           ('indexed', alarm_events.Event)]:
+            elapsed = render(cls, codes)
+            print '%-8s %i events in %.3fs: %.1fus/event' % (
+                label, count, elapsed, elapsed * 1e6 / count)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
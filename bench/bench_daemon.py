@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""Per-event latency from spool file creation to dispatch.
+
+Compares the classic mode, where alarmreceiver forks alarm_events.py
+for every call, with a resident --daemon watching the spool. An event
+counts as dispatched when its line shows up in the security log.
+
+  python bench/bench_daemon.py [count]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+
+def log_lines(home):
+    try:
+        with open(os.path.join(home, '9876-security.log')) as f:
+            return sum(1 for _ in f)
+    except IOError:
+        return 0
+
+
+def bench_fork(count, workdir, env):
+    config, spool = common.make_config(workdir)
+    samples = []
+    for i in range(count):
+        start = time.time()
+        common.spool_event(spool, '987618340103001B')
+        subprocess.check_call([sys.executable, common.SCRIPT, config],
+                              env=env)
+        assert log_lines(env['HOME']) == i + 1
+        samples.append(time.time() - start)
+    return samples
+
+
+def bench_daemon(count, workdir, env, poll=False):
+    config, spool = common.make_config(workdir)
+    args = [sys.executable, common.SCRIPT, config, '--daemon',
+            '--poll-interval', '0.05']
+    if poll:
+        args.append('--no-inotify')
+    daemon = subprocess.Popen(args, env=env)
+    try:
+        time.sleep(1.0)
+        samples = []
+        for i in range(count):
+            start = time.time()
+            common.spool_event(spool, '987618340103001B')
+            if not common.wait_for(lambda: log_lines(env['HOME']) > i):
+                raise Exception('Daemon did not dispatch event %i' % i)
+            samples.append(time.time() - start)
+        return samples
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for label, func, kwargs in [('fork', bench_fork, {}),
+                                ('daemon', bench_daemon, {}),
+                                ('daemon-poll', bench_daemon,
+                                 {'poll': True})]:
+        workdir = tempfile.mkdtemp()
+        try:
+            env = dict(os.environ, HOME=workdir)
+            samples = func(count, workdir, env, **kwargs)
+        finally:
+            shutil.rmtree(workdir)
+        common.summarize(label, samples)
+
+
+if __name__ == '__main__':
+    main()
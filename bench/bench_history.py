@@ -0,0 +1,100 @@
+#!/usr/bin/python
+"""Time history queries over a large synthetic event store.
+
+Fills an EventStore with a year of events spread over many accounts
+and zones, then times the common questions with the indexes and, for
+comparison, as full scans (what grepping the security logs amounts
+to).
+
+  python bench/bench_history.py [events] [accounts]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_history
+
+
+CODES = [130, 131, 134, 301, 302, 350, 401, 570, 602]
+QUERIES = [
+    ('last open of a zone', 'last',
+     dict(account=1042, zone=5, event_code=134)),
+    ('zone 5, one day', 'count',
+     dict(zone=5, start=-86400)),
+    ('account, one week', 'count',
+     dict(account=1042, start=-7 * 86400)),
+    ('alarms, one day', 'count',
+     dict(event_class=1, start=-86400)),
+    ('code 302, 30 days', 'count',
+     dict(event_code=302, start=-30 * 86400)),
+]
+
+
+def fill(store, count, accounts, now):
+    rand = random.Random(42)
+    rows = []
+    start = time.time()
+    for i in range(count):
+        rows.append((now - rand.random() * 365 * 86400,
+                     1000 + rand.randrange(accounts), None,
+                     rand.choice(CODES), 1, 1, rand.randrange(1, 65),
+                     None, None))
+        if len(rows) == 50000:
+            store.add_rows(rows)
+            rows = []
+    store.add_rows(rows)
+    return time.time() - start
+
+
+def timed(fn, repeat=20):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def scan(store, kwargs):
+    where, args = store._where(kwargs.get('start'), None,
+                               kwargs.get('account'), kwargs.get('zone'),
+                               kwargs.get('event_code'),
+                               kwargs.get('event_class'))
+    with store._lock:
+        return store._db.execute('SELECT COUNT(*) FROM events NOT INDEXED' +
+                                 where, args).fetchone()[0]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    workdir = tempfile.mkdtemp()
+    try:
+        store = alarm_history.EventStore(os.path.join(workdir, 'h.db'))
+        now = time.time()
+        elapsed = fill(store, count, accounts, now)
+        print 'inserted %i events: %.1fs, %.1fus/event, %.0f MB' % (
+            count, elapsed, elapsed * 1e6 / count,
+            os.path.getsize(store.path) / 1e6)
+        for label, method, kwargs in QUERIES:
+            kwargs = dict(kwargs)
+            if 'start' in kwargs:
+                kwargs['start'] += now
+            indexed = timed(lambda: getattr(store, method)(**kwargs))
+            full = timed(lambda: scan(store, kwargs), repeat=2)
+            print '%-22s indexed %8.3fms  full scan %8.1fms' % (
+                label, indexed * 1000, full * 1000)
+        store.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
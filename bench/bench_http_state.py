@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""Connections and requests per event for update_state().
+
+Runs update_state() against a local stand-in post_url server with the
+stock urllib2 opener (a new connection per request), with the
+keep-alive handler, and with post_batch. The "post-only" server
+answers PUT with 405, which shows the cost of the PUT->POST fallback
+with and without the per-endpoint method memory.
+
+  python bench/bench_http_state.py [events]
+"""
+
+import ConfigParser
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+
+import common
+import standins
+
+import alarm_events
+
+CODES = ['987618340103001_', '987618140103001_', '987618113003001_',
+         '987618057003002_', '987618130100000_']
+
+
+class _NoMemory(dict):
+    """Stands in for _STATE_METHODS to replay the old retry-every-time."""
+    def __setitem__(self, key, value):
+        pass
+
+
+def run(label, server, opener, workdir, batch=False, forget_methods=False,
+        count=200):
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('general')
+    cfg.set('general', 'spool_dir', workdir)
+    cfg.add_section('9876')
+    cfg.set('9876', 'name', 'Bench')
+    cfg.set('9876', 'zone_1', 'Front Door')
+    cfg.set('9876', 'user_1', 'Master')
+    cfg.set('9876', 'post_url', server.url + '/alarm')
+    if batch:
+        cfg.set('9876', 'post_batch', 'yes')
+    alarm_events.CONFIG = cfg
+    if forget_methods:
+        alarm_events._STATE_METHODS = _NoMemory()
+    else:
+        alarm_events._STATE_METHODS = {}
+    urllib2.install_opener(opener)
+    server.reset()
+
+    events = [alarm_events.parse_event_code(CODES[i % len(CODES)])
+              for i in range(count)]
+    start = time.time()
+    for event in events:
+        alarm_events.update_state(event)
+    elapsed = time.time() - start
+    print '%-28s conns/event=%5.2f reqs/event=%5.2f %8.0f events/s' % (
+        label, float(server.connections) / count,
+        float(len(server.requests)) / count, count / elapsed)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # Install alarm_events' own opener now, so that it does not replace
+    # the ones run() installs
+    alarm_events.http_handler()
+    plain = urllib2.build_opener()
+    handler = alarm_events.keepalive_handler()
+    keepalive = urllib2.build_opener(handler)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        server = standins.StateServer()
+        run('before (urllib2)', server, plain, workdir, count=count)
+        run('keep-alive', server, keepalive, workdir, count=count)
+        run('keep-alive + batch', server, keepalive, workdir, batch=True,
+            count=count)
+        handler.close_all()
+        server.stop()
+
+        server = standins.StateServer(reject_methods=['PUT'])
+        run('post-only, before', server, plain, workdir,
+            forget_methods=True, count=count)
+        run('post-only, keep-alive', server, keepalive, workdir, count=count)
+        handler.close_all()
+        server.stop()
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+"""Write a replayed backlog through log_event().
+
+Compares the original open/append/close-per-event writer with
+EventLog keeping handles open, flushing every line and every 100.
+The cost of rendering each line, which all writers share, is shown
+separately.
+
+  python bench/bench_log.py [events] [accounts]
+"""
+
+import ConfigParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+def legacy_log_event(event, directory):
+    filename = os.path.join(directory, '%s-security.log' % event.account)
+    line = '%s: %s' % (time.strftime('%Y-%m-%dT%H:%M:%S'), str(event))
+    with file(filename, 'a') as f:
+        f.write(line + '\n')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    accounts = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('general')
+    for account in range(accounts):
+        cfg.add_section(str(1000 + account))
+        cfg.set(str(1000 + account), 'name', 'System %i' % account)
+    alarm_events.CONFIG = cfg
+
+    codes = []
+    for i in range(count):
+        code = '%04i18140101%03i' % (1000 + i % accounts, i % 50)
+        codes.append(code + alarm_events.checksum_digit(code))
+    events = [alarm_events.Event.from_record(r)
+              for r in alarm_events.parse_event_codes(codes)]
+
+    # Rendering the line is common to all writers; time it on its own
+    runs = [('render only', lambda d: str),
+            ('open/close', lambda d: (lambda e: legacy_log_event(e, d))),
+            ('kept open', lambda d: alarm_events.EventLog(d).write),
+            ('flush 100', lambda d: alarm_events.EventLog(
+                d, flush_lines=100).write),
+            ('flush+fsync 100', lambda d: alarm_events.EventLog(
+                d, flush_lines=100, fsync=True).write)]
+    for label, make in runs:
+        workdir = tempfile.mkdtemp()
+        try:
+            write = make(workdir)
+            start = time.time()
+            for event in events:
+                write(event)
+            if hasattr(write, '__self__'):
+                write.__self__.close()
+            elapsed = time.time() - start
+        finally:
+            shutil.rmtree(workdir)
+        print '%-16s %i events: %.2fs, %.1fus/event' % (
+            label, count, elapsed, elapsed * 1e6 / count)
+
+
+if __name__ == '__main__':
+    main()
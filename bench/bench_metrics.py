@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""Cost of the metrics instrumentation, off and on.
+
+Drains the same spool with main() with metrics off and on (sinks are
+no-op counters, so the pipeline itself dominates), and reads one large
+multi-event file, the tightest instrumented loop, both ways.
+
+  python bench/bench_metrics.py [files] [events-per-big-file]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+def _sink(name):
+    def sink(event):
+        pass
+    sink.__name__ = name
+    return sink
+
+
+def drain(count, enabled):
+    workdir = tempfile.mkdtemp()
+    try:
+        general = enabled and 'metrics = yes' or ''
+        config, spool = common.make_config(workdir, general=general)
+        alarm_events.load_config(config)
+        code = '987618113001001'
+        code += alarm_events.checksum_digit(code)
+        for i in range(count):
+            common.spool_event(spool, code)
+        start = time.time()
+        with open(os.devnull, 'w') as sys.stderr:
+            alarm_events.main()
+        sys.stderr = sys.__stderr__
+        return time.time() - start
+    finally:
+        shutil.rmtree(workdir)
+
+
+def read_big(events, enabled, repeat=5):
+    workdir = tempfile.mkdtemp()
+    try:
+        general = enabled and 'metrics = yes' or ''
+        config, spool = common.make_config(workdir, general=general)
+        alarm_events.load_config(config)
+        code = '987618113001001'
+        code += alarm_events.checksum_digit(code)
+        path = os.path.join(workdir, 'big')
+        with open(path, 'w') as f:
+            f.write('[metadata]\nCALLINGFROM=1\n[events]\n')
+            f.write((code + '\n') * events)
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            for event in alarm_events.read_spool_file(path):
+                pass
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    events = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    for name in ('mail_event', 'log_event', 'update_state', 'store_event'):
+        setattr(alarm_events, name, _sink(name))
+    # Alternate off and on runs and keep the best of each, as the
+    # dispatcher's threads make single runs noisy
+    results = {False: [], True: []}
+    for i in range(3):
+        for enabled in (False, True):
+            results[enabled].append(drain(count, enabled))
+    for enabled in (False, True):
+        best = min(results[enabled])
+        print 'main(), metrics %-3s %i files: %.2fs, %.0fus/file' % (
+            enabled and 'on' or 'off', count, best, best * 1e6 / count)
+    print '  overhead when on: %+.1f%%' % (
+        100 * (min(results[True]) / min(results[False]) - 1))
+
+    results = {False: [], True: []}
+    for i in range(3):
+        for enabled in (False, True):
+            results[enabled].append(read_big(events, enabled))
+    for enabled in (False, True):
+        best = min(results[enabled])
+        print 'read, metrics %-3s %i events: %.3fs, %.2fus/event' % (
+            enabled and 'on' or 'off', events, best, best * 1e6 / events)
+    print '  overhead when on: %+.1f%%' % (
+        100 * (min(results[True]) / min(results[False]) - 1))
+
+    # What instrumentation costs when off, per call
+    calls = 1000000
+    null = alarm_events.NULL_METRICS
+    start = time.time()
+    for i in xrange(calls):
+        null.observe('x', time.time() - start)
+    print 'disabled observe() with its timing: %.3fus/call' % (
+        (time.time() - start) * 1e6 / calls)
+
+
+if __name__ == '__main__':
+    main()
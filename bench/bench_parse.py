@@ -0,0 +1,116 @@
+#!/usr/bin/python
+"""Parse a large batch of ContactID codes.
+
+Compares the original dict-backed Event built by slicing each code,
+parse_event_code() into the slotted Event, and the bulk
+parse_event_codes() into EventRecord tuples (with checksums verified).
+Then reads the same codes from a spool file, as delivery does, one
+code at a time and with read_spool_file(), which parses in batches.
+
+  python bench/bench_parse.py [count]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+class LegacyEvent:
+    def __init__(self, **kwargs):
+        self.system_format = '%(account)s'
+        self.partition = 0
+        self.from_ext = '?'
+        self.from_caller = '?'
+        self.account = 0
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+def legacy_parse(event_code):
+    event = LegacyEvent()
+    event.account = int(event_code[0:4])
+    event.qualifier = int(event_code[6])
+    event.event_code = int(event_code[7:10])
+    event.partition = int(event_code[10:12])
+    event.zone_number = int(event_code[12:15])
+    event.raw_event = event_code
+    return event
+
+
+def make_codes(count):
+    rand = random.Random(7)
+    codes = []
+    for _ in range(count):
+        prefix = '%04i18%i%03i%02i%03i' % (
+            rand.randrange(10000), rand.choice([1, 3, 6]),
+            rand.choice([130, 301, 381, 401, 570, 602]),
+            rand.randrange(1, 9), rand.randrange(1, 200))
+        codes.append(prefix + alarm_events.checksum_digit(prefix))
+    return codes
+
+
+def size_of(obj):
+    size = sys.getsizeof(obj)
+    if not isinstance(obj, tuple) and hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    codes = make_codes(count)
+    blob = '\n'.join(codes)
+
+    runs = [('legacy', lambda: [legacy_parse(c) for c in codes]),
+            ('per-code', lambda: [alarm_events.parse_event_code(c)
+                                  for c in codes]),
+            ('bulk', lambda: alarm_events.parse_event_codes(blob))]
+    for label, func in runs:
+        start = time.time()
+        parsed = func()
+        elapsed = time.time() - start
+        assert len(parsed) == count
+        print '%-9s %i codes in %.2fs: %7.0f codes/s, %i bytes/object' % (
+            label, count, elapsed, count / elapsed, size_of(parsed[0]))
+        del parsed
+
+    workdir = tempfile.mkdtemp()
+    try:
+        alarm_events.load_config(common.make_config(workdir)[0])
+        path = os.path.join(workdir, 'event-1')
+        with open(path, 'w') as f:
+            f.write('[metadata]\n\nCALLINGFROM=1\n\n[events]\n\n%s\n' % blob)
+
+        def per_code():
+            """read_spool_file() as it was, before batching."""
+            events = []
+            with open(path) as f:
+                for metadata, code in alarm_events.iter_spool_records(f):
+                    event = alarm_events.parse_event_code(code)
+                    event.metadata = metadata
+                    event.from_ext = metadata.get('CALLINGFROM')
+                    event.from_name = metadata.get('CALLERNAME')
+                    events.append(event)
+            return events
+        runs = [('spool per-code', per_code),
+                ('spool batched',
+                 lambda: list(alarm_events.read_spool_file(path)))]
+        for label, func in runs:
+            start = time.time()
+            assert len(func()) == count
+            elapsed = time.time() - start
+            print '%-14s %i codes in %.2fs: %7.0f codes/s' % (
+                label, count, elapsed, count / elapsed)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+"""Throughput, latency and memory of the whole pipeline under load.
+
+Synthesizes alarmreceiver spool files the way a busy receiver sees
+them: many accounts and zones, a realistic mix of alarms (1xx),
+troubles (3xx), openings and closings (4xx), bypasses (5xx) and test
+reports (6xx), calls carrying several events, and panels retransmitting
+calls whose kissoff they missed. alarm_events.py then delivers them to
+local stand-in SMTP and post_url servers.
+
+In backlog mode the files are spooled first and drained by one run, as
+after an outage; latency counts from the start of that run. In daemon
+mode the calls arrive at --rate per second while a --daemon watches the
+spool; latency counts from each file landing in the spool.
+
+Every run is appended to bench/results/pipeline.jsonl with the git
+revision it ran against and compared with the last run of the same
+scenario, so that regressions show up between versions.
+
+  python bench/bench_pipeline.py [--mode backlog|daemon] [--calls N] ...
+  python bench/bench_pipeline.py --history
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import standins
+
+import alarm_events
+
+
+RESULTS = os.path.join(common.HERE, 'results', 'pipeline.jsonl')
+
+# Runs alarm_events in the child, noting when each spool file is done
+DRIVER = """
+import os, sys, time
+import alarm_events
+alarm_events.load_config(sys.argv[1])
+fd = os.open(sys.argv[2], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+finish = alarm_events.finish_spool_file
+def finish_spool_file(ticket):
+    finish(ticket)
+    os.write(fd, '%s %.6f %i\\n' % (os.path.basename(ticket.filename),
+                                    time.time(), len(ticket.errors)))
+alarm_events.finish_spool_file = finish_spool_file
+if sys.argv[3] == 'daemon':
+    alarm_events.daemon_main(0.05)
+else:
+    alarm_events.main()
+"""
+
+# (weight, event codes, qualifiers, what the zone field holds)
+MIX = [
+    (5, (130, 131, 134), (1, 3), 'zone'),
+    (20, (301, 302, 333, 383), (1, 3), 'zone'),
+    (40, (401, 403), (1, 3), 'user'),
+    (10, (570,), (1, 3), 'zone'),
+    (25, (602,), (1,), None),
+]
+
+GENERAL = """[general]
+spool_dir = %(spool)s
+email_from = Alarm System <bench@localhost>
+safety_net_email = bench@localhost
+system_format = %%(account)s
+smtp_host = 127.0.0.1
+smtp_port = %(smtp_port)i
+smtp_retries = 0
+log_dir = %(workdir)s/logs
+dedup_window = 60
+%(general)s
+"""
+
+SYSTEM = """
+[%(account)s]
+name = Bench System %(account)s
+email = bench-%(account)s@localhost
+nomail_events = 602
+post_url = %(post_url)s/%(account)s/
+%(labels)s
+"""
+
+
+def make_config(workdir, accounts, zones, smtp_port, post_url, general):
+    spool = os.path.join(workdir, 'spool')
+    os.makedirs(spool)
+    os.makedirs(os.path.join(workdir, 'logs'))
+    labels = '\n'.join(['zone_%i = Zone %i' % (i, i)
+                        for i in range(1, zones + 1)] +
+                       ['user_%i = User %i' % (i, i) for i in range(1, 9)])
+    path = os.path.join(workdir, 'bench.config')
+    with open(path, 'w') as f:
+        f.write(GENERAL % {'spool': spool, 'smtp_port': smtp_port,
+                           'workdir': workdir, 'general': general})
+        for account in account_numbers(accounts):
+            f.write(SYSTEM % {'account': account, 'post_url': post_url,
+                              'labels': labels})
+    return path, spool
+
+
+def account_numbers(accounts):
+    return ['%04i' % (1000 + i) for i in range(accounts)]
+
+
+def make_event(rng, account, zones):
+    total = sum(weight for weight, _, _, _ in MIX)
+    pick = rng.uniform(0, total)
+    for weight, codes, qualifiers, field in MIX:
+        pick -= weight
+        if pick <= 0:
+            break
+    if field == 'zone':
+        zone = rng.randint(1, zones)
+    elif field == 'user':
+        zone = rng.randint(1, 8)
+    else:
+        zone = 0
+    code = '%s18%i%03i%02i%03i' % (account, rng.choice(qualifiers),
+                                   rng.choice(codes), 1, zone)
+    return code + alarm_events.checksum_digit(code)
+
+
+def synthesize(calls, accounts, zones, retransmit, multi, seed):
+    """Return the calls to spool, as (extension, event codes) pairs.
+
+    A call carries one event, or with probability multi several; with
+    probability retransmit it is repeated a few calls later, as a panel
+    does when it misses the kissoff.
+    """
+    rng = random.Random(seed)
+    numbers = account_numbers(accounts)
+    plan = []
+    resends = {}
+    while len(plan) < calls:
+        position = len(plan)
+        if position in resends:
+            plan.append(resends.pop(position))
+            continue
+        account = rng.choice(numbers)
+        count = rng.random() < multi and rng.randint(2, 6) or 1
+        call = (account, [make_event(rng, account, zones)
+                          for _ in range(count)])
+        plan.append(call)
+        if rng.random() < retransmit:
+            resends.setdefault(position + rng.randint(1, 5), call)
+    return plan
+
+
+def read_done(path):
+    done = {}
+    errors = 0
+    if not os.path.exists(path):
+        return done, errors
+    with open(path) as f:
+        for line in f:
+            name, when, failed = line.split()
+            done[name] = float(when)
+            errors += int(failed)
+    return done, errors
+
+
+def wait_child(proc):
+    """Reap proc and return its peak resident set size in KiB."""
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    return usage.ru_maxrss
+
+
+def run_backlog(plan, config, spool, done_path, env):
+    spooled = {}
+    for ext, codes in plan:
+        name = os.path.basename(common.spool_call(spool, codes, ext))
+        spooled[name] = len(codes)
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', DRIVER, config,
+                             done_path, 'backlog'], env=env,
+                            stdout=open(os.devnull, 'w'))
+    rss = wait_child(proc)
+    done, errors = read_done(done_path)
+    latencies = [done[name] - start for name in spooled if name in done]
+    elapsed = max(done.values() or [time.time()]) - start
+    return spooled, done, errors, latencies, elapsed, rss
+
+
+def run_daemon(plan, config, spool, done_path, env, rate):
+    proc = subprocess.Popen([sys.executable, '-c', DRIVER, config,
+                             done_path, 'daemon'], env=env,
+                            stdout=open(os.devnull, 'w'))
+    try:
+        time.sleep(1.0)
+        spooled = {}
+        created = {}
+        start = time.time()
+        for i, (ext, codes) in enumerate(plan):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            name = os.path.basename(common.spool_call(spool, codes, ext))
+            created[name] = time.time()
+            spooled[name] = len(codes)
+        common.wait_for(lambda: len(read_done(done_path)[0]) >= len(plan),
+                        timeout=60 + len(plan) / 100.0, interval=0.05)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        rss = wait_child(proc)
+    done, errors = read_done(done_path)
+    latencies = [done[name] - created[name] for name in spooled
+                 if name in done]
+    elapsed = max(done.values() or [time.time()]) - start
+    return spooled, done, errors, latencies, elapsed, rss
+
+
+def revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short',
+                                       'HEAD'], cwd=common.ROOT).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--',
+                                 '*.py'], cwd=common.ROOT)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return dirty and rev + '-dirty' or rev
+
+
+def scenario(args):
+    name = '%s calls=%i accounts=%i zones=%i retransmit=%g multi=%g' % (
+        args.mode, args.calls, args.accounts, args.zones, args.retransmit,
+        args.multi)
+    if args.mode == 'daemon':
+        name += ' rate=%g' % args.rate
+    if args.general:
+        name += ' ' + ' '.join(args.general)
+    return name
+
+
+def load_results():
+    if not os.path.exists(RESULTS):
+        return []
+    with open(RESULTS) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def store_result(result):
+    if not os.path.isdir(os.path.dirname(RESULTS)):
+        os.makedirs(os.path.dirname(RESULTS))
+    with open(RESULTS, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def format_result(result):
+    return ('%(revision)-14s %(events_per_sec)9.1f ev/s '
+            'p50=%(p50_ms)8.2fms p99=%(p99_ms)8.2fms '
+            'rss=%(max_rss_kb)7iKiB' % result)
+
+
+def compare(result, previous):
+    print 'previous:', format_result(previous)
+    for key, label, higher_is_better in [
+            ('events_per_sec', 'throughput', True),
+            ('p50_ms', 'p50 latency', False),
+            ('p99_ms', 'p99 latency', False),
+            ('max_rss_kb', 'peak memory', False)]:
+        if not previous[key]:
+            continue
+        change = 100.0 * (result[key] - previous[key]) / previous[key]
+        worse = change < 0 if higher_is_better else change > 0
+        print '  %-12s %+7.1f%%%s' % (label, change,
+                                      worse and abs(change) >= 10 and
+                                      '  <-- regression?' or '')
+
+
+def show_history():
+    by_scenario = {}
+    for result in load_results():
+        by_scenario.setdefault(result['scenario'], []).append(result)
+    for name in sorted(by_scenario):
+        print name
+        for result in by_scenario[name]:
+            print '  %s %s' % (result['time'], format_result(result))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('backlog', 'daemon'),
+                        default='backlog')
+    parser.add_argument('--calls', type=int, default=2000,
+                        help='Spool files to write (default: %(default)s)')
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--zones', type=int, default=32,
+                        help='Zones per account (default: %(default)s)')
+    parser.add_argument('--retransmit', type=float, default=0.05,
+                        help='Fraction of calls sent twice')
+    parser.add_argument('--multi', type=float, default=0.2,
+                        help='Fraction of calls carrying several events')
+    parser.add_argument('--rate', type=float, default=200,
+                        help='Calls per second in daemon mode')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--general', action='append', default=[],
+                        metavar='OPTION=VALUE',
+                        help='Extra [general] setting, e.g. '
+                             'dispatch_workers=8 (repeatable)')
+    parser.add_argument('--no-store', action='store_true',
+                        help='Do not record this run in the results')
+    parser.add_argument('--history', action='store_true',
+                        help='List the recorded results and exit')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.history:
+        show_history()
+        return
+    plan = synthesize(args.calls, args.accounts, args.zones,
+                      args.retransmit, args.multi, args.seed)
+    workdir = tempfile.mkdtemp()
+    mail = standins.MailServer()
+    state = standins.StateServer()
+    try:
+        config, spool = make_config(
+            workdir, args.accounts, args.zones, mail.port, state.url,
+            '\n'.join(option.replace('=', ' = ', 1)
+                      for option in args.general))
+        done_path = os.path.join(workdir, 'done')
+        env = dict(os.environ, HOME=workdir, PYTHONPATH=common.ROOT)
+        if args.mode == 'daemon':
+            outcome = run_daemon(plan, config, spool, done_path, env,
+                                 args.rate)
+        else:
+            outcome = run_backlog(plan, config, spool, done_path, env)
+        spooled, done, errors, latencies, elapsed, rss = outcome
+        events = sum(count for name, count in spooled.items()
+                     if name in done)
+        mails, requests = mail.messages, len(state.requests)
+    finally:
+        mail.stop()
+        state.stop()
+        shutil.rmtree(workdir)
+
+    result = {
+        'time': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': revision(),
+        'scenario': scenario(args),
+        'files': len(done),
+        'events': events,
+        'seconds': round(elapsed, 3),
+        'events_per_sec': round(events / max(elapsed, 1e-6), 1),
+        'p50_ms': round(1000 * common.percentile(latencies, 50), 2),
+        'p99_ms': round(1000 * common.percentile(latencies, 99), 2),
+        'max_rss_kb': rss,
+        'mails': mails,
+        'state_requests': requests,
+        'failed_sinks': errors,
+    }
+    print result['scenario']
+    print '%i/%i files, %i events in %.2fs; %i mails, %i state requests, ' \
+        '%i sink failures' % (len(done), len(spooled), events, elapsed,
+                              mails, requests, errors)
+    print 'this run:', format_result(result)
+    previous = [r for r in load_results()
+                if r['scenario'] == result['scenario']]
+    if previous:
+        compare(result, previous[-1])
+    if not args.no_store:
+        store_result(result)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""Load the DC-09 receiver with thousands of simulated panels.
+
+Starts alarm_receiver.py against a config of many accounts whose
+post_url is a local stand-in server, then opens one TCP connection per
+simulated panel. Every panel sends its frames one at a time, waiting
+for each ACK as a real communicator does. Reports how long the ACKs
+took and how long it was until every event had reached post_url.
+
+  python bench/bench_receiver.py [--panels N] [--frames N]
+"""
+
+import argparse
+import asyncore
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import standins
+
+import alarm_receiver
+
+
+CODES = [(1, 130), (3, 130), (1, 302), (3, 302), (1, 401), (3, 401),
+         (1, 570), (3, 570), (1, 602)]
+
+SYSTEM = """
+[%(account)s]
+name = Panel %(account)s
+email = bench@localhost
+nomail_events = 130,302,401,570,602
+post_url = %(post_url)s/%(account)s
+post_batch = yes
+"""
+
+
+class Panel(asyncore.dispatcher):
+    """A communicator that sends frames and waits for each ACK."""
+    def __init__(self, poller, port, account, frames, rng, results):
+        asyncore.dispatcher.__init__(self, map=poller.map)
+        self.account = account
+        self.frames = frames
+        self.rng = rng
+        self.results = results
+        self.sent = 0
+        self.buffer = ''
+        self.out = ''
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(('127.0.0.1', port))
+
+    def _next(self):
+        qualifier, code = self.rng.choice(CODES)
+        self.sent += 1
+        self.out = alarm_receiver.frame(
+            '"ADM-CID"%04iL0#%04i[#%04i|%i%03i 01 %03i]' % (
+                self.sent, self.account, self.account, qualifier, code,
+                self.rng.randrange(1, 100)))
+        self.started = time.time()
+
+    def handle_connect(self):
+        self._next()
+
+    def writable(self):
+        return bool(self.out) or not self.connected
+
+    def handle_write(self):
+        self.out = self.out[self.send(self.out):]
+
+    def handle_read(self):
+        self.buffer += self.recv(4096)
+        if not self.buffer.endswith('\r'):
+            return
+        reply = alarm_receiver.parse_frame(self.buffer)
+        self.buffer = ''
+        self.results.append((reply['id'], time.time() - self.started))
+        if self.sent < self.frames:
+            self._next()
+
+    def handle_close(self):
+        self.close()
+
+
+def make_config(workdir, accounts, post_url):
+    config, _ = common.make_config(
+        workdir, account='0001', general='log_dir = %s\n'
+        'dispatch_workers = 16\ndispatch_queue = 1024' % workdir)
+    with open(config, 'a') as f:
+        for account in accounts:
+            f.write(SYSTEM % {'account': '%04i' % account,
+                              'post_url': post_url})
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--panels', type=int, default=2000,
+                        help='Simulated panels, each on its own connection')
+    parser.add_argument('--frames', type=int, default=5,
+                        help='Frames each panel sends')
+    args = parser.parse_args()
+    alarm_receiver.raise_file_limit()
+    workdir = tempfile.mkdtemp()
+    state = standins.StateServer()
+    proc = None
+    try:
+        accounts = [1000 + i % 9000 for i in range(args.panels)]
+        config = make_config(workdir, sorted(set(accounts)), state.url)
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(common.ROOT, 'alarm_receiver.py'),
+             config, '--port', '0', '--address', '127.0.0.1'],
+            stdout=subprocess.PIPE, env=dict(os.environ, HOME=workdir))
+        port = int(proc.stdout.readline().split()[-1])
+
+        rng = random.Random(0)
+        results = []
+        poller = alarm_receiver.Poller()
+        start = time.time()
+        for account in accounts:
+            poller.update(Panel(poller, port, account, args.frames, rng,
+                                results))
+        total = args.panels * args.frames
+        while len(results) < total and poller.map:
+            poller.poll(1)
+        acked = time.time() - start
+        common.wait_for(lambda: len(state.requests) >= total, timeout=300,
+                        interval=0.05)
+        delivered = time.time() - start
+        poller.close_all()
+
+        latencies = [seconds for _, seconds in results]
+        replies = {}
+        for reply, _ in results:
+            replies[reply] = replies.get(reply, 0) + 1
+        print '%i panels x %i frames: %s' % (args.panels, args.frames,
+                                             replies)
+        common.summarize('ACK', latencies)
+        print 'all ACKed in %.2fs (%.0f frames/s), all delivered in ' \
+            '%.2fs (%.0f events/s, %i state requests)' % (
+                acked, total / acked, delivered, total / delivered,
+                len(state.requests))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        state.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
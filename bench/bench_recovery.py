@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""Recovery time and repeat deliveries after a run dies part way.
+
+Spools a backlog, then fakes a run that was killed after claiming
+some of the files and finishing some of their sinks. A fresh main()
+then recovers and drains the spool. The sinks are counters, so the
+repeats it avoided can be compared with redelivering everything (what
+a rerun did before files were journalled).
+
+  python bench/bench_recovery.py [files] [claimed]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+CALLS = {}
+
+
+def _counter(name):
+    def sink(event):
+        CALLS[name] = CALLS.get(name, 0) + 1
+    sink.__name__ = name
+    return sink
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    claimed = int(sys.argv[2]) if len(sys.argv) > 2 else count / 2
+    sinks = ['mail_event', 'log_event', 'update_state', 'store_event']
+    for name in sinks:
+        setattr(alarm_events, name, _counter(name))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config, spool = common.make_config(workdir)
+        alarm_events.load_config(config)
+        code = '987618113001001'
+        code += alarm_events.checksum_digit(code)
+        files = [common.spool_event(spool, code) for i in range(count)]
+
+        # A run that died after claiming these; the first half of them
+        # had been mailed and logged, the rest had not been started
+        pid = os.fork()
+        if not pid:
+            for i, filename in enumerate(files[:claimed]):
+                journal = alarm_events.SpoolJournal.for_file(
+                    alarm_events.claim_spool_file(filename))
+                if i < claimed / 2:
+                    for name in sinks[:2]:
+                        journal.record(0, getattr(alarm_events, name))
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        start = time.time()
+        released = alarm_events.recover_spool(spool)
+        recovered = time.time() - start
+        alarm_events.main()
+        elapsed = time.time() - start
+        calls = sum(CALLS.values())
+        naive = count * len(sinks)
+        print '%i files, %i left claimed: recovered in %.1fms, drained ' \
+              'in %.2fs (%.2fms/file)' % (count, released, recovered * 1000,
+                                          elapsed, elapsed * 1000 / count)
+        print 'sink calls: %i (rerunning everything: %i, %i repeats ' \
+              'avoided)' % (calls, naive, naive - calls)
+        left = os.listdir(spool)
+        print 'left in spool: %s' % (left or 'nothing')
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Render event text the way the sinks ask for it.
+
+Each delivered event is rendered several times: the mail subject
+(str), the mail body (dump), the log line (str) and event_full in the
+state update (str). "eager" does that with the message chosen by
+event code and every field looked up each time, as Event.__str__ and
+dump() used to; "templates" uses the compiled templates and each
+event's cached text; "first" is a single str() and dump() of each
+event, the cost of the templates alone. "custom" gives each system a
+template of its own that only uses the event and system name.
+
+  python bench/bench_render.py [systems] [events]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+CODES = (130, 131, 302, 333, 401, 570, 602)
+
+
+def write_config(path, systems, custom):
+    with open(path, 'w') as f:
+        f.write('[general]\nspool_dir = /tmp\nemail_from = bench@localhost\n')
+        for system in range(systems):
+            f.write('\n[%i]\nname = System %i\nemail = bench@localhost\n'
+                    'type = networx\nnomail_events = 570\n' % (
+                        1000 + system, system))
+            for zone in range(1, 33):
+                f.write('zone_%i = Zone %i of %i\n' % (zone, zone, system))
+            for user in range(1, 9):
+                f.write('user_%i = User %i of %i\n' % (user, user, system))
+            if custom:
+                f.write('template_1xx = %(event)s at %(system)s\n'
+                        'template_4xx = %(event)s at %(system)s\n')
+
+
+def eager_str(event):
+    """Event.__str__ as it was, with every field looked up first."""
+    data = {
+        'partition': event.partition,
+        'zone_num': event.zone_number,
+        'zone': event.zone,
+        'user': event.user,
+        'event_num': event.event_code,
+        'event': event.event,
+        'system': event.system_name,
+    }
+    if event.event_code >= 600:
+        res = 'Event %(event_num)i: %(event)s'
+    elif event.event_code >= 500:
+        res = 'Event %(event_num)i: %(event)s in zone %(zone)s'
+    elif event.event_code >= 400:
+        res = 'Event %(event_num)i: %(event)s by %(user)s'
+    elif event.event_code >= 300:
+        res = 'Event %(event_num)i: %(event)s in device %(zone)s'
+    elif event.event_code >= 100:
+        res = 'Alarm %(event_num)i: %(event)s in zone %(zone)s'
+    else:
+        res = 'Unknown event %(event_num)i received for index %(zone_num)i'
+    res += ' at %(system)s'
+    return res % data
+
+
+def eager_dump(event):
+    string = ''
+    if event.event_code / 100 == 3:
+        trouble_rpt = alarm_events.panel_type(event.system).trouble_report(
+            event)
+        string += 'reason=%s\n' % trouble_rpt
+    for key in alarm_events.Event._DUMP_KEYS:
+        if hasattr(event, key):
+            string += '%s=%s\n' % (key, getattr(event, key))
+    return string
+
+
+def make_codes(rng, systems, count):
+    codes = []
+    for _ in range(count):
+        code = '%04i18%i%03i%02i%03i' % (
+            1000 + rng.randrange(systems), rng.choice((1, 3)),
+            rng.choice(CODES), rng.randrange(1, 4), rng.randrange(1, 33))
+        codes.append(code + alarm_events.checksum_digit(code))
+    return codes
+
+
+def deliver(event, text, details):
+    """What the mail, log and state sinks ask for."""
+    return (text(event), details(event), text(event), text(event))
+
+
+def timed(codes, text, details, uses=deliver):
+    events = [alarm_events.parse_event_code(code) for code in codes]
+    start = time.time()
+    for event in events:
+        uses(event, text, details)
+    return time.time() - start
+
+
+def main():
+    systems = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    workdir = tempfile.mkdtemp()
+    try:
+        codes = make_codes(random.Random(0), systems, count)
+        for custom in (False, True):
+            path = os.path.join(workdir, 'render.config')
+            write_config(path, systems, custom)
+            alarm_events.load_config(path)
+            # Both must agree, unless the templates were changed
+            for code in codes[:500]:
+                event = alarm_events.parse_event_code(code)
+                assert eager_dump(event) == event.dump()
+                assert custom or eager_str(event) == str(event)
+            eager = timed(codes, eager_str, eager_dump)
+            templates = timed(codes, str, alarm_events.Event.dump)
+            first = timed(codes, str, alarm_events.Event.dump,
+                          lambda event, text, details: (text(event),
+                                                        details(event)))
+            print ('%-8s %i events: eager %7.0f/s  templates %7.0f/s  '
+                   'first %7.0f/s' % (custom and 'custom' or 'built in',
+                                      count, count / eager,
+                                      count / templates, count / first))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
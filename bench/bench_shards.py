@@ -0,0 +1,111 @@
+#!/usr/bin/python
+"""How delivery of a multi-account backlog scales with --workers.
+
+Spools events for many accounts whose post_url endpoint is slow to
+answer, as when a central station relays to customer systems, then
+drains the spool with alarm_events.py --workers N for increasing N
+(N = 0 is the plain, unsharded run). With --daemon the same backlog
+is spooled into a running supervisor instead.
+
+  python bench/bench_shards.py [--files N] [--accounts N] [--daemon]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+import standins
+
+import alarm_events
+
+
+SYSTEM = """
+[%(account)s]
+name = Bench System %(account)s
+email = bench@localhost
+nomail_events = 401,602
+post_url = %(post_url)s/%(account)s/
+"""
+
+
+def make_config(workdir, accounts, post_url):
+    config, spool = common.make_config(
+        workdir, account='9876',
+        general='system_format = %%(account)s\nlog_dir = %s' % workdir)
+    with open(config, 'a') as f:
+        for account in accounts:
+            f.write(SYSTEM % {'account': account, 'post_url': post_url})
+    return config, spool
+
+
+def spool_backlog(spool, accounts, files):
+    for i in range(files):
+        account = accounts[i % len(accounts)]
+        code = '%s181401%02i%03i' % (account, 1, i % 1000)
+        common.spool_event(spool, code + alarm_events.checksum_digit(code),
+                           ext=account)
+
+
+def run(workers, args, state):
+    workdir = tempfile.mkdtemp()
+    try:
+        accounts = ['%04i' % (1000 + i) for i in range(args.accounts)]
+        config, spool = make_config(workdir, accounts, state.url)
+        env = dict(os.environ, HOME=workdir)
+        command = [sys.executable, common.SCRIPT, config]
+        if workers:
+            command += ['--workers', str(workers)]
+        state.reset()
+        if not args.daemon:
+            spool_backlog(spool, accounts, args.files)
+            start = time.time()
+            subprocess.check_call(command, env=env)
+            return time.time() - start, len(state.requests)
+        proc = subprocess.Popen(command + ['--daemon'], env=env)
+        try:
+            time.sleep(1.0)
+            start = time.time()
+            spool_backlog(spool, accounts, args.files)
+            # Each event sets four values (state, event, ...)
+            common.wait_for(
+                lambda: len(state.requests) >= 4 * args.files,
+                timeout=120, interval=0.01)
+            return time.time() - start, len(state.requests)
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=400)
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='Seconds the post_url endpoint takes to answer')
+    parser.add_argument('--workers', default='0,1,2,4,8',
+                        help='Worker counts to try (default: %(default)s)')
+    parser.add_argument('--daemon', action='store_true')
+    args = parser.parse_args()
+    state = standins.StateServer(delay=args.delay)
+    try:
+        base = None
+        for workers in [int(n) for n in args.workers.split(',')]:
+            elapsed, requests = run(workers, args, state)
+            base = base or elapsed
+            print 'workers=%-3i %7.2fs %8.1f events/s  speedup %.2fx  ' \
+                '(%i state requests)' % (workers, elapsed,
+                                         args.files / elapsed,
+                                         base / elapsed, requests)
+    finally:
+        state.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+"""What it costs to start alarm_events for one call from eventcmd.
+
+Times whole runs, as Asterisk makes them, against a config of many
+systems: with nothing in the spool and with one event, started as
+alarm_events.py and as alarm_eventcmd.py, plus the bare interpreter
+for comparison. "uncached" runs remove the config cache first. Then
+lists the slowest imports of "import alarm_events", as python3's
+-X importtime would (python2 has no such option).
+
+  python bench/bench_startup.py [--runs N] [--systems N]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+
+import alarm_events
+
+
+EVENTCMD = os.path.join(common.ROOT, 'alarm_eventcmd.py')
+
+SYSTEM = """
+[%(account)i]
+name = System %(account)i
+email = bench@localhost
+nomail_events = 401
+zone_1 = Front Door
+user_1 = Master User
+"""
+
+IMPORT_TIMES = r"""
+import __builtin__
+import sys
+import time
+
+_import = __builtin__.__import__
+finished = []
+depth = [0]
+
+
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+    depth[0] += 1
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        depth[0] -= 1
+        finished.append((depth[0], name, time.time() - start))
+
+__builtin__.__import__ = timed_import
+import alarm_events
+print 'import time: cumulative | module (over 0.5ms)'
+for level, name, seconds in finished:
+    if seconds >= 0.0005:
+        print '%9.2fms | %s%s' % (1000 * seconds, '  ' * level, name)
+"""
+
+
+def make_config(workdir, systems):
+    config, spool = common.make_config(workdir)
+    with open(config, 'a') as f:
+        for i in range(systems):
+            f.write(SYSTEM % {'account': 1000 + i})
+    return config, spool
+
+
+def time_runs(command, runs, env, before=None):
+    samples = []
+    for _ in range(runs):
+        if before:
+            before()
+        start = time.time()
+        subprocess.check_call(command, env=env)
+        samples.append(time.time() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--systems', type=int, default=2000,
+                        help='Systems in the config besides the one the '
+                             'events come from')
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        config, spool = make_config(workdir, args.systems)
+        cache = alarm_events._config_cache_path(config)
+        env = dict(os.environ, HOME=workdir)
+        subprocess.check_call([sys.executable, common.SCRIPT, config,
+                               '--compile'], env=env)
+
+        def uncache():
+            if os.path.exists(cache):
+                os.remove(cache)
+
+        def spool_one():
+            common.spool_event(spool, '9876181401010013', ext='9876')
+
+        common.summarize('python', time_runs(
+            [sys.executable, '-c', 'pass'], args.runs, env))
+        print '--- nothing in the spool'
+        common.summarize('uncached', time_runs(
+            [sys.executable, common.SCRIPT, config], args.runs, env,
+            uncache))
+        common.summarize('script', time_runs(
+            [sys.executable, common.SCRIPT, config], args.runs, env))
+        common.summarize('eventcmd', time_runs(
+            [sys.executable, EVENTCMD, config], args.runs, env))
+        print '--- one event'
+        common.summarize('uncached', time_runs(
+            [sys.executable, common.SCRIPT, config], args.runs, env,
+            lambda: (uncache(), spool_one())))
+        common.summarize('script', time_runs(
+            [sys.executable, common.SCRIPT, config], args.runs, env,
+            spool_one))
+        common.summarize('eventcmd', time_runs(
+            [sys.executable, EVENTCMD, config], args.runs, env, spool_one))
+        assert not alarm_events.spool_files(spool)
+        print
+        subprocess.check_call([sys.executable, '-c', IMPORT_TIMES],
+                              cwd=common.ROOT, env=env)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+"""Mail spawns and state updates for an alarm storm, with coalescing.
+
+Spools a burst like an AC failure plus siren tamper cascade (trouble
+and restore events from one panel, with two real alarms mixed in) and
+runs main() over it with coalescing off and on. /usr/bin/mail and the
+state endpoint are replaced with counters.
+
+  python bench/bench_storm.py [troubles]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import common
+
+import alarm_events
+
+
+class FakeMail(object):
+    spawned = 0
+
+    def __init__(self, *args, **kwargs):
+        FakeMail.spawned += 1
+        self.stdin = open(os.devnull, 'w')
+
+    def wait(self):
+        return 0
+
+
+def storm(count):
+    codes = []
+    for i in range(count):
+        code = ['18130100000', '18132100000', '18330100000',
+                '18332100000'][i % 4]
+        codes.append('9876%s' % code)
+        if i == count / 2:
+            codes.append('987618113001003')
+    codes.append('987618113001003')
+    return [c + alarm_events.checksum_digit(c) for c in codes]
+
+
+def run(codes, window):
+    workdir = tempfile.mkdtemp()
+    os.environ['HOME'] = workdir
+    try:
+        system = window and 'coalesce_window = %i' % window or ''
+        config, spool = common.make_config(workdir, nomail='570',
+                                           system=system)
+        for code in codes:
+            common.spool_event(spool, code)
+        alarm_events.load_config(config)
+        FakeMail.spawned = 0
+        alarm_events.update_state = counting_update_state
+        counting_update_state.calls = 0
+        alarm_events.main()
+        print 'window=%-3i %i events: %i mail processes, %i state updates' % (
+            window, len(codes), FakeMail.spawned, counting_update_state.calls)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def counting_update_state(event, changes=None):
+    counting_update_state.calls += 1
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    subprocess.Popen = FakeMail
+    codes = storm(count)
+    run(codes, 0)
+    run(codes, 30)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""dump() over a trouble-heavy event stream.
+
+Times the trouble reason on its own, with the NetworX device table
+rebuilt for every event (as before) and shared, and then whole
+dump() calls, which is what each trouble mail pays.
+
+  python bench/bench_trouble.py [events]
+"""
+
+import ConfigParser
+import random
+import sys
+import time
+
+import common
+
+import alarm_events
+
+
+class LegacyNetworxTroubleReport(alarm_events.TroubleReport):
+    def __init__(self, event):
+        super(LegacyNetworxTroubleReport, self).__init__(event)
+        self._devices = {0: 'Control Panel'}
+        for keypad in range(0, 8):
+            for partition in range(0, 8):
+                index = 192 + (8 * keypad) + partition
+                self._devices[index] = 'Keypad %i (Partition %i)' % (
+                    keypad + 1, partition + 1)
+        expanders = [23] + range(16, 22) + range(96, 112)
+        for i, number in enumerate(expanders):
+            self._devices[number] = 'Expander %i (Zones %i-%i)' % (
+                number, 9 + i, 9 + 8 + i)
+        powers = range(84, 92)
+        for number in powers:
+            self._devices[number] = 'Power Supply %i' % number
+
+    def __str__(self):
+        self.devices = self._devices
+        return super(LegacyNetworxTroubleReport, self).__str__()
+
+
+def timed(label, count, fn):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print '%-18s %i events: %.3fs, %.1fus/event' % (
+        label, count, elapsed, elapsed * 1e6 / count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('general')
+    cfg.add_section('9876')
+    cfg.set('9876', 'name', 'Bench System')
+    cfg.set('9876', 'type', 'networx')
+    alarm_events.CONFIG = cfg
+
+    rand = random.Random(42)
+    devices = [0, 23, 85, 200, 255, 911]
+    codes = []
+    for i in range(count):
+        code = '987618%i%03i01%03i' % (
+            rand.choice([1, 3]), rand.choice([301, 333, 321, 380]),
+            rand.choice(devices))
+        codes.append(code + alarm_events.checksum_digit(code))
+    events = [alarm_events.Event.from_record(r)
+              for r in alarm_events.parse_event_codes(codes)]
+    panel = alarm_events.panel_type('9876')
+
+    timed('reason, rebuilt', count,
+          lambda: [str(LegacyNetworxTroubleReport(e)) for e in events])
+    timed('reason, shared', count,
+          lambda: [str(panel.trouble_report(e)) for e in events])
+    timed('dump()', count, lambda: [e.dump() for e in events])
+
+
+if __name__ == '__main__':
+    main()
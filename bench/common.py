@@ -0,0 +1,82 @@
+"""Helpers shared by the benchmark scripts in this directory."""
+
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+SCRIPT = os.path.join(ROOT, 'alarm_events.py')
+
+BASE_CONFIG = """[general]
+spool_dir = %(spool)s
+email_from = Alarm System <bench@localhost>
+safety_net_email = bench@localhost
+%(general)s
+
+[%(account)s]
+name = Bench System
+email = bench@localhost
+nomail_events = %(nomail)s
+zone_1 = Front Door
+user_1 = Master User
+%(system)s
+"""
+
+
+def make_config(workdir, account='9876', nomail='401', general='',
+                system=''):
+    spool = os.path.join(workdir, 'spool')
+    if not os.path.isdir(spool):
+        os.makedirs(spool)
+    path = os.path.join(workdir, 'bench.config')
+    with open(path, 'w') as f:
+        f.write(BASE_CONFIG % {'spool': spool, 'account': account,
+                               'nomail': nomail, 'general': general,
+                               'system': system})
+    return path, spool
+
+
+def spool_event(spool, event_code, ext='1', name='Bench Caller'):
+    """Write a spool file the way alarmreceiver does: fully, then visible."""
+    return spool_call(spool, [event_code], ext, name)
+
+
+def spool_call(spool, event_codes, ext='1', name='Bench Caller'):
+    """Spool every event of one call in a single file."""
+    fd, tmp = tempfile.mkstemp(dir=spool, prefix='tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write('[metadata]\n\nCALLINGFROM=%s\nCALLERNAME=%s\n\n'
+                '[events]\n\n%s\n' % (ext, name, '\n'.join(event_codes)))
+    final = os.path.join(spool, 'event-%s' % os.path.basename(tmp)[4:])
+    os.rename(tmp, final)
+    return final
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(label, samples):
+    print '%-12s n=%-5i mean=%8.2fms p50=%8.2fms p99=%8.2fms max=%8.2fms' % (
+        label, len(samples),
+        1000 * sum(samples) / max(1, len(samples)),
+        1000 * percentile(samples, 50),
+        1000 * percentile(samples, 99),
+        1000 * max(samples or [0]))
+
+
+def wait_for(predicate, timeout=10.0, interval=0.0005):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return False
@@ -0,0 +1,102 @@
+"""Local stand-ins for the servers alarm_events.py talks to."""
+
+import BaseHTTPServer
+import SocketServer
+import asyncore
+import smtpd
+import threading
+
+
+class _StateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path, body))
+            if server.down:
+                code = 503
+            elif self.command in server.reject_methods:
+                code = 405
+            else:
+                code = 200
+                server.values[self.path] = body
+        if server.delay:
+            server.delay_event.wait(server.delay)
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class StateServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A post_url endpoint that records connections and requests.
+
+    reject_methods lists methods answered with 405 (to exercise the
+    PUT/POST fallback), down makes every request fail with 503 and
+    delay slows every response down by that many seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, reject_methods=(), delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _StateHandler)
+        self.lock = threading.Lock()
+        self.reject_methods = set(reject_methods)
+        self.delay = delay
+        self.delay_event = threading.Event()
+        self.down = False
+        self.reset()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_port
+
+    def reset(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = []
+            self.values = {}
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MailServer(smtpd.SMTPServer):
+    """An smtp_host that accepts and counts every message."""
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = 0
+        self.running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while self.running:
+            asyncore.loop(0.01, count=1)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages += 1
+
+    def stop(self):
+        self.running = False
+        self._thread.join()
+        asyncore.close_all()
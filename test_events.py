@@ -1,10 +1,27 @@
+import asyncore
+import BaseHTTPServer
 import ConfigParser
+import glob
+import gzip
+import json
 import mock
 import os
+import shutil
+import smtpd
+import socket
+import SocketServer
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
+import alarm_eventcmd
 import alarm_events
+import alarm_history
+import alarm_receiver
 
 FAKE_EVENT_LINES = ['[metadata]',
                     '',
@@ -14,7 +31,7 @@ FAKE_EVENT_LINES = ['[metadata]',
                     '',
                     '[events]',
                     '',
-                    '987618340103001_',
+                    '987618340103001B',
                 ]
 
 
@@ -39,6 +56,11 @@ class BaseTest(unittest.TestCase):
         cfg.set('9876', 'post_url', 'http://localhost/foo')
         cfg.set('9876', 'type', 'networx')
 
+        # Keep state updates that fail out of the shared spool_dir
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir)
+        cfg.set('general', 'state_queue_dir', queue_dir)
+
         cfg_mock = mock.patch.object(alarm_events, 'CONFIG', cfg)
         cfg_mock.start()
         self.addCleanup(cfg_mock.stop)
@@ -127,6 +149,124 @@ class TestEvents(BaseTest):
             'reason=Trouble with expander device 911 (restored)',
             reason)
 
+    def test_trouble_table_shared(self):
+        e = alarm_events.parse_event_code('987618333300200_')
+        self.assertIs(alarm_events.NetworxTroubleReport.devices,
+                      alarm_events.panel_type(e.system).devices)
+
+    def test_panel_dir(self):
+        panel_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, panel_dir)
+        with open(os.path.join(panel_dir, 'nx8e.conf'), 'w') as f:
+            f.write('[panel]\nname = nx8e\ninherits = networx\n'
+                    '[devices]\n24-25 = Receiver %(i)i\n'
+                    '[events]\n393 = Smoke detector needs cleaning\n')
+        alarm_events.CONFIG.set('general', 'panel_dir', panel_dir)
+        alarm_events.CONFIG.set('9876', 'type', 'nx8e')
+        e = alarm_events.parse_event_code('987618333300025_')
+        self.assertEqual('reason=Trouble with Receiver 2 (restored)',
+                         e.dump().split('\n')[0])
+        e = alarm_events.parse_event_code('987618333300200_')
+        self.assertEqual(
+            'reason=Trouble with Keypad 2 (Partition 1) (restored)',
+            e.dump().split('\n')[0])
+        e = alarm_events.parse_event_code('987618139300005_')
+        self.assertEqual('Smoke detector needs cleaning', e.event)
+
+
+    def test_malformed(self):
+        for code in (None, '', '98761834', '987617340103001_',
+                     '9876183401030X1_', '987618340103001_0'):
+            self.assertRaises(alarm_events.InvalidEvent,
+                              alarm_events.parse_event_code, code)
+
+    def test_from_record(self):
+        record = alarm_events.EventRecord(9876, 3, 401, 3, 1,
+                                          '987618340103001_')
+        e = alarm_events.Event.from_record(record)
+        self.assertEqual('Event 401: System armed normally by '
+                         'Fake Master at Test System', str(e))
+        self.assertFalse(hasattr(e, '__dict__'))
+
+    def test_templates(self):
+        cfg = alarm_events.CONFIG
+        cfg.set('general', 'template_6xx', '%(system)s: %(event)s')
+        cfg.set('9876', 'template_130',
+                '[P%(partition)02i] ALARM %(zone)s (%(system_id)s)')
+        cfg.set('9876', 'template_4xx', '%(event)s')
+        e = alarm_events.parse_event_code('987618113003001_')
+        self.assertEqual('[P03] ALARM Front Door (9876)', str(e))
+        e = alarm_events.parse_event_code('987618160203001_')
+        self.assertEqual('Test System: Periodic test', str(e))
+        e = alarm_events.parse_event_code('987618113103001_')
+        self.assertEqual('Alarm 131: Burglary alarm (perimeter) in zone '
+                         'Front Door at Test System', str(e))
+
+        # Only the fields it uses are looked up
+        e = alarm_events.parse_event_code('987618340103001_')
+        with mock.patch.object(alarm_events.Event, 'user') as user:
+            self.assertEqual('System armed normally', str(e))
+        self.assertFalse(user.called)
+
+    def test_templates_shared(self):
+        alarm_events.CONFIG.add_section('1234')
+        alarm_events.CONFIG.set('1234', 'template_1xx', '%(event)s')
+        table = alarm_events.message_templates()
+        self.assertIs(table.compile('9876'), table.compile('5555'))
+        self.assertIsNot(table.compile('9876'), table.compile('1234'))
+        self.assertIs(table.compile('9876')[1][2],
+                      table.compile('1234')[1][2])
+
+    def test_bad_template(self):
+        cfg = alarm_events.CONFIG
+        cfg.set('9876', 'template_1xx', '%(zone)s at %(place)s')
+        cfg.set('general', 'template_602', '%(event_num)i%')
+        problems = alarm_events.validate_config(cfg)
+        self.assertIn("Bad template: [general] template_602: Bad template "
+                      "'%(event_num)i%': incomplete format", problems)
+        cfg.remove_option('general', 'template_602')
+        self.assertIn("Bad template: [9876] template_1xx: Unknown field(s) "
+                      "place in '%(zone)s at %(place)s'",
+                      alarm_events.validate_config(cfg))
+
+    def test_rendered_once(self):
+        e = alarm_events.parse_event_code('987618113003001_')
+        e.from_name = 'Test Caller'
+        text, details = str(e), e.dump()
+        self.assertIn('from_name=Test Caller\n', details)
+        self.assertIn('system_name=Test System\n', details)
+        with mock.patch.object(alarm_events, 'system_index') as index:
+            self.assertIs(text, str(e))
+            self.assertIs(details, e.dump())
+        self.assertFalse(index.called)
+
+
+class TestParseCodes(unittest.TestCase):
+    def test_checksum(self):
+        self.assertEqual('B', alarm_events.checksum_digit('987618340103001'))
+        self.assertTrue(alarm_events.checksum_ok('987618340103001B'))
+        self.assertFalse(alarm_events.checksum_ok('9876183401030011'))
+        self.assertFalse(alarm_events.checksum_ok('987618340103001_'))
+
+    def test_bulk(self):
+        records = alarm_events.parse_event_codes(
+            '987618340103001B\n\n  1234181130010055\n')
+        self.assertEqual(
+            [alarm_events.EventRecord(9876, 3, 401, 3, 1, '987618340103001B'),
+             alarm_events.EventRecord(1234, 1, 130, 1, 5, '1234181130010055')],
+            records)
+        self.assertEqual(records, alarm_events.parse_event_codes(
+            ['987618340103001B\n', '1234181130010055']))
+
+    def test_bulk_rejects(self):
+        self.assertRaises(alarm_events.InvalidEvent,
+                          alarm_events.parse_event_codes,
+                          ['987618340103001B', '9876183401030011'])
+        self.assertRaises(alarm_events.InvalidEvent,
+                          alarm_events.parse_event_codes,
+                          ['987618340103001B', '98761834'])
+        self.assertEqual(1, len(alarm_events.parse_event_codes(
+            ['987618340103001_'], verify_checksum=False)))
 
 class TestSampleConfig(unittest.TestCase):
     def test_load_sample_config(self):
@@ -135,9 +275,324 @@ class TestSampleConfig(unittest.TestCase):
         cfg_mock.start()
         self.addCleanup(cfg_mock.stop)
 
+        # Loading writes a cache next to the config; keep it out of samples/
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sample.config')
+        shutil.copy('samples/sample.config', path)
+
         self.assertFalse(alarm_events.CONFIG.has_section('general'))
-        alarm_events.load_config('samples/sample.config')
+        alarm_events.load_config(path)
         self.assertTrue(alarm_events.CONFIG.has_section('general'))
+        self.assertFalse(os.path.exists('samples/.sample.config.cache'))
+
+    def test_load_sample_panel(self):
+        panel = alarm_events.PanelType.from_file('samples/sample-panel.conf')
+        self.assertEqual('example', panel.name)
+        self.assertEqual('Power Supply 2', panel.devices[85])
+        self.assertEqual('Expander 17 (Zones 17-24)', panel.devices[17])
+        self.assertEqual('Keypad 8 (Partition 8)', panel.devices[255])
+
+
+
+class TestConfigIndex(BaseTest):
+    def test_compiled_system(self):
+        system = alarm_events.system_index('9876')
+        self.assertEqual('Test System', system.name)
+        self.assertEqual({1: 'Front Door', 2: 'Back Door', 3: 'Motion'},
+                         system.zones)
+        self.assertEqual({1: 'Fake Master', 2: 'Fake User'}, system.users)
+        self.assertEqual(frozenset([570, 666]), system.nomail)
+        self.assertEqual('networx', system.type)
+        self.assertFalse(system.post_batch)
+
+    def test_missing(self):
+        alarm_events.CONFIG.remove_option('9876', 'name')
+        self.assertRaises(ConfigParser.NoSectionError,
+                          alarm_events.system_index, '1234')
+        e = alarm_events.parse_event_code('987618340103001_')
+        self.assertRaises(ConfigParser.NoOptionError,
+                          getattr, e, 'system_name')
+
+    def test_disk_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fn = os.path.join(tmpdir, 'my.config')
+        with open(fn, 'w') as f:
+            f.write('[general]\nspool_dir = /tmp\n'
+                    '[9876]\nname = Cached\nzone_5 = Garage\n')
+        alarm_events.load_config(fn)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir,
+                                                    '.my.config.cache')))
+        with mock.patch('ConfigParser.ConfigParser.read') as mock_read:
+            alarm_events.load_config(fn)
+            self.assertFalse(mock_read.called)
+        self.assertEqual('/tmp', alarm_events.CONFIG.get('general',
+                                                         'spool_dir'))
+        self.assertEqual({5: 'Garage'},
+                         alarm_events.system_index('9876').zones)
+
+        with open(fn, 'a') as f:
+            f.write('zone_6 = Shed\n')
+        os.utime(fn, (0, 0))
+        alarm_events.load_config(fn)
+        self.assertEqual({5: 'Garage', 6: 'Shed'},
+                         alarm_events.system_index('9876').zones)
+
+    def test_disk_cache_unpacked_on_use(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fn = os.path.join(tmpdir, 'my.config')
+        with open(fn, 'w') as f:
+            f.write('[general]\nspool_dir = /tmp\n'
+                    '[1234]\nname = Shop\n[9876]\nname = Cached\n')
+        alarm_events.load_config(fn)
+        alarm_events.load_config(fn)
+        cfg = alarm_events.CONFIG
+        self.assertEqual('Cached', alarm_events.system_index('9876').name)
+        self.assertEqual('Cached', cfg.get('9876', 'name'))
+        self.assertIsInstance(dict.get(cfg._alarm_index, '1234'), str)
+        self.assertIsInstance(dict.get(cfg._sections, '1234'), str)
+        self.assertEqual(['general', '1234', '9876'], cfg.sections())
+        self.assertEqual([('name', 'Shop')], cfg.items('1234'))
+
+    def test_eventcmd_idle(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fn = os.path.join(tmpdir, 'my.config')
+        with open(fn, 'w') as f:
+            f.write('[general]\nspool_dir = %s\n'
+                    '[9876]\nname = Cached\n' % tmpdir)
+        self.assertFalse(alarm_eventcmd.idle(fn))
+        alarm_events.load_config(fn)
+        self.assertTrue(alarm_eventcmd.idle(fn))
+
+        event = os.path.join(tmpdir, 'event-1')
+        open(event, 'w').close()
+        self.assertFalse(alarm_eventcmd.idle(fn))
+        os.remove(event)
+        os.makedirs(os.path.join(tmpdir, 'state-queue'))
+        queued = os.path.join(tmpdir, 'state-queue', 'state-1.json')
+        open(queued, 'w').close()
+        self.assertFalse(alarm_eventcmd.idle(fn))
+        os.remove(queued)
+        self.assertTrue(alarm_eventcmd.idle(fn))
+        due = os.path.join(tmpdir, 'checkins.json.due')
+        with open(due, 'w') as f:
+            f.write('%r\n1234' % (time.time() + 60))
+        self.assertTrue(alarm_eventcmd.idle(fn))
+        with open(due, 'w') as f:
+            f.write('%r\n1234' % (time.time() - 1))
+        self.assertFalse(alarm_eventcmd.idle(fn))
+        os.remove(due)
+
+        with open(fn, 'a') as f:
+            f.write('[1234]\nname = Shop\n')
+        os.utime(fn, (0, 0))
+        self.assertFalse(alarm_eventcmd.idle(fn))
+
+_RELOAD_DAEMON = """
+import os, sys
+import alarm_events
+alarm_events.load_config(sys.argv[1])
+fd = os.open(sys.argv[2], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+def mail_event(event):
+    os.write(fd, 'mail %s\\n' % event.system_name)
+def safety_net(msg):
+    os.write(fd, 'safety_net %s\\n' % msg.split('\\n')[0])
+alarm_events.mail_event = mail_event
+alarm_events.log_event = alarm_events.update_state = lambda event: None
+alarm_events.safety_net = safety_net
+alarm_events.daemon_main(0.05)
+"""
+
+
+_RETRY_DAEMON = """
+import os, sys
+import alarm_events
+alarm_events.load_config(sys.argv[1])
+fd = os.open(sys.argv[2], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+calls = []
+def mail_event(event):
+    calls.append(event)
+    if len(calls) == 1:
+        os.write(fd, 'failed\\n')
+        raise Exception('mail server down')
+    os.write(fd, 'mail %s\\n' % event.system_name)
+def safety_net(msg):
+    os.write(fd, 'safety_net %s\\n' % msg.split('\\n')[0])
+alarm_events.mail_event = mail_event
+alarm_events.log_event = alarm_events.update_state = lambda *args: None
+alarm_events.safety_net = safety_net
+alarm_events.SPOOL_RETRY = 0.2
+alarm_events.daemon_main(0.05)
+"""
+
+
+class TestDaemonRetry(BaseTest):
+    def test_failed_file_retried(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        spool = os.path.join(tmpdir, 'spool')
+        os.mkdir(spool)
+        config = os.path.join(tmpdir, 'my.config')
+        with open(config, 'w') as f:
+            f.write('[general]\nspool_dir = %s\nemail_from = x@y\n'
+                    '[9876]\nname = Home\nemail = x@y\n'
+                    'nomail_events = 570\n' % spool)
+        delivered = os.path.join(tmpdir, 'delivered')
+        env = dict(os.environ, HOME=tmpdir,
+                   PYTHONPATH=os.path.dirname(
+                       os.path.abspath(alarm_events.__file__)))
+        proc = subprocess.Popen([sys.executable, '-c', _RETRY_DAEMON,
+                                 config, delivered], env=env,
+                                stdout=subprocess.PIPE)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+        fn = os.path.join(spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+
+        def lines():
+            try:
+                with open(delivered) as f:
+                    return f.read().split('\n')[:-1]
+            except IOError:
+                return []
+
+        deadline = time.time() + 10
+        while len(lines()) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        while os.path.exists(fn) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(os.path.exists(fn))
+        # The file went back into the spool unchanged, and was still
+        # retried once its backoff was over
+        self.assertEqual(['failed', 'safety_net Failed to deliver event '
+                          '%s:' % fn, 'mail Home'], lines())
+
+
+class TestConfigReload(BaseTest):
+    def setUp(self):
+        super(TestConfigReload, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spool = os.path.join(self.tmpdir, 'spool')
+        self.include = os.path.join(self.tmpdir, 'systems')
+        os.mkdir(self.spool)
+        os.mkdir(self.include)
+        self.config = os.path.join(self.tmpdir, 'my.config')
+        with open(self.config, 'w') as f:
+            f.write('[general]\nspool_dir = %s\nemail_from = x@y\n'
+                    'include_dir = %s\nconfig_check = 0.05\n' % (
+                        self.spool, self.include))
+
+    def _include(self, name, text, stamp=1000):
+        path = os.path.join(self.include, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.utime(path, (stamp, stamp))
+
+    def _system(self, account, name, stamp=1000):
+        self._include('%s.conf' % account,
+                      '[%s]\nname = %s\nemail = x@y\nnomail_events = 570\n'
+                      % (account, name), stamp)
+
+    def test_include_dir(self):
+        self._system('9876', 'Home')
+        self._system('1234', 'Shop')
+        alarm_events.load_config(self.config)
+        self.assertEqual('Shop', alarm_events.system_index('1234').name)
+        self.assertEqual([], alarm_events.validate_config(
+            alarm_events.CONFIG))
+
+        # A changed include file is noticed despite the cache
+        self._system('1234', 'Store', 2000)
+        alarm_events.load_config(self.config)
+        self.assertEqual('Store', alarm_events.system_index('1234').name)
+
+        self._include('zz.conf', '[9876]\nname = Again\n')
+        self.assertRaises(alarm_events.ConfigError,
+                          alarm_events.load_config, self.config)
+
+    def test_validate(self):
+        self._include('bad.conf', '[1234]\nname = Shop\nemail = x@y\n'
+                      'nomail_events = 570,x\n'
+                      '[5678]\nemail = x@y\nnomail_events = 570\n'
+                      'type = vista\n')
+        with open(self.config, 'a') as f:
+            f.write('dedup_window = 6O\n')
+        cfg = alarm_events.read_config(self.config)
+        self.assertEqual([
+            '[general] dedup_window: invalid literal for float(): 6O',
+            "[1234] invalid literal for int() with base 10: 'x'",
+            '[5678] name is not set',
+            "[5678] unknown panel type 'vista'"],
+            alarm_events.validate_config(cfg))
+
+    def test_reloader(self):
+        self._system('9876', 'Home')
+        alarm_events.load_config(self.config)
+        version = alarm_events.CONFIG._alarm_version
+        reloader = alarm_events.ConfigReloader(0.05)
+        now = time.time() + 1
+        self.assertFalse(reloader.changed(now))
+
+        self._include('9876.conf', '[9876]\nname = Home\n', 2000)
+        self.assertTrue(reloader.changed(now + 1))
+        self.assertRaises(alarm_events.ConfigError, reloader.load)
+        # A bad version is not tried again until it changes
+        self.assertFalse(reloader.changed(now + 2))
+
+        self._system('9876', 'House', 3000)
+        self.assertTrue(reloader.changed(now + 3))
+        cfg = reloader.load()
+        self.assertTrue(cfg._alarm_version > version)
+        self.assertEqual('Home', alarm_events.system_index('9876').name)
+        alarm_events.swap_config(cfg)
+        self.assertEqual('House', alarm_events.system_index('9876').name)
+
+    def test_daemon_reloads(self):
+        self._system('9876', 'Before')
+        delivered = os.path.join(self.tmpdir, 'delivered')
+        env = dict(os.environ, HOME=self.tmpdir,
+                   PYTHONPATH=os.path.dirname(
+                       os.path.abspath(alarm_events.__file__)))
+        proc = subprocess.Popen([sys.executable, '-c', _RELOAD_DAEMON,
+                                 self.config, delivered], env=env,
+                                stdout=subprocess.PIPE)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.terminate)
+
+        def lines():
+            try:
+                with open(delivered) as f:
+                    return f.read().split('\n')[:-1]
+            except IOError:
+                return []
+
+        def deliver(count, expected):
+            zone = '%03i' % count
+            code = '9876181130010' + zone[1:]
+            code += alarm_events.checksum_digit(code)
+            with open(os.path.join(self.spool, 'event-%i' % count),
+                      'w') as f:
+                f.write('\n'.join(FAKE_EVENT_LINES[:-1] + [code]))
+            deadline = time.time() + 10
+            while len(lines()) < count and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(expected, lines()[-1])
+
+        deliver(1, 'mail Before')
+        self._system('9876', 'After', 2000)
+        time.sleep(0.3)
+        deliver(2, 'mail After')
+        self._include('9876.conf', '[9876]\nname = Broken\n', 3000)
+        time.sleep(0.3)
+        self.assertEqual('safety_net The changed config was not loaded, '
+                         'so version 2 stays in use:', lines()[-1])
+        deliver(4, 'mail After')
+        self.assertEqual(4, len(lines()))
 
 
 class TestUpdateState(BaseTest):
@@ -183,13 +638,320 @@ class TestUpdateState(BaseTest):
             self.assertEqual('no', req.get_data())
             self.assertEqual(1, len(mock_open.call_args_list))
 
+    def test_put_falls_back_to_post_once(self):
+        e = alarm_events.parse_event_code('987618340103001_')
+        error = urllib2.HTTPError('http://localhost/foo/state', 405,
+                                  'Method Not Allowed', {}, None)
+        with mock.patch.dict(alarm_events._STATE_METHODS, clear=True):
+            with mock.patch('urllib2.urlopen') as mock_open:
+                mock_open.side_effect = [error] + [mock.MagicMock()] * 4
+                alarm_events.update_state(e)
+                methods = [c[0][0].get_method()
+                           for c in mock_open.call_args_list]
+            self.assertEqual(['PUT', 'POST', 'POST', 'POST', 'POST'],
+                             methods)
+            self.assertEqual({'http://localhost/foo': 'POST'},
+                             alarm_events._STATE_METHODS)
+
+    def test_batch(self):
+        alarm_events.CONFIG.set('9876', 'post_batch', 'yes')
+        e = alarm_events.parse_event_code('987618340103001_')
+        with mock.patch('urllib2.urlopen') as mock_open:
+            alarm_events.update_state(e)
+            self.assertEqual(1, len(mock_open.call_args_list))
+            req = mock_open.call_args_list[0][0][0]
+        self.assertEqual('http://localhost/foo', req.get_full_url())
+        self.assertEqual('application/json', req.get_header('Content-type'))
+        self.assertEqual({'state': 'armed',
+                          'event': 'System armed normally',
+                          'event_code': '401',
+                          'event_full': str(e)},
+                         json.loads(req.get_data()))
+
+
+def _make_event(qualifier, code, partition, zone, account='9876'):
+    raw = '%s18%i%03i%02i%03i' % (account, qualifier, code, partition, zone)
+    return alarm_events.parse_event_code(
+        raw + alarm_events.checksum_digit(raw))
+
+
+class TestPanelState(BaseTest):
+    def setUp(self):
+        super(TestPanelState, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        alarm_events.CONFIG.set('general', 'state_dir', self.tmpdir)
+        alarm_events.CONFIG.set('general', 'panel_state', 'yes')
+
+    def test_model(self):
+        state = alarm_events.PanelState()
+        self.assertEqual([('partition_1', 'armed')],
+                         state.apply(_make_event(3, 401, 1, 2)))
+        self.assertEqual([('partition_2', 'disarmed')],
+                         state.apply(_make_event(1, 401, 2, 2)))
+        self.assertEqual([], state.apply(_make_event(3, 401, 1, 2)))
+        self.assertEqual([('zone_3', 'bypassed')],
+                         state.apply(_make_event(1, 570, 1, 3)))
+        state.apply(_make_event(1, 570, 1, 5))
+        self.assertEqual([('zone_5', 'bypassed,trouble')],
+                         state.apply(_make_event(1, 383, 1, 5)))
+        self.assertEqual([('zone_2', 'alarm,open')],
+                         state.apply(_make_event(1, 130, 1, 2)))
+        # Alarm memory lasts until the partition is disarmed
+        self.assertEqual([('zone_2', 'alarm')],
+                         state.apply(_make_event(3, 130, 1, 2)))
+        self.assertEqual([('partition_1', 'disarmed'), ('zone_2', 'normal')],
+                         state.apply(_make_event(1, 401, 1, 2)))
+        self.assertEqual([('zone_3', 'normal')],
+                         state.apply(_make_event(3, 570, 1, 3)))
+        self.assertEqual([], state.apply(_make_event(1, 602, 0, 0)))
+        self.assertEqual([('partition_1', 'disarmed'),
+                          ('partition_2', 'disarmed'),
+                          ('zone_5', 'bypassed,trouble')], state.values())
+        copy = alarm_events.PanelState.from_json(
+            json.loads(json.dumps(state.to_json())))
+        self.assertEqual(state.values(), copy.values())
+
+    def test_only_changes_published(self):
+        with mock.patch('urllib2.urlopen') as mock_open:
+            alarm_events.update_state(_make_event(3, 401, 1, 2))
+            alarm_events.update_state(_make_event(3, 401, 1, 2))
+            paths = [c[0][0].get_full_url().rsplit('/', 1)[1]
+                     for c in mock_open.call_args_list]
+        self.assertEqual(['state', 'event', 'event_code', 'event_full',
+                          'partition_1',
+                          'state', 'event', 'event_code', 'event_full'],
+                         paths)
+
+    def test_digest(self):
+        digest = alarm_events.Digest([_make_event(1, 570, 1, 3),
+                                      _make_event(1, 570, 1, 4),
+                                      _make_event(3, 570, 1, 3)])
+        with mock.patch('urllib2.urlopen') as mock_open:
+            alarm_events.update_digest_state(digest)
+            sent = dict((c[0][0].get_full_url().rsplit('/', 1)[1],
+                         c[0][0].get_data())
+                        for c in mock_open.call_args_list)
+        self.assertEqual('no', sent['bypass'])
+        self.assertEqual('normal', sent['zone_3'])
+        self.assertEqual('bypassed', sent['zone_4'])
+
+    def test_snapshot(self):
+        with mock.patch('urllib2.urlopen'):
+            alarm_events.update_state(_make_event(1, 570, 2, 7))
+            alarm_events.update_state(_make_event(3, 401, 2, 1))
+        alarm_events.close_sinks()
+        self.assertEqual(['9876.json'],
+                         os.listdir(os.path.join(self.tmpdir, 'panels')))
+        del alarm_events.CONFIG._alarm_panel_state
+        with mock.patch('sys.stdout') as stdout:
+            alarm_events.show_state('9876')
+        self.assertEqual('partition_2=armed\nzone_7=bypassed\n',
+                         ''.join(c[0][0] for c in
+                                 stdout.write.call_args_list))
+
+
+class _CountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(self.path)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestKeepAlive(BaseTest):
+    def test_connection_reused(self):
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _CountingHandler)
+        server.connections = 0
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+
+        prefix = 'http://127.0.0.1:%i/alarm' % server.server_port
+        handler = alarm_events.keepalive_handler()
+        opener = urllib2.build_opener(handler)
+        self.addCleanup(handler.close_all)
+        with mock.patch('urllib2.urlopen', opener.open):
+            for key in ('state', 'event', 'event_code'):
+                alarm_events._update_state(prefix, key, 'x')
+        self.assertEqual(['/alarm/state', '/alarm/event', '/alarm/event_code'],
+                         server.requests)
+        self.assertEqual(1, server.connections)
+
+
+class _FlakyStateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.down:
+            self.send_response(503)
+        else:
+            self.server.requests.append((self.path, body))
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_POST = do_PUT
+
+    def log_message(self, *args):
+        pass
+
+
+class _FlakyStateServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestStateQueue(BaseTest):
+    def setUp(self):
+        super(TestStateQueue, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        alarm_events.CONFIG.set('general', 'state_queue_dir', self.tmpdir)
+        self.server = _FlakyStateServer(('127.0.0.1', 0), _FlakyStateHandler)
+        self.server.down = True
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.prefix = 'http://127.0.0.1:%i/alarm' % self.server.server_port
+        alarm_events.CONFIG.set('9876', 'post_url', self.prefix)
+        methods = mock.patch.dict(alarm_events._STATE_METHODS, clear=True)
+        methods.start()
+        self.addCleanup(methods.stop)
+
+    def _update(self, *codes):
+        for code in codes:
+            alarm_events.update_state(alarm_events.parse_event_code(code))
+
+    def test_latest_values_sent_on_recovery(self):
+        queue = alarm_events.state_queue()
+        self._update('987618340103001_', '987618140103001_',
+                     '987618057003001_')
+        self.assertEqual([], self.server.requests)
+        self.assertTrue(queue.waiting(self.prefix))
+        # Not due yet
+        self.assertEqual(1, queue.retry())
+        self.server.down = False
+        self.assertEqual(0, queue.retry(force=True))
+        self.assertEqual(
+            [('/alarm/bypass', 'yes'),
+             ('/alarm/event', 'System disarmed normally'),
+             ('/alarm/event_code', '401'),
+             ('/alarm/state', 'disarmed')],
+            [(path, body) for path, body in self.server.requests
+             if path != '/alarm/event_full'])
+        self.assertFalse(queue.waiting(self.prefix))
+        # Once the queue is empty, updates go straight out again
+        del self.server.requests[:]
+        self._update('987618340103001_')
+        self.assertEqual('/alarm/state', self.server.requests[0][0])
+
+    def test_batch_collapsed(self):
+        alarm_events.CONFIG.set('9876', 'post_batch', 'yes')
+        self._update('987618340103001_', '987618357003001_')
+        self.server.down = False
+        self.assertEqual(0, alarm_events.state_queue().retry(force=True))
+        (path, body), = self.server.requests
+        self.assertEqual('/alarm', path)
+        values = json.loads(body)
+        self.assertEqual('armed', values['state'])
+        self.assertEqual('no', values['bypass'])
+        # Bypasses only set bypass
+        self.assertEqual('401', values['event_code'])
+
+    def test_backoff(self):
+        queue = alarm_events.StateQueue(self.tmpdir, backoff=10,
+                                        max_backoff=25)
+        queue.put(self.prefix, [('state', 'armed')], False, now=1000)
+        due = queue.next_due()
+        self.assertTrue(1005 <= due <= 1010, due)
+        self.assertEqual(1, queue.retry(now=due))
+        due2 = queue.next_due()
+        self.assertTrue(due + 10 <= due2 <= due + 20, due2 - due)
+        queue.retry(now=due2)
+        queue.retry(now=queue.next_due())
+        self.assertTrue(queue.next_due() - due2 <= 25 * 2)
+        entry, = [json.load(open(os.path.join(self.tmpdir, name)))
+                  for name in os.listdir(self.tmpdir)
+                  if name.endswith('.json')]
+        self.assertEqual(4, entry['failures'])
+        self.assertEqual({'state': 'armed'}, entry['values'])
+
+    def test_claimed_while_sending(self):
+        queue = alarm_events.StateQueue(self.tmpdir)
+        other = alarm_events.StateQueue(self.tmpdir)
+        queue.put(self.prefix, [('state', 'armed')], False, now=1000)
+        sends = []
+        send = alarm_events.StateQueue._send
+
+        def slow_send(entry):
+            sends.append(entry['values'])
+            if len(sends) == 1:
+                # Another shard or run retries while this one sends
+                self.assertEqual(1, other.retry(now=2000, force=True))
+                self.assertEqual(2000 + other.CLAIM, other.next_due())
+            return send(entry)
+        self.server.down = False
+        with mock.patch.object(alarm_events.StateQueue, '_send',
+                               staticmethod(slow_send)):
+            self.assertEqual(0, queue.retry(now=2000))
+        self.assertEqual([{'state': 'armed'}], sends)
+        self.assertEqual([('/alarm/state', 'armed')], self.server.requests)
+
+    def test_claim_expires(self):
+        queue = alarm_events.StateQueue(self.tmpdir)
+        queue.put(self.prefix, [('state', 'armed')], False, now=1000)
+        path, = [os.path.join(self.tmpdir, name)
+                 for name in os.listdir(self.tmpdir)
+                 if name.endswith('.json')]
+        entry = json.load(open(path))
+        # Left behind by a run that died while sending
+        entry['claimed'] = 2000 + queue.CLAIM
+        with open(path, 'w') as f:
+            json.dump(entry, f)
+        self.server.down = False
+        self.assertEqual(1, queue.retry(now=2000, force=True))
+        self.assertEqual([], self.server.requests)
+        self.assertEqual(0, queue.retry(now=2001 + queue.CLAIM))
+        self.assertEqual([('/alarm/state', 'armed')], self.server.requests)
+
+    def test_background_retry(self):
+        queue = alarm_events.StateQueue(self.tmpdir, backoff=0.05,
+                                        max_backoff=0.2)
+        self.addCleanup(queue.close)
+        queue.start()
+        queue.put(self.prefix, [('state', 'armed')], False)
+        time.sleep(0.3)
+        self.server.down = False
+        deadline = time.time() + 5
+        while queue.waiting(self.prefix) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual([('/alarm/state', 'armed')], self.server.requests)
+
 
 class TestMisc(BaseTest):
     def test_process_event(self):
         extension, name, event = alarm_events.process_event(FAKE_EVENT_LINES)
         self.assertEqual('1', extension)
         self.assertEqual('Test Caller', name)
-        self.assertEqual('987618340103001_', event)
+        self.assertEqual('987618340103001B', event)
 
     def test_mail_nomail(self):
         e = alarm_events.Event()
@@ -267,3 +1029,1424 @@ class TestMisc(BaseTest):
                                system_format=('%(partition)s-%(from_ext)s-'
                                               '%(from_caller)s-%(account)s'))
         self.assertEqual('456-foo-bar-123', e.system)
+
+
+class TestDaemon(BaseTest):
+    def setUp(self):
+        super(TestDaemon, self).setUp()
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool)
+
+    def test_watcher_wakes_on_new_file(self):
+        watcher = alarm_events.SpoolWatcher(self.spool, poll_interval=0.01)
+        self.addCleanup(watcher.close)
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        start = time.time()
+        watcher.wait(5)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_watcher_polling_fallback(self):
+        with mock.patch.object(alarm_events.SpoolWatcher, '_inotify_open',
+                               side_effect=OSError):
+            watcher = alarm_events.SpoolWatcher(self.spool,
+                                                poll_interval=0.01)
+        self.assertTrue(watcher.polling)
+        with mock.patch('time.sleep') as mock_sleep:
+            watcher.wait(5)
+            mock_sleep.assert_called_once_with(0.01)
+
+    def test_read_spool_file(self):
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        event, = alarm_events.read_spool_file(fn, '%(from_ext)s-%(account)s')
+        self.assertEqual('1-9876', event.system)
+        self.assertEqual('Test Caller', event.from_name)
+        self.assertEqual('bar', event.metadata['FOO'])
+
+    def test_read_spool_file_bulk(self):
+        fn = os.path.join(self.spool, 'event-1')
+        codes = ['987618340103001B', '9876183401030011', '987618140103001C']
+        with open(fn, 'w') as f:
+            f.write('[metadata]\nCALLINGFROM=1\n[events]\n%s\n'
+                    'CALLINGFROM=2\n%s\n' % ('\n'.join(codes * 200), codes[0]))
+        with mock.patch('alarm_events.parse_event_code') as per_code:
+            events = list(alarm_events.read_spool_file(fn))
+        self.assertFalse(per_code.called)
+        self.assertEqual(codes * 200 + codes[:1],
+                         [event.raw_event for event in events])
+        self.assertEqual([(401, 3, 3, 1, '1'), (401, 3, 3, 1, '2')],
+                         [(e.event_code, e.qualifier, e.partition,
+                           e.zone_number, e.from_ext)
+                          for e in (events[0], events[-1])])
+
+        # A malformed line falls back to parsing its batch code by code
+        with open(fn, 'a') as f:
+            f.write('98761834010300\n')
+        malformed = []
+        events = list(alarm_events.read_spool_file(
+            fn, malformed=lambda line, error: malformed.append(line)))
+        self.assertEqual(601, len(events))
+        self.assertEqual(['98761834010300'], malformed)
+        self.assertRaises(alarm_events.InvalidEvent, list,
+                          alarm_events.read_spool_file(fn))
+
+
+
+class TestEventScreen(BaseTest):
+    def setUp(self):
+        super(TestEventScreen, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'dedup.json')
+
+    def _event(self, code='987618340103001B', ext='1'):
+        e = alarm_events.parse_event_code(code)
+        e.from_ext = ext
+        return e
+
+    def test_checksum(self):
+        screen = alarm_events.EventScreen()
+        self.assertEqual('rejected',
+                         screen.check(self._event('9876183401030011')))
+        self.assertEqual('accepted', screen.check(self._event()))
+        screen = alarm_events.EventScreen(verify_checksum=False)
+        self.assertEqual('accepted',
+                         screen.check(self._event('9876183401030011')))
+
+    def test_window(self):
+        screen = alarm_events.EventScreen(window=60)
+        self.assertEqual('accepted', screen.check(self._event(), now=100))
+        self.assertEqual('suppressed', screen.check(self._event(), now=130))
+        self.assertEqual('accepted',
+                         screen.check(self._event(ext='2'), now=130))
+        self.assertEqual('accepted', screen.check(self._event(), now=161))
+        self.assertEqual({'accepted': 3, 'rejected': 0, 'suppressed': 1},
+                         screen.counts)
+
+    def test_bounded(self):
+        screen = alarm_events.EventScreen(window=60, max_entries=2)
+        for ext in ('1', '2', '3'):
+            screen.check(self._event(ext=ext), now=100)
+        self.assertEqual(2, len(screen.seen))
+        self.assertEqual('accepted',
+                         screen.check(self._event(ext='1'), now=101))
+
+    def test_persisted(self):
+        screen = alarm_events.EventScreen(window=60, path=self.path)
+        screen.check(self._event(), now=100)
+        screen.save()
+        screen = alarm_events.EventScreen(window=60, path=self.path)
+        self.assertEqual('suppressed', screen.check(self._event(), now=110))
+        self.assertEqual(1, screen.totals['suppressed'])
+        self.assertEqual(2, screen.totals['accepted'] +
+                         screen.totals['suppressed'])
+        self.assertIn('1 duplicate(s) suppressed, 3 sink call(s) saved',
+                      screen.summary())
+
+    def test_concurrent_runs(self):
+        first = alarm_events.EventScreen(window=60, path=self.path)
+        second = alarm_events.EventScreen(window=60, path=self.path)
+        first.check(self._event(), now=100)
+        second.check(self._event(ext='2'), now=101)
+        second.check(self._event(ext='2'), now=102)
+        first.save()
+        second.save()
+        first.check(self._event(ext='3'), now=103)
+        first.save()
+        screen = alarm_events.EventScreen(window=60, path=self.path)
+        for ext in ('1', '2', '3'):
+            self.assertEqual('suppressed',
+                             screen.check(self._event(ext=ext), now=110))
+        self.assertEqual({'accepted': 3, 'rejected': 0, 'suppressed': 4},
+                         screen.totals)
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main(self, mock_mail, mock_log, mock_update, mock_glob):
+        alarm_events.CONFIG.set('general', 'spool_dir', self.tmpdir)
+        alarm_events.CONFIG.set('general', 'dedup_window', '60')
+        files = []
+        for i, code in enumerate(['987618340103001B', '987618340103001B',
+                                  '9876183401030011']):
+            fn = os.path.join(self.tmpdir, 'event-%i' % i)
+            with open(fn, 'w') as f:
+                f.write('\n'.join(FAKE_EVENT_LINES[:-1] + [code]))
+            files.append(fn)
+        mock_glob.return_value = files
+        with mock.patch('sys.stderr'), mock.patch('sys.stdout'):
+            alarm_events.main()
+        self.assertEqual(1, mock_mail.call_count)
+        self.assertEqual(['dedup.json', 'dedup.json.lock', 'processing',
+                          'rejected-event-2'],
+                         sorted(os.listdir(self.tmpdir)))
+
+
+class TestCheckIns(BaseTest):
+    def setUp(self):
+        super(TestCheckIns, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'checkins.json')
+        cfg = alarm_events.CONFIG
+        cfg.set('general', 'spool_dir', self.tmpdir)
+        cfg.set('9876', 'checkin_interval', '60')
+        cfg.set('9876', 'checkin_grace', '10')
+        cfg.add_section('1234')
+        cfg.set('1234', 'name', 'Unwatched')
+
+    def _event(self, code='9876181401010013', ext='1'):
+        e = alarm_events.parse_event_code(code)
+        e.from_ext = ext
+        return e
+
+    def test_missed_and_restored(self):
+        monitor = alarm_events.CheckInMonitor()
+        self.assertEqual([], monitor.seen(self._event(), now=1000))
+        self.assertEqual(1070, monitor.next_due())
+        self.assertEqual([], monitor.check(1069))
+        missed, = monitor.check(1070)
+        self.assertEqual(('9876', 354, 1, '1'),
+                         (missed.system, missed.event_code,
+                          missed.qualifier, missed.from_ext))
+        self.assertTrue(alarm_events.checksum_ok(missed.raw_event))
+        self.assertIn('LASTSEEN', missed.metadata)
+        self.assertEqual([], monitor.check(5000))
+        self.assertEqual(None, monitor.next_due())
+        restored, = monitor.seen(self._event(), now=5001)
+        self.assertEqual((354, 3), (restored.event_code, restored.qualifier))
+        self.assertEqual(5071, monitor.next_due())
+
+    def test_default_grace_and_unwatched(self):
+        alarm_events.CONFIG.remove_option('9876', 'checkin_grace')
+        monitor = alarm_events.CheckInMonitor(self.path)
+        self.assertEqual([], monitor.seen(self._event('1234181401010019')))
+        self.assertEqual(None, monitor.next_due())
+        self.assertFalse(os.path.exists(self.path))
+        monitor.seen(self._event(), now=1000)
+        self.assertEqual(1066, monitor.next_due())
+
+    def test_rebalanced_with_shards(self):
+        alarm_events.CONFIG.set('1234', 'checkin_interval', '60')
+        alarm_events.CONFIG.set('1234', 'checkin_grace', '10')
+        state = alarm_events.state_path
+
+        def monitor(router, system):
+            index = router and router.shard(system)
+            return alarm_events.CheckInMonitor(
+                state(alarm_events.checkin_file(index)))
+
+        alarm_events.rebalance_checkins()
+        self.assertEqual([], os.listdir(self.tmpdir))
+        monitor(None, '9876').seen(self._event(), now=1000)
+        monitor(None, '1234').seen(self._event('1234181401010019'),
+                                   now=1050)
+        missed, = monitor(None, '9876').check(1070)
+
+        for workers in (2, 3, 5):
+            router = alarm_events.ShardRouter(self.tmpdir, None, workers)
+            alarm_events.rebalance_checkins(router)
+            self.assertFalse(os.path.exists(
+                state(alarm_events.checkin_file())))
+            # Each system's new shard knows it, and what it missed
+            self.assertEqual([], monitor(router, '9876').check(1100))
+            self.assertEqual(1120, monitor(router, '1234').stored_due())
+        with mock.patch('alarm_events._checkin_files') as files:
+            alarm_events.rebalance_checkins(router)
+            self.assertFalse(files.called)
+
+        alarm_events.rebalance_checkins()
+        self.assertEqual(['checkins.json', 'checkins.json.due',
+                          'checkins.json.lock', 'checkins.layout',
+                          'checkins.layout.lock', 'shards'],
+                         sorted(os.listdir(self.tmpdir)))
+        restored, = monitor(None, '9876').seen(self._event(), now=1200)
+        self.assertEqual((354, 3), (restored.event_code, restored.qualifier))
+        missed, = monitor(None, '1234').check(1120)
+        self.assertEqual('1234', missed.system)
+
+    def test_shared_between_runs(self):
+        def due():
+            with open(self.path + '.due') as f:
+                return f.read()
+        monitor = alarm_events.CheckInMonitor(self.path)
+        monitor.seen(self._event(), now=1000)
+        monitor.seen(self._event(), now=2000)
+        # Only logged; the stored deadline may be early, never late
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual('1070.0', due())
+        monitor = alarm_events.CheckInMonitor(self.path)
+        self.assertEqual(1070, monitor.stored_due())
+        self.assertEqual([], monitor.check(1070))
+        self.assertEqual(2070, monitor.stored_due())
+        self.assertFalse(os.path.exists(self.path + '.log'))
+        self.assertEqual('2070.0', due())
+
+        self.assertEqual(1, len(alarm_events.CheckInMonitor(
+            self.path).check(2070)))
+        self.assertEqual('\n9876', due())
+        # Another run does not raise it again, and restores it
+        monitor = alarm_events.CheckInMonitor(self.path)
+        self.assertEqual([], monitor.check(3000))
+        monitor = alarm_events.CheckInMonitor(self.path)
+        self.assertEqual(1, len(monitor.seen(self._event(), now=3001)))
+        self.assertEqual('3071.0', due())
+        self.assertEqual([], alarm_events.CheckInMonitor(
+            self.path).seen(self._event(), now=3002))
+        monitor = alarm_events.CheckInMonitor(self.path)
+        self.assertEqual(3072, monitor.next_due())
+        self.assertEqual(0, len(monitor.check(3071)))
+
+    def test_heap_compacted(self):
+        monitor = alarm_events.CheckInMonitor()
+        for now in range(1000):
+            monitor.seen(self._event(), now=now)
+        self.assertTrue(len(monitor._heap) < 100)
+        self.assertEqual(1069, monitor.next_due())
+
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main(self, mock_mail, mock_log, mock_update):
+        monitor = alarm_events.CheckInMonitor(self.path)
+        monitor.seen(self._event(), now=time.time() - 100)
+        monitor.save()
+        with mock.patch('sys.stdout'):
+            alarm_events.main()
+        event, = mock_mail.call_args[0]
+        self.assertEqual((354, 1), (event.event_code, event.qualifier))
+        self.assertEqual(1, mock_log.call_count)
+
+        # Delivered along with the next event from the system
+        fn = os.path.join(self.tmpdir, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        alarm_events.CONFIG._alarm_checkins = None
+        with mock.patch('sys.stdout'):
+            alarm_events.main()
+        self.assertEqual([(354, 3), (401, 3)],
+                         [(call[0][0].event_code, call[0][0].qualifier)
+                          for call in mock_mail.call_args_list[1:]])
+
+
+class TestSpoolFiles(BaseTest):
+    def setUp(self):
+        super(TestSpoolFiles, self).setUp()
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool)
+
+    @mock.patch('alarm_events.Dispatcher.from_config')
+    def test_main_empty_spool(self, mock_dispatcher):
+        alarm_events.CONFIG.set('general', 'spool_dir', self.spool)
+        alarm_events.main()
+        self.assertFalse(mock_dispatcher.called)
+
+    def test_iter_spool_records_lazy(self):
+        def lines():
+            yield '[metadata]'
+            yield 'CALLINGFROM=1'
+            yield '[events]'
+            yield '987618340103001B'
+            yield 'TIMESTAMP=later'
+            yield '9876181401030011'
+            raise AssertionError('read past what was asked for')
+
+        records = alarm_events.iter_spool_records(lines())
+        first = next(records)
+        second = next(records)
+        self.assertEqual(({'CALLINGFROM': '1'}, '987618340103001B'), first)
+        self.assertEqual(({'CALLINGFROM': '1', 'TIMESTAMP': 'later'},
+                          '9876181401030011'), second)
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main_multiple_events(self, mock_mail, mock_log, mock_update,
+                                  mock_glob):
+        codes = ['987618340103001B', '9876181130030012', '9876181401030011']
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES[:-1] + codes))
+        mock_glob.return_value = [fn]
+        alarm_events.CONFIG.set('general', 'dispatch_workers', '1')
+        alarm_events.main()
+        self.assertEqual(codes, [c[0][0].raw_event
+                                 for c in mock_mail.call_args_list])
+        for call in mock_update.call_args_list:
+            self.assertEqual('1', call[0][0].from_ext)
+            self.assertEqual('Test Caller', call[0][0].from_name)
+        self.assertFalse(os.path.exists(fn))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main_partial_failure(self, mock_mail, mock_log, mock_update,
+                                  mock_glob):
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES + ['9876181130030012']))
+        mock_glob.return_value = [fn]
+        mock_mail.side_effect = [None, Exception('mail is down')]
+        self.assertRaises(alarm_events.DispatchError, alarm_events.main)
+        self.assertTrue(os.path.exists(fn))
+
+        # The rerun only mails the event that failed
+        mock_mail.reset_mock()
+        mock_log.reset_mock()
+        mock_update.reset_mock()
+        mock_mail.side_effect = None
+        alarm_events.main()
+        self.assertEqual(['9876181130030012'],
+                         [c[0][0].raw_event for c in mock_mail.call_args_list])
+        self.assertFalse(mock_log.called)
+        self.assertFalse(mock_update.called)
+        self.assertEqual(['processing'], os.listdir(self.spool))
+        self.assertEqual([], os.listdir(os.path.join(self.spool,
+                                                     'processing')))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main_recovers_claimed(self, mock_mail, mock_log, mock_update,
+                                   mock_glob):
+        alarm_events.CONFIG.set('general', 'spool_dir', self.spool)
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        # A run that died after logging the event
+        pid = os.fork()
+        if not pid:
+            claimed = alarm_events.claim_spool_file(fn)
+            alarm_events.SpoolJournal.for_file(claimed).record(0, mock_log)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertFalse(os.path.exists(fn))
+        mock_glob.return_value = [fn]
+        alarm_events.main()
+        self.assertTrue(mock_mail.called)
+        self.assertTrue(mock_update.called)
+        self.assertFalse(mock_log.called)
+        self.assertFalse(os.path.exists(fn))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main_quarantines_bad_file(self, mock_mail, mock_log,
+                                       mock_update, mock_glob):
+        files = []
+        for i, code in enumerate(['98761834010300', '987618340103001B']):
+            files.append(os.path.join(self.spool, 'event-%i' % i))
+            with open(files[-1], 'w') as f:
+                f.write('\n'.join(FAKE_EVENT_LINES[:-1] + [code]))
+        mock_glob.return_value = files
+        with mock.patch('sys.stdout'):
+            self.assertRaises(alarm_events.DispatchError, alarm_events.main)
+        self.assertEqual(1, mock_mail.call_count)
+        self.assertEqual(['processing', 'quarantined-event-0'],
+                         sorted(os.listdir(self.spool)))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main_skips_bad_line(self, mock_mail, mock_log, mock_update,
+                                 mock_glob):
+        fn = os.path.join(self.spool, 'event-0')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES[:-1] + [
+                '987618340103001B', '98761834010300', '9876181401030011']))
+        mock_glob.return_value = [fn]
+        with mock.patch('sys.stdout') as stdout:
+            alarm_events.main()
+        self.assertIn("Rejected line '98761834010300'",
+                      ''.join(call[0][0] for call in
+                              stdout.write.call_args_list))
+        self.assertEqual([(401, 3), (401, 1)],
+                         [(call[0][0].event_code, call[0][0].qualifier)
+                          for call in mock_mail.call_args_list])
+        self.assertEqual(2, mock_log.call_count)
+        self.assertEqual(['processing', 'rejected-event-0'],
+                         sorted(os.listdir(self.spool)))
+        self.assertEqual([], os.listdir(os.path.join(self.spool,
+                                                     'processing')))
+
+    def test_no_events(self):
+        fn = os.path.join(self.spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES[:-1]))
+        self.assertRaises(alarm_events.InvalidEvent,
+                          alarm_events.submit_spool_file, fn, None,
+                          alarm_events.EventScreen(), None, None)
+
+
+
+_CLAIM_WORKER = """
+import os, sys
+import alarm_events
+alarm_events.load_config(sys.argv[1])
+fd = os.open(sys.argv[2], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+def mail_event(event):
+    os.write(fd, '%s\\n' % event.from_name)
+alarm_events.mail_event = mail_event
+alarm_events.main()
+"""
+
+
+class TestConcurrentClaims(BaseTest):
+    def setUp(self):
+        super(TestConcurrentClaims, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spool = os.path.join(self.tmpdir, 'spool')
+        os.mkdir(self.spool)
+
+    def _spool(self, count):
+        for i in range(count):
+            with open(os.path.join(self.spool, 'event-%05i' % i), 'w') as f:
+                f.write('\n'.join(FAKE_EVENT_LINES[:3] +
+                                  ['CALLERNAME=Caller %i' % i] +
+                                  FAKE_EVENT_LINES[4:]))
+
+    def test_live_claims_not_recovered(self):
+        self._spool(1)
+        fn = os.path.join(self.spool, 'event-00000')
+        claimed = alarm_events.claim_spool_file(fn)
+        self.addCleanup(alarm_events.close_claims)
+        self.assertEqual(0, alarm_events.recover_spool(self.spool))
+        self.assertTrue(os.path.exists(claimed))
+        self.assertEqual(None, alarm_events.claim_spool_file(fn))
+        alarm_events.close_claims()
+        self.assertTrue(os.path.exists(fn))
+
+    def test_stress(self):
+        count, workers = 1000, 8
+        self._spool(count)
+        config = os.path.join(self.tmpdir, 'test.config')
+        with open(config, 'w') as f:
+            f.write('[general]\nspool_dir = %s\nemail_from = x@y\n'
+                    '[9876]\nname = Test System\nemail = x@y\n'
+                    'nomail_events = 570\n' % self.spool)
+        delivered = os.path.join(self.tmpdir, 'delivered')
+        env = dict(os.environ, HOME=self.tmpdir,
+                   PYTHONPATH=os.path.dirname(
+                       os.path.abspath(alarm_events.__file__)))
+        procs = [subprocess.Popen([sys.executable, '-c', _CLAIM_WORKER,
+                                   config, delivered], env=env,
+                                  stdout=subprocess.PIPE)
+                 for i in range(workers)]
+        for proc in procs:
+            proc.communicate()
+            self.assertEqual(0, proc.returncode)
+        with open(delivered) as f:
+            names = f.read().split('\n')[:-1]
+        self.assertEqual(sorted('Caller %i' % i for i in range(count)),
+                         sorted(names))
+        self.assertEqual(['processing'], os.listdir(self.spool))
+
+
+class TestSharding(BaseTest):
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        self.spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool)
+        alarm_events.CONFIG.set('general', 'spool_dir', self.spool)
+
+    def _spool(self, accounts, calls):
+        """Spool calls events for each account; returns them in order."""
+        spooled = []
+        for i in range(calls):
+            for account in accounts:
+                code = '%04i181401%02i%03i' % (account, 1, i)
+                code += alarm_events.checksum_digit(code)
+                fn = os.path.join(self.spool, 'event-%04i-%03i' % (account,
+                                                                   i))
+                with open(fn, 'w') as f:
+                    f.write('\n'.join(FAKE_EVENT_LINES[:-1] + [code]))
+                os.utime(fn, (1000 + i, 1000 + i))
+                spooled.append(code)
+        return spooled
+
+    def _sharded(self, spool):
+        shards = {}
+        for name in os.listdir(os.path.join(spool, 'shards')):
+            for fn in os.listdir(os.path.join(spool, 'shards', name)):
+                if fn.startswith('event-'):
+                    shards.setdefault(fn[6:10], set()).add(name)
+        return shards
+
+    def test_route_by_account(self):
+        self._spool(range(1000, 1020), 3)
+        router = alarm_events.ShardRouter(self.spool, None, 4)
+        routed, errors = router.route_all()
+        self.assertEqual(([], set(range(4))), (errors, routed))
+        shards = self._sharded(self.spool)
+        self.assertEqual(20, len(shards))
+        self.assertTrue(all(len(names) == 1 for names in shards.values()))
+        self.assertEqual(['shards'], os.listdir(self.spool))
+
+    def test_rebalance_moves_journals(self):
+        self._spool([1000, 1001, 1002, 1003], 1)
+        alarm_events.ShardRouter(self.spool, None, 2).route_all()
+        before = self._sharded(self.spool)['1000'].pop()
+        journal = os.path.join(self.spool, 'shards', before, 'processing',
+                               'event-1000-000.journal')
+        os.mkdir(os.path.dirname(journal))
+        with open(journal, 'w') as f:
+            f.write('0 log_event\n')
+        router = alarm_events.ShardRouter(self.spool, None, 5)
+        self.assertEqual([], router.rebalance())
+        after = self._sharded(self.spool)['1000'].pop()
+        self.assertEqual(after != before, not os.path.exists(journal))
+        with open(os.path.join(self.spool, 'shards', after, 'processing',
+                               'event-1000-000.journal')) as f:
+            self.assertEqual('0 log_event\n', f.read())
+
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_sharded_main(self, mock_mail, mock_log, mock_update):
+        accounts = range(1000, 1030)
+        spooled = self._spool(accounts, 4)
+        delivered = os.path.join(self.spool, 'delivered')
+        fd = os.open(delivered, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self.addCleanup(os.close, fd)
+
+        def mail(event):
+            if event.account == 1007:
+                raise Exception('mail for 1007 is down')
+            os.write(fd, '%i %s\n' % (os.getpid(), event.raw_event))
+
+        mock_mail.side_effect = mail
+        with mock.patch('sys.stdout'):
+            with self.assertRaises(alarm_events.DispatchError) as cm:
+                alarm_events.sharded_main(4)
+        self.assertIn('1 shard(s) failed, 0 file(s) quarantined',
+                      str(cm.exception))
+        with open(delivered) as f:
+            lines = [line.split() for line in f]
+        by_account = {}
+        for pid, code in lines:
+            by_account.setdefault(code[:4], []).append((pid, code))
+        self.assertEqual(29, len(by_account))
+        for account, events in by_account.items():
+            # One worker delivered each account's events, in order
+            self.assertEqual(1, len(set(pid for pid, _ in events)))
+            self.assertEqual([code for code in spooled
+                              if code.startswith(account)],
+                             [code for _, code in events])
+        # The failed account's files wait in its shard for the next run
+        self.assertEqual(4, len(glob.glob(os.path.join(
+            self.spool, 'shards', '*', 'event-1007-*'))))
+
+
+class TestMetrics(BaseTest):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_off_by_default(self):
+        self.assertIs(alarm_events.NULL_METRICS, alarm_events.metrics())
+
+    def test_render(self):
+        collected = alarm_events.Metrics()
+        collected.observe('x_seconds', 0.003, stage='parse')
+        collected.observe('x_seconds', 2, stage='parse')
+        collected.count('x_total', result='ok')
+        collected.gauge('x_backlog', 7)
+        text = collected.render()
+        self.assertIn('# TYPE x_seconds histogram\n', text)
+        self.assertIn('x_seconds_bucket{stage="parse",le="0.0025"} 0\n',
+                      text)
+        self.assertIn('x_seconds_bucket{stage="parse",le="0.005"} 1\n', text)
+        self.assertIn('x_seconds_bucket{stage="parse",le="+Inf"} 2\n', text)
+        self.assertIn('x_seconds_count{stage="parse"} 2\n', text)
+        self.assertIn('x_total{result="ok"} 1\n', text)
+        self.assertIn('x_backlog 7\n', text)
+        self.assertEqual(['x_seconds{stage="parse"} n=2 mean=1001.5ms '
+                          'p50<=5ms p99<=2500ms', 'x_total{result="ok"} 1',
+                          'x_backlog 7'], collected.summary())
+
+    def test_save_accumulates(self):
+        path = os.path.join(self.tmpdir, 'metrics.prom')
+        state = os.path.join(self.tmpdir, 'metrics.json')
+        for run in range(2):
+            collected = alarm_events.Metrics(path, state)
+            collected.count('x_total')
+            collected.save()
+            collected.save()
+        with open(path) as f:
+            self.assertIn('x_total 2\n', f.read())
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('alarm_events.mail_event')
+    def test_main(self, mock_mail, mock_log, mock_update, mock_glob):
+        path = os.path.join(self.tmpdir, 'metrics.prom')
+        alarm_events.CONFIG.set('general', 'metrics_file', path)
+        alarm_events.CONFIG.set('general', 'state_dir', self.tmpdir)
+        mock_log.__name__ = 'log_event'
+        mock_log.side_effect = Exception('disk full')
+        fn = os.path.join(self.tmpdir, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        mock_glob.return_value = [fn]
+        with mock.patch('sys.stderr') as stderr:
+            self.assertRaises(alarm_events.DispatchError, alarm_events.main)
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('alarm_events_sink_calls_total{result="failed",'
+                      'sink="log_event"} 1\n', text)
+        self.assertIn('alarm_events_events_total{verdict="accepted"} 1\n',
+                      text)
+        self.assertIn('alarm_events_spool_backlog 1\n', text)
+        self.assertIn('alarm_events_parse_seconds_count 1\n', text)
+        self.assertIn('alarm_events_files_total{result="failed"} 1\n', text)
+        self.assertTrue(any('alarm_events_spool_wait_seconds' in str(c)
+                            for c in stderr.write.call_args_list))
+
+    def test_server(self):
+        collected = alarm_events.Metrics()
+        collected.count('x_total')
+        server = alarm_events.MetricsServer(collected, 0)
+        self.addCleanup(server.close)
+        body = urllib2.urlopen('http://127.0.0.1:%i/metrics' %
+                               server.port).read()
+        self.assertIn('x_total 1\n', body)
+
+
+class TestEventLog(BaseTest):
+    def setUp(self):
+        super(TestEventLog, self).setUp()
+        self.logdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.logdir)
+        self.event = alarm_events.parse_event_code('987618340103001_')
+        # 2026-10-17 12:00:00 local time
+        self.now = time.mktime((2026, 10, 17, 12, 0, 0, 0, 0, -1))
+
+    def _read(self, name):
+        with open(os.path.join(self.logdir, name)) as f:
+            return f.read()
+
+    def test_line_format(self):
+        with mock.patch.dict(os.environ, {'HOME': self.logdir}):
+            alarm_events.log_event(self.event)
+        self.assertEqual(
+            '%s: Event 401: System armed normally by Fake Master at '
+            'Test System\n' % time.strftime('%Y-%m-%dT%H:%M:%S'),
+            self._read('9876-security.log'))
+
+    def test_buffered(self):
+        log = alarm_events.EventLog(self.logdir, flush_lines=3)
+        log.write(self.event, self.now)
+        log.write(self.event, self.now)
+        self.assertEqual('', self._read('9876-security.log'))
+        log.write(self.event, self.now)
+        self.assertEqual(3, self._read('9876-security.log').count('\n'))
+        log.write(self.event, self.now)
+        log.flush()
+        self.assertEqual(4, self._read('9876-security.log').count('\n'))
+        log.close()
+
+    def test_max_open(self):
+        log = alarm_events.EventLog(self.logdir, max_open=2)
+        for account in (1, 2, 3, 1):
+            event = mock.MagicMock(account=account)
+            event.__str__.return_value = 'Event %i' % account
+            log.write(event, self.now)
+        self.assertEqual(['1-security.log', '3-security.log'],
+                         sorted(os.path.basename(path)
+                                for path in log._files))
+        log.close()
+        self.assertEqual(2, self._read('1-security.log').count('\n'))
+
+    def test_rotate_size_compressed(self):
+        log = alarm_events.EventLog(self.logdir, rotate_size=200,
+                                    compress=True)
+        for i in range(3):
+            log.write(self.event, self.now)
+        log.close()
+        rotated = glob.glob(os.path.join(self.logdir, '*.gz'))
+        self.assertEqual(1, len(rotated))
+        self.assertEqual(2, gzip.open(rotated[0]).read().count('\n'))
+        self.assertEqual(1, self._read('9876-security.log').count('\n'))
+
+    def test_rotate_daily(self):
+        log = alarm_events.EventLog(self.logdir, rotate_period='daily')
+        log.write(self.event, self.now)
+        log.write(self.event, self.now + 86400)
+        log.close()
+        self.assertIn('2026-10-17T12:00:00',
+                      self._read('9876-security.log.2026-10-17'))
+        self.assertIn('2026-10-18T12:00:00',
+                      self._read('9876-security.log'))
+
+    def test_json_lines(self):
+        log = alarm_events.EventLog(self.logdir, json_lines=True)
+        log.write(self.event, self.now)
+        log.close()
+        record = json.loads(self._read('9876-security.jsonl'))
+        self.assertEqual(401, record['event_code'])
+        self.assertEqual('Fake Master', record['user'])
+        self.assertEqual('987618340103001_', record['raw_event'])
+        self.assertEqual('2026-10-17T12:00:00', record['time'])
+
+
+class TestHistory(BaseTest):
+    def setUp(self):
+        super(TestHistory, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.store = alarm_history.EventStore(
+            os.path.join(self.tmpdir, 'history.db'))
+        self.addCleanup(self.store.close)
+        self.now = time.mktime((2026, 10, 17, 12, 0, 0, 0, 0, -1))
+
+    def test_sink(self):
+        alarm_events.CONFIG.set('general', 'history_db',
+                                os.path.join(self.tmpdir, 'sink.db'))
+        event = alarm_events.parse_event_code('987618113003001_')
+        alarm_events.store_event(event)
+        store = alarm_events.event_store()
+        self.assertEqual(1, store.count(account=9876, zone=1))
+        alarm_events.close_sinks()
+        self.assertIsNone(alarm_events.CONFIG._alarm_store)
+
+    def test_sink_unset(self):
+        alarm_events.store_event(None)
+        self.assertIsNone(alarm_events.event_store())
+
+    def test_zone_without_account_indexed(self):
+        where, args = self.store._where(self.now, None, None, 5, None, None)
+        plan = self.store._db.execute(
+            'EXPLAIN QUERY PLAN SELECT time FROM events%s ORDER BY time'
+            % where, args).fetchall()
+        self.assertIn('events_zone_time', ' '.join(row[-1] for row in plan))
+
+    def test_queries(self):
+        for offset, code in enumerate(['9876181130030012',
+                                       '987618313001001_',
+                                       '987618113003002_',
+                                       '987618340103001B']):
+            self.store.add(alarm_events.parse_event_code(code),
+                           self.now + offset * 3600)
+        self.assertEqual(4, self.store.count(account=9876))
+        self.assertEqual(0, self.store.count(account=1234))
+        self.assertEqual(3, self.store.count(event_class=1))
+        self.assertEqual(1, self.store.count(event_code=401))
+        self.assertEqual(2, self.store.count(start=self.now + 3600,
+                                             end=self.now + 3 * 3600))
+        last = self.store.last(account=9876, zone=1, event_code=130)
+        self.assertEqual(self.now + 3600, last['time'])
+        self.assertEqual('Alarm 130: Burglary alarm (restored) in zone Front Door at '
+                         'Test System', last['text'])
+        self.assertEqual([1, 3], [row['qualifier'] for row in
+                                  self.store.query(zone=1, event_class=1)])
+
+    def test_import_log(self):
+        log = alarm_events.EventLog(self.tmpdir, json_lines=True)
+        for offset, code in enumerate(['987618113003002_',
+                                       '987618340103001B',
+                                       '9876181602000009']):
+            log.write(alarm_events.parse_event_code(code),
+                      self.now + offset)
+        log.close()
+        path = os.path.join(self.tmpdir, '9876-security.log')
+        with open(path, 'a') as f:
+            f.write('garbage\n')
+        self.assertEqual(3, self.store.import_log(path))
+        rows = self.store.query()
+        self.assertEqual([(130, 2, 1), (401, 1, 3), (602, None, 1)],
+                         [(row['event_code'], row['zone_number'],
+                           row['qualifier']) for row in rows])
+        self.assertEqual(self.now + 1, rows[1]['time'])
+        self.assertEqual(3, self.store.import_log(path[:-3] + 'jsonl'))
+        self.assertEqual(2, self.store.count(zone=2, event_code=130))
+
+    def test_parse_time(self):
+        self.assertEqual(self.now,
+                         alarm_history.parse_time('2026-10-17T12:00:00'))
+        with mock.patch('time.time', return_value=self.now):
+            self.assertEqual(self.now - 7 * 86400,
+                             alarm_history.parse_time('7d'))
+
+
+class TestCoalescer(BaseTest):
+    def setUp(self):
+        super(TestCoalescer, self).setUp()
+        alarm_events.CONFIG.set('9876', 'coalesce_window', '30')
+        self.dispatcher = mock.MagicMock()
+        self.coalescer = alarm_events.Coalescer(self.dispatcher)
+        self.tickets = []
+
+    def _submit(self, code, now=100):
+        ticket = alarm_events.SpoolTicket('event-%i' % len(self.tickets),
+                                          mock.MagicMock())
+        self.tickets.append(ticket)
+        self.coalescer.submit(alarm_events.parse_event_code(code), ticket,
+                              now=now)
+
+    def test_alarms_bypass(self):
+        self._submit('9876181130030012')
+        self.assertEqual(1, self.dispatcher.submit.call_count)
+        self.assertEqual(None, self.coalescer.next_due())
+
+    def test_digest(self):
+        self._submit('987618130100000_')
+        self._submit('987618132100000_', now=110)
+        self._submit('987618340103001_', now=120)
+        self.assertFalse(self.dispatcher.submit.called)
+        self.assertEqual(130, self.coalescer.next_due())
+
+        self.coalescer.flush(now=129)
+        self.assertFalse(self.dispatcher.submit.called)
+        self.coalescer.flush(now=130)
+        self.assertEqual(1, self.dispatcher.submit.call_count)
+        digest, done, sinks, _ = self.dispatcher.submit.call_args[0]
+        self.assertEqual(['987618130100000_', '987618132100000_'],
+                         [e.raw_event for e in digest.events])
+        self.assertEqual(alarm_events.digest_sinks(), sinks)
+        self.assertEqual('2 events at Test System: AC Fail, Siren tamper',
+                         str(digest))
+
+        done([])
+        for ticket in self.tickets[:2]:
+            ticket.close()
+            ticket.on_done.assert_called_once_with(ticket)
+        self.tickets[2].close()
+        self.assertFalse(self.tickets[2].on_done.called)
+
+        # The lone 401 goes out as a plain event
+        self.coalescer.flush()
+        event, done = self.dispatcher.submit.call_args[0][:2]
+        self.assertEqual('987618340103001_', event.raw_event)
+
+    def test_mail_digest(self):
+        alarm_events.CONFIG.set('9876', 'nomail_events', '321')
+        events = [alarm_events.parse_event_code(c)
+                  for c in ('987618130100000_', '987618132100000_',
+                            '987618330100000_')]
+        events[0].metadata = {'TIMESTAMP': 'Mon 10:00'}
+        with mock.patch('subprocess.Popen') as mock_p:
+            alarm_events.mail_digest(alarm_events.Digest(events))
+        self.assertEqual(1, mock_p.call_count)
+        self.assertEqual('2 events at Test System: AC Fail, '
+                         'AC Fail (restored)', mock_p.call_args[0][0][4])
+        body = mock_p.return_value.stdin.write.call_args[0][0]
+        self.assertTrue(body.startswith(
+            'Mon 10:00: Event 301: AC Fail in device Zone 0 at Test System\n'
+            'Event 301: AC Fail (restored) in device Zone 0 at Test System\n'
+            '\nreason=Trouble with Control Panel\n'))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('alarm_events.log_event')
+    @mock.patch('subprocess.Popen')
+    def test_main(self, mock_popen, mock_log, mock_update, mock_glob):
+        fd, fn = tempfile.mkstemp()
+        storm = ['987618130100000_', '987618132100000_'] * 10
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES[:-1] + storm +
+                              ['987618113003001_']))
+        mock_glob.return_value = [fn]
+        alarm_events.CONFIG.set('general', 'verify_checksum', 'no')
+        with mock.patch('sys.stderr'):
+            alarm_events.main()
+        self.assertFalse(os.path.exists(fn))
+        self.assertEqual(2, mock_popen.call_count)
+        self.assertEqual(21, mock_log.call_count)
+        self.assertEqual(2, mock_update.call_count)
+
+class TestDispatcher(BaseTest):
+    def _events(self, *accounts):
+        return [alarm_events.Event(account=account, raw_event=str(i))
+                for i, account in enumerate(accounts)]
+
+    def test_per_account_order(self):
+        delivered = []
+
+        def sink(event):
+            time.sleep(0.001 * (event.account % 3))
+            delivered.append((event.account, int(event.raw_event)))
+
+        dispatcher = alarm_events.Dispatcher([sink], workers=3,
+                                             queue_size=2)
+        for event in self._events(*([1, 2, 3, 4] * 10)):
+            dispatcher.submit(event)
+        dispatcher.close()
+        self.assertEqual(40, len(delivered))
+        for account in (1, 2, 3, 4):
+            seq = [n for a, n in delivered if a == account]
+            self.assertEqual(sorted(seq), seq)
+
+    def test_sinks_run_concurrently(self):
+        barrier = threading.Event()
+
+        def waiter(event):
+            if not barrier.wait(5):
+                raise Exception('other sink never ran')
+
+        def setter(event):
+            barrier.set()
+
+        dispatcher = alarm_events.Dispatcher([waiter, setter], workers=1)
+        results = []
+        dispatcher.submit(self._events(1)[0], results.append)
+        dispatcher.close()
+        self.assertEqual([[]], results)
+
+    def test_sink_timeout(self):
+        release = threading.Event()
+
+        def hung(event):
+            release.wait(5)
+
+        def fast(event):
+            pass
+
+        dispatcher = alarm_events.Dispatcher([hung, fast], workers=1,
+                                             sink_timeout=0.05)
+        results = []
+        dispatcher.submit(self._events(1)[0], results.append)
+        dispatcher.close()
+        release.set()
+        self.assertEqual(1, len(results[0]))
+        self.assertIn('hung timed out', results[0][0])
+        self.assertEqual(results[0], dispatcher.failures)
+
+    def test_order_kept_after_timeout(self):
+        release = threading.Event()
+        delivered = []
+
+        def slow(event):
+            if event.raw_event == '0':
+                release.wait(5)
+            delivered.append(event.raw_event)
+
+        dispatcher = alarm_events.Dispatcher([slow], workers=1,
+                                             sink_timeout=0.05)
+        results = []
+        for event in self._events(1, 1):
+            dispatcher.submit(event, results.append)
+        # The first event overran, and the second waited behind it
+        while len(results) < 2:
+            time.sleep(0.01)
+        self.assertEqual([], delivered)
+        release.set()
+        deadline = time.time() + 5
+        while len(delivered) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        dispatcher.close()
+        self.assertEqual(['0', '1'], delivered)
+        self.assertEqual(2, len(dispatcher.failures))
+
+    @mock.patch('glob.glob')
+    @mock.patch('alarm_events.update_state')
+    @mock.patch('subprocess.Popen')
+    def test_main_keeps_file_on_failure(self, mock_popen, mock_update,
+                                        mock_glob):
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool)
+        alarm_events.CONFIG.set('general', 'spool_dir', spool)
+        fn = os.path.join(spool, 'event-1')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(FAKE_EVENT_LINES))
+        mock_glob.return_value = [fn]
+        mock_update.side_effect = Exception('endpoint down')
+        self.assertRaises(alarm_events.DispatchError, alarm_events.main)
+        self.assertTrue(os.path.exists(fn))
+        self.assertTrue(mock_popen.called)
+
+
+class _StandInSMTP(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while self.running:
+            asyncore.loop(0.01, count=1)
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+
+class TestRouting(BaseTest):
+    def setUp(self):
+        super(TestRouting, self).setUp()
+        cfg = alarm_events.CONFIG
+        cfg.add_section('1234')
+        cfg.set('1234', 'name', 'Shop')
+        cfg.add_section('sink:ops')
+        cfg.set('sink:ops', 'type', 'exec')
+        cfg.set('sink:ops', 'command', 'true')
+        cfg.set('sink:ops', 'events', '100-199, 300-399')
+        cfg.set('sink:ops', 'systems', '9876')
+        cfg.set('9876', 'route_mail',
+                'events=100-199; events=401 qualifiers=3 hours=22-6')
+        cfg.set('1234', 'route_log', 'none')
+
+    def _sinks(self, *names):
+        sinks = []
+        for name in names:
+            sink = lambda event: None
+            sink.__name__ = name
+            sinks.append(sink)
+        return sinks
+
+    def _routed(self, code, system='9876', hour=12):
+        event = alarm_events.parse_event_code(
+            code.replace('9876', system, 1))
+        now = time.mktime((2026, 10, 18, hour, 30, 0, 0, 0, -1))
+        sinks = self._sinks('mail_event', 'log_event', 'update_state',
+                            'sink:ops')
+        return [sink.__name__ for sink in
+                alarm_events.route_table().select(event, sinks, now)]
+
+    def test_parse(self):
+        self.assertEqual([], alarm_events.parse_route('none'))
+        rule, = alarm_events.parse_route('zones=1-3,8 partitions=1')
+        self.assertEqual(frozenset([1, 2, 3, 8]), rule.zones)
+        self.assertEqual(None, rule.events)
+        hours = alarm_events._parse_hours('23:30-0:30')
+        self.assertEqual(range(1410, 1440) + range(0, 30),
+                         [m for m in range(1410, 1440) + range(0, 1410)
+                          if hours >> m & 1])
+        self.assertRaises(ValueError, alarm_events.parse_route, 'zones')
+        self.assertRaises(ValueError, alarm_events.parse_route, 'user=1')
+        self.assertRaises(ValueError, alarm_events.parse_route,
+                          'events=900-1000')
+
+    def test_select(self):
+        everything = ['mail_event', 'log_event', 'update_state', 'sink:ops']
+        # Burglary: mail by route, ops by its default
+        self.assertEqual(everything, self._routed('9876181130030012'))
+        # Arming mails only at night
+        self.assertEqual(['log_event', 'update_state'],
+                         self._routed('9876183401030015'))
+        self.assertEqual(everything[:3],
+                         self._routed('9876183401030015', hour=23))
+        # Disarming is not mailed at all
+        self.assertEqual(['log_event', 'update_state'],
+                         self._routed('987618140103001_', hour=23))
+        # ops only listens to 9876; 1234 is not logged
+        self.assertEqual(['mail_event', 'update_state'],
+                         self._routed('9876181130030012', system='1234'))
+        # Systems without routing get everything
+        self.assertEqual(everything,
+                         self._routed('9876181130030012', system='5555'))
+
+    def test_digest_routed_by_any_event(self):
+        events = [alarm_events.parse_event_code(code)
+                  for code in ('9876181401030011', '9876181130030012')]
+        digest = alarm_events.Digest(events)
+        sinks = self._sinks('mail_event', 'sink:ops')
+        self.assertEqual(sinks, alarm_events.route_table().select(
+            digest, sinks))
+        self.assertEqual([], alarm_events.route_table().select(
+            alarm_events.Digest(events[:1]), sinks[1:]))
+
+    def test_dispatcher_routes(self):
+        delivered = []
+        sinks = [lambda event: delivered.append('mail'),
+                 lambda event: delivered.append('log')]
+        sinks[0].__name__, sinks[1].__name__ = 'mail_event', 'log_event'
+        dispatcher = alarm_events.Dispatcher(sinks, workers=1)
+        results = []
+        dispatcher.submit(alarm_events.parse_event_code('1234181130030015'),
+                          results.append)
+        dispatcher.close()
+        self.assertEqual((['mail'], [[]]), (delivered, results))
+
+    def test_plugins(self):
+        sinks = alarm_events.default_sinks()
+        self.assertEqual('sink:ops', sinks[-1].__name__)
+        self.assertIsInstance(sinks[-1], alarm_events.ExecSink)
+        self.assertEqual(['sink:ops'],
+                         [alarm_events._journal_name(sink) for sink
+                          in alarm_events.digest_sinks()[4:]])
+        alarm_events.CONFIG.set('sink:ops', 'type', 'no_such_type')
+        self.assertIn('Bad sink or routing: Unknown sink type',
+                      alarm_events.validate_config(alarm_events.CONFIG)[0])
+
+    @mock.patch('alarm_events.sink_class')
+    def test_plugin_imported_on_first_event(self, mock_sink_class):
+        alarm_events.CONFIG.set('sink:ops', 'type', 'my_sinks.Pager')
+        sink = alarm_events.sink_plugins()[0]
+        self.assertEqual('sink:ops', sink.__name__)
+        self.assertFalse(mock_sink_class.called)
+        event = alarm_events.parse_event_code('9876181130030012')
+        sink(event)
+        sink(event)
+        mock_sink_class.assert_called_once_with('my_sinks.Pager')
+        plugin = mock_sink_class.return_value.return_value
+        self.assertEqual([mock.call(event)] * 2, plugin.call_args_list)
+
+    def test_exec_sink(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        out = os.path.join(tmpdir, 'out')
+        sink = alarm_events.ExecSink('run', {
+            'command': 'echo $ALARM_EVENT_CODE > %s; cat >> %s' % (out, out)})
+        sink(alarm_events.parse_event_code('9876181130030012'))
+        with open(out) as f:
+            code, record = f.read().split('\n', 1)
+        self.assertEqual('130', code)
+        self.assertEqual('Front Door', json.loads(record)['zone'])
+        failing = alarm_events.ExecSink('fail', {'command': 'echo no; false'})
+        self.assertRaises(Exception, failing,
+                          alarm_events.parse_event_code('9876181130030012'))
+
+    def test_webhook_sink(self):
+        sink = alarm_events.WebhookSink('hook', {'url': 'http://hook/x'})
+        events = [alarm_events.parse_event_code(code)
+                  for code in ('9876181401030011', '9876181130030012')]
+        with mock.patch('urllib2.urlopen') as mock_open:
+            sink(events[0])
+            sink.digest(alarm_events.Digest(events))
+        single, digest = [c[0][0] for c in mock_open.call_args_list]
+        self.assertEqual('http://hook/x', single.get_full_url())
+        self.assertEqual(401, json.loads(single.get_data())['event_code'])
+        self.assertEqual([401, 130], [record['event_code'] for record
+                                      in json.loads(digest.get_data())])
+
+    def test_socket_sink(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        self.addCleanup(server.close)
+        sink = alarm_events.SocketSink('local', {'path': path})
+        self.addCleanup(sink.close)
+        sink(alarm_events.parse_event_code('9876181130030012'))
+        sink(alarm_events.parse_event_code('9876181401030011'))
+        conn, _ = server.accept()
+        conn.settimeout(5)
+        data = ''
+        while data.count('\n') < 2:
+            data += conn.recv(4096)
+        conn.close()
+        self.assertEqual([130, 401], [json.loads(line)['event_code']
+                                      for line in data.split('\n')[:2]])
+
+
+class TestReceiver(BaseTest):
+    def setUp(self):
+        super(TestReceiver, self).setUp()
+        self.dispatcher = mock.MagicMock()
+        self.receiver = alarm_receiver.Receiver(
+            self.dispatcher, alarm_events.EventScreen())
+
+    def _frame(self, seq, data='#9876|1401 01 001', ident='ADM-CID'):
+        return alarm_receiver.frame('"%s"%04iR1L2#9876[%s]' % (ident, seq,
+                                                               data))
+
+    def _reply(self, data):
+        return alarm_receiver.parse_frame(
+            self.receiver.handle(data, ('127.0.0.1', 1)))
+
+    def test_crc(self):
+        self.assertEqual(0xBB3D, alarm_receiver.crc16('123456789'))
+
+    def test_ack_and_deliver(self):
+        reply = self._reply(self._frame(1))
+        self.assertEqual(('ACK', '0001', '1', '2', '9876'),
+                         (reply['id'], reply['seq'], reply['rcvr'],
+                          reply['pref'], reply['acct']))
+        event = self.dispatcher.submit.call_args[0][0]
+        self.assertEqual('9876181401010013', event.raw_event)
+        self.assertEqual('Event 401: System disarmed normally by '
+                         'Fake Master at Test System', str(event))
+        self.assertEqual('127.0.0.1', event.from_caller)
+
+    def test_repeated_sequence(self):
+        self._reply(self._frame(7))
+        self.assertEqual('ACK', self._reply(self._frame(7))['id'])
+        self.assertEqual(1, self.dispatcher.submit.call_count)
+        self._reply(self._frame(8, '#9876|3401 01 001'))
+        self.assertEqual(2, self.dispatcher.submit.call_count)
+
+    def test_reused_sequence(self):
+        # After a reboot the panel counts from 1 again
+        self._reply(self._frame(1))
+        self.assertEqual('ACK', self._reply(self._frame(
+            1, '#9876|1130 01 003'))['id'])
+        self.assertEqual(['9876181401010013', '9876181130010032'],
+                         [call[0][0].raw_event for call in
+                          self.dispatcher.submit.call_args_list])
+
+    def test_nak_and_duh(self):
+        good = self._frame(2)
+        self.assertEqual('NAK', self._reply(good[:6] + 'F' + good[7:])['id'])
+        self.assertEqual('NAK', self._reply(good.replace('1401', '1402'))[
+            'id'])
+        self.assertEqual('DUH', self._reply(self._frame(3, '#9876|X'))['id'])
+        self.assertEqual('DUH', self._reply(self._frame(
+            4, ident='*ADM-CID'))['id'])
+        self.assertEqual('ACK', self._reply(self._frame(
+            5, '', ident='NULL'))['id'])
+        self.assertFalse(self.dispatcher.submit.called)
+
+    def test_tcp_and_udp(self):
+        server = alarm_receiver.DC09Server(self.receiver, 0, '127.0.0.1')
+        self.addCleanup(server.close)
+        sock = socket.create_connection(('127.0.0.1', server.port))
+        self.addCleanup(sock.close)
+        # Two frames in one packet, and one split across two
+        third = self._frame(3)
+        sock.sendall('noise' + self._frame(1) + self._frame(2) + third[:10])
+        for _ in range(20):
+            server.poll(0.05)
+        sock.sendall(third[10:])
+        replies = ''
+        sock.settimeout(0.05)
+        while replies.count('\r') < 3:
+            server.poll(0.05)
+            try:
+                replies += sock.recv(4096)
+            except socket.timeout:
+                pass
+        self.assertEqual(['0001', '0002', '0003'],
+                         [alarm_receiver.parse_frame(reply + '\r')['seq']
+                          for reply in replies.split('\r')[:-1]])
+        self.assertEqual(3, self.dispatcher.submit.call_count)
+
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(udp.close)
+        udp.sendto(self._frame(4), ('127.0.0.1', server.port))
+        server.poll(1)
+        self.assertEqual('ACK', alarm_receiver.parse_frame(
+            udp.recv(4096))['id'])
+
+        server.sweep(time.time() + server.idle_timeout + 1)
+        self.assertEqual([], server.connections())
+
+
+class TestSMTP(BaseTest):
+    def setUp(self):
+        super(TestSMTP, self).setUp()
+        self.outbox = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outbox)
+
+    def _server(self):
+        server = _StandInSMTP()
+        self.addCleanup(server.stop)
+        return server
+
+    def _mailer(self, port):
+        return alarm_events.SMTPMailer('127.0.0.1', port, retries=1,
+                                       backoff=0, outbox=self.outbox,
+                                       timeout=5)
+
+    def test_connection_reused(self):
+        server = self._server()
+        mailer = self._mailer(server.port)
+        mailer.send('one', 'body 1', 'a@example.com, Bob <b@example.com>',
+                    'Alarm System <foo@bar.com>')
+        mailer.send('two', 'body 2', 'a@example.com')
+        mailer.close()
+        self.assertEqual(1, server.connections)
+        self.assertEqual(2, len(server.messages))
+        mailfrom, rcpttos, data = server.messages[0]
+        self.assertEqual('foo@bar.com', mailfrom)
+        self.assertEqual(['a@example.com', 'b@example.com'], rcpttos)
+        self.assertIn('Subject: one', data)
+
+    def test_outbox(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_port = sock.getsockname()[1]
+        sock.close()
+
+        mailer = self._mailer(dead_port)
+        with mock.patch('sys.stdout'):
+            mailer.send('queued', 'body', 'a@example.com', 'foo@bar.com')
+        self.assertEqual(2, len(os.listdir(self.outbox)))
+        self.assertIn('retry', os.listdir(self.outbox))
+        self.assertEqual(1, mailer.flush_outbox())
+
+        server = self._server()
+        mailer.port = server.port
+        # Not until the server has had time to come back
+        self.assertEqual(1, mailer.flush_outbox())
+        self.assertEqual(0, mailer.flush_outbox(now=time.time() + 60))
+        mailer.close()
+        self.assertEqual([], os.listdir(self.outbox))
+        self.assertEqual(['a@example.com'], server.messages[0][1])
+
+    def test_outbox_unreachable(self):
+        mailer = self._mailer(25)
+        now = time.time()
+        with mock.patch.object(mailer, '_connect') as connect, \
+                mock.patch('sys.stdout'):
+            for i in range(3):
+                mailer._to_outbox('foo@bar.com', ['a@example.com'],
+                                  'mail %i' % i)
+            connect.side_effect = socket.error('unreachable')
+            self.assertEqual(3, mailer.flush_outbox(now))
+            self.assertEqual(1, connect.call_count)
+            # Later runs wait, for longer after each failure
+            self.assertEqual(3, self._mailer(25).flush_outbox(now + 59))
+            self.assertEqual(3, mailer.flush_outbox(now + 60))
+            self.assertEqual(2, connect.call_count)
+            self.assertEqual(3, mailer.flush_outbox(now + 60 + 119))
+            self.assertEqual(2, connect.call_count)
+
+    def test_backoff_unlocked(self):
+        mailer = alarm_events.SMTPMailer('127.0.0.1', 25, retries=2,
+                                         backoff=1, outbox=self.outbox)
+        sleeps = []
+
+        def sleep(seconds):
+            # Other lanes may send meanwhile
+            self.assertTrue(mailer._lock.acquire(False))
+            mailer._lock.release()
+            sleeps.append(seconds)
+        with mock.patch.object(mailer, '_connect') as connect, \
+                mock.patch('time.sleep', sleep), mock.patch('sys.stdout'):
+            connect.side_effect = socket.error('unreachable')
+            self.assertFalse(mailer.deliver('foo@bar.com', ['a@example.com'],
+                                            'mail'))
+        self.assertEqual([1, 2], sleeps)
+
+    @mock.patch('subprocess.Popen')
+    def test_send_mail_uses_smtp(self, mock_popen):
+        alarm_events.CONFIG.set('general', 'smtp_host', 'mail.example.com')
+        alarm_events.CONFIG.set('general', 'smtp_port', '2525')
+        e = alarm_events.parse_event_code('987618140103001_')
+        with mock.patch('smtplib.SMTP') as mock_smtp:
+            alarm_events.mail_event(e)
+            alarm_events.mail_event(e)
+        self.assertFalse(mock_popen.called)
+        mock_smtp.assert_called_once_with('mail.example.com', 2525,
+                                          timeout=30)
+        conn = mock_smtp.return_value
+        self.assertEqual(2, conn.sendmail.call_count)
+        self.assertEqual(('foo@bar.com', ['junk@danplanet.com']),
+                         conn.sendmail.call_args[0][:2])